@@ -0,0 +1,356 @@
+from flipper_storage_lib import FlipperStorage, MetadataCache, BufferedRead
+from flipper_storage_emulator import EmulatedSerial, DirectoryTree
+from storage import Main as StorageMain
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+class SyncRun(StorageMain):
+    """
+    storage.py command executed in-process, on the benchmark's port, never through a session.
+    Manifests, journals and transfer rates are kept in the benchmark's scratch directory.
+    """
+    def __init__(self, benchmark, argv):
+        super().__init__()
+        self.benchmark = benchmark
+        self.args = self.parser.parse_args(argv)
+
+    def new_port(self):
+        return self.benchmark.new_port()
+
+    def __call__(self):
+        # cache_dir() looks at XDG_CACHE_HOME first on every platform
+        saved = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.benchmark.scratch, 'cache')
+        try:
+            self.args.func()
+        finally:
+            if saved is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = saved
+
+
+class BlockStream:
+    """
+    Stream of prepared data handed out block by block, like USB packets of a serial port
+    """
+    def __init__(self, data, block):
+        self.data = data
+        self.position = 0
+        self.block = block
+
+    @property
+    def in_waiting(self):
+        return min(self.block, len(self.data) - self.position)
+
+    def read(self, size=1):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def readinto(self, view):
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+class Main:
+    def __init__(self):
+        # command args
+        self.parser = argparse.ArgumentParser(description="Measure transfer speed and command latency")
+        self.parser.add_argument("-p", "--port", help="CDC Port, emulated device if not set")
+        self.parser.add_argument("-fp", "--flipper-path", help="Scratch directory on Flipper, removed afterwards", default='/ext/.benchmark')
+        self.parser.add_argument("-o", "--output", help="Write JSON results to file instead of stdout")
+        self.parser.add_argument("--compare", help="Print ratios against results of a previous run")
+        self.parser.add_argument("--sizes", help="File sizes, bytes", default='1024,65536,1048576')
+        self.parser.add_argument("--chunk-sizes", help="Transfer chunk sizes, bytes", default='512,2048,8192')
+        self.parser.add_argument("--windows", help="Upload pipeline windows", default='1,8')
+        self.parser.add_argument("--trees", help="Trees for walk and sync, FANOUTxDEPTH", default='4x2,8x3')
+        self.parser.add_argument("--files-per-dir", help="Files in every directory of a tree", type=int, default=4)
+        self.parser.add_argument("--repeat", help="Runs of every measurement", type=int, default=3)
+        self.parser.add_argument("--only", help="Comma separated groups: transfer,memory,command,buffer,walk,sync", default='transfer,memory,command,buffer,walk,sync')
+        # emulated device
+        self.parser.add_argument("--command-latency", help="Emulated device time per command, ms", type=float, default=2.0)
+        self.parser.add_argument("--link-latency", help="Emulated one-way link latency, ms", type=float, default=0.5)
+        self.parser.add_argument("--baudrate", help="Throttle emulated link to baud rate", type=int)
+
+    def __call__(self):
+        self.args = self.parser.parse_args()
+        self.results = []
+        self.scratch = tempfile.mkdtemp(prefix='flipper-benchmark-')
+        self.tree = DirectoryTree(os.path.join(self.scratch, 'device')) if not self.args.port else None
+        try:
+            storage = self.open_storage()
+            storage.remove_tree(self.args.flipper_path)
+            storage.mkdir(self.args.flipper_path)
+            storage.stop()
+
+            groups = self.args.only.split(',')
+            if 'transfer' in groups:
+                self.transfer()
+            if 'memory' in groups:
+                self.memory()
+            if 'command' in groups:
+                self.command()
+            if 'buffer' in groups:
+                self.buffer()
+            if 'walk' in groups or 'sync' in groups:
+                self.trees('walk' in groups, 'sync' in groups)
+
+            storage = self.open_storage()
+            storage.remove_tree(self.args.flipper_path)
+            storage.stop()
+        finally:
+            shutil.rmtree(self.scratch)
+
+        report = {
+            'version': 1,
+            'device': self.args.port or 'emulator',
+            'emulator': None if self.args.port else {
+                'command_latency_ms': self.args.command_latency,
+                'link_latency_ms': self.args.link_latency,
+                'baudrate': self.args.baudrate,
+            },
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': self.results,
+        }
+        text = json.dumps(report, indent=2)
+        if self.args.output:
+            with open(self.args.output, 'w') as file:
+                file.write(text + '\n')
+        else:
+            print(text)
+
+        if self.args.compare:
+            self.compare(self.args.compare)
+
+    def new_port(self):
+        if self.args.port:
+            return None
+        port = EmulatedSerial(
+            self.tree,
+            command_latency=self.args.command_latency / 1000.0,
+            link_latency=self.args.link_latency / 1000.0,
+            throttle=self.args.baudrate is not None,
+        )
+        if self.args.baudrate:
+            port.baudrate = self.args.baudrate
+        return port
+
+    def open_storage(self):
+        storage = FlipperStorage(self.args.port or 'emulator', self.new_port())
+        storage.start()
+        return storage
+
+    def add(self, group, name, params, samples, unit, value):
+        result = {
+            'group': group,
+            'name': name,
+            'params': params,
+            'unit': unit,
+            'median': value(statistics.median(samples)),
+            'best': value(min(samples)),
+            'worst': value(max(samples)),
+            'samples': len(samples),
+        }
+        self.results.append(result)
+        print(f'{name} {params}: {result["median"]:.3f} {unit}', file=sys.stderr)
+
+    # Run func repeat times, returning seconds per run
+    def measure(self, func, repeat):
+        samples = []
+        for _ in range(repeat):
+            # keep storage.py progress output out of the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                func()
+                samples.append(time.perf_counter() - start)
+        return samples
+
+    def local_file(self, size):
+        filename = os.path.join(self.scratch, 'file-' + str(size))
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as file:
+                file.write(os.urandom(size))
+        return filename
+
+    def transfer(self):
+        storage = self.open_storage()
+        remote = self.args.flipper_path + '/transfer.bin'
+        for size in [int(size) for size in self.args.sizes.split(',')]:
+            local = self.local_file(size)
+            megabytes = size / 1000000.0
+            for chunk_size in [int(chunk_size) for chunk_size in self.args.chunk_sizes.split(',')]:
+                for window in [int(window) for window in self.args.windows.split(',')]:
+                    samples = self.measure(lambda: storage.send_file(local, remote, window, chunk_size), self.args.repeat)
+                    params = {'size': size, 'chunk_size': chunk_size, 'window': window}
+                    self.add('transfer', 'send_file', params, samples, 'MB/s', lambda t: megabytes / t)
+
+                samples = self.measure(lambda: storage.read_file_to(remote, lambda data: None, chunk_size), self.args.repeat)
+                params = {'size': size, 'chunk_size': chunk_size}
+                self.add('transfer', 'read_file', params, samples, 'MB/s', lambda t: megabytes / t)
+        storage.remove(remote)
+        storage.stop()
+
+    # Peak memory traced while sending, should not grow with file size
+    def memory(self):
+        storage = self.open_storage()
+        remote = self.args.flipper_path + '/memory.bin'
+        chunk_size = max(int(chunk_size) for chunk_size in self.args.chunk_sizes.split(','))
+        window = max(int(window) for window in self.args.windows.split(','))
+        for size in [int(size) for size in self.args.sizes.split(',')]:
+            local = self.local_file(size)
+            samples = []
+            for _ in range(self.args.repeat):
+                tracemalloc.start()
+                storage.send_file(local, remote, window, chunk_size)
+                samples.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            params = {'size': size, 'chunk_size': chunk_size, 'window': window}
+            self.add('memory', 'send_file peak', params, samples, 'KiB', lambda peak: peak / 1024.0)
+        storage.remove(remote)
+        storage.stop()
+
+    def command(self):
+        storage = self.open_storage()
+        # stat would be answered from cache after the first run, time the device instead
+        storage.cache = MetadataCache(0)
+        repeat = self.args.repeat * 10
+        remote = self.args.flipper_path + '/command.bin'
+        storage.send_file(self.local_file(65536), remote)
+        directory = self.args.flipper_path + '/command'
+
+        to_ms = lambda t: t * 1000.0
+        self.add('command', 'stat', {}, self.measure(lambda: storage.exist(remote), repeat), 'ms', to_ms)
+        self.add('command', 'md5', {'size': 65536}, self.measure(lambda: storage.hash_flipper(remote), repeat), 'ms', to_ms)
+        # mkdir and remove only make sense in pairs, time them apart
+        mkdir = []
+        remove = []
+        for _ in range(repeat):
+            mkdir.extend(self.measure(lambda: storage.mkdir(directory), 1))
+            remove.extend(self.measure(lambda: storage.remove(directory), 1))
+        self.add('command', 'mkdir', {}, mkdir, 'ms', to_ms)
+        self.add('command', 'remove', {}, remove, 'ms', to_ms)
+        storage.remove(remote)
+        storage.stop()
+
+    # BufferedRead.until on answers of every size, throughput should not drop as answers grow
+    def buffer(self):
+        prompt = FlipperStorage.CLI_PROMPT
+        eol = FlipperStorage.CLI_EOL
+        for size in [int(size) for size in self.args.sizes.split(',')]:
+            # a long list answer
+            line = ('[F] file.bin 1024b' + eol).encode()
+            lines = max(1, size // len(line))
+            answer = line * lines + prompt.encode()
+            megabytes = len(answer) / 1000000.0
+            params = {'size': size, 'block': 64}
+
+            def until_prompt():
+                BufferedRead(BlockStream(answer, 64)).until(prompt)
+
+            def until_lines():
+                read = BufferedRead(BlockStream(answer, 64))
+                for _ in range(lines):
+                    read.until(eol)
+                read.until(prompt)
+
+            self.add('buffer', 'until prompt', params, self.measure(until_prompt, self.args.repeat), 'MB/s', lambda t: megabytes / t)
+            self.add('buffer', 'until lines', params, self.measure(until_lines, self.args.repeat), 'MB/s', lambda t: megabytes / t)
+
+    # Local tree with fanout subdirs per level and files_per_dir small files in every dir
+    def local_tree(self, fanout, depth):
+        root = os.path.join(self.scratch, 'tree-' + str(fanout) + 'x' + str(depth))
+        if os.path.exists(root):
+            return root
+        level = [root]
+        for current_depth in range(depth + 1):
+            next_level = []
+            for path in level:
+                os.makedirs(path)
+                for index in range(self.args.files_per_dir):
+                    with open(os.path.join(path, 'file' + str(index) + '.bin'), 'wb') as file:
+                        file.write(os.urandom(64 + index * 256))
+                if current_depth < depth:
+                    next_level.extend(os.path.join(path, 'dir' + str(index)) for index in range(fanout))
+            level = next_level
+        return root
+
+    def sync(self, argv):
+        run = SyncRun(self, ['--no-session', '-p', self.args.port or 'emulator'] + argv)
+        return self.measure(run, 1)
+
+    def trees(self, walk, sync):
+        for tree in self.args.trees.split(','):
+            fanout, depth = [int(value) for value in tree.split('x')]
+            local = self.local_tree(fanout, depth)
+            remote = self.args.flipper_path + '/tree'
+            params = {'fanout': fanout, 'depth': depth, 'files_per_dir': self.args.files_per_dir}
+            to_s = lambda t: t
+
+            full = []
+            noop = []
+            for _ in range(self.args.repeat):
+                storage = self.open_storage()
+                storage.remove_tree(remote)
+                storage.stop()
+                full.extend(self.sync(['send', '-fp', remote, '-lp', local]))
+                noop.extend(self.sync(['send', '-fp', remote, '-lp', local]))
+            if sync:
+                self.add('sync', 'send full', params, full, 's', to_s)
+                self.add('sync', 'send no-op', params, noop, 's', to_s)
+
+            if walk:
+                storage = self.open_storage()
+                samples = self.measure(lambda: sum(1 for _ in storage.walk(remote)), self.args.repeat)
+                storage.stop()
+                self.add('walk', 'walk', params, samples, 's', to_s)
+
+            if sync:
+                received = os.path.join(self.scratch, 'received')
+                full = []
+                again = []
+                for _ in range(self.args.repeat):
+                    shutil.rmtree(received, ignore_errors=True)
+                    full.extend(self.sync(['receive', '-fp', remote, '-lp', received]))
+                    again.extend(self.sync(['receive', '-i', '-fp', remote, '-lp', received]))
+                self.add('sync', 'receive full', params, full, 's', to_s)
+                self.add('sync', 'receive again', params, again, 's', to_s)
+
+            storage = self.open_storage()
+            storage.remove_tree(remote)
+            storage.stop()
+
+    # Print median ratios of this run against an older report
+    def compare(self, filename):
+        with open(filename) as file:
+            baseline = json.load(file)
+
+        def key(result):
+            return (result['group'], result['name'], json.dumps(result['params'], sort_keys=True))
+
+        old = {key(result): result for result in baseline['results']}
+        for result in self.results:
+            if key(result) not in old:
+                continue
+            before = old[key(result)]['median']
+            after = result['median']
+            ratio = after / before if before else float('inf')
+            print(f'{result["name"]} {result["params"]}: {before:.3f} -> {after:.3f} {result["unit"]} (x{ratio:.2f})', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    Main()()
@@ -0,0 +1,510 @@
+import asyncio
+import functools
+import io
+import os
+import serial
+import tempfile
+import time
+
+from flipper_storage_lib import FlipperStorage, EventSink, Answer, StorageError, PendingWrites, BackgroundWriter
+
+
+class SerialTransport(asyncio.Transport):
+    """
+    Non-blocking asyncio transport over an open pyserial port.
+
+    Incoming data is pushed to the protocol as soon as the event loop sees it:
+    the port file descriptor is watched where the port has one, an emulated
+    port is read when its next answer is due, anything else (e.g. Windows
+    ports) falls back to polling every POLL_INTERVAL seconds.
+    """
+    POLL_INTERVAL = 0.005
+    READ_SIZE = 65536
+    # protocol is asked to pause writing above this many buffered bytes
+    HIGH_WATER = 65536
+
+    def __init__(self, loop, protocol, port):
+        super().__init__()
+        self.loop = loop
+        self.protocol = protocol
+        self.port = port
+        self.buffer = bytearray()
+        self.closing = False
+        self.paused = False
+        self.writing_paused = False
+        self.timer = None
+        try:
+            self.fd = port.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            self.fd = None
+        self.port.timeout = 0
+        self.protocol.connection_made(self)
+        self.resume_reading()
+
+    def get_extra_info(self, name, default=None):
+        if name == 'serial':
+            return self.port
+        return default
+
+    # reading
+
+    def is_reading(self):
+        return not self.paused and not self.closing
+
+    def pause_reading(self):
+        if self.paused or self.closing:
+            return
+        self.paused = True
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        elif self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+    def resume_reading(self):
+        if self.closing:
+            return
+        self.paused = False
+        if self.fd is not None:
+            self.loop.add_reader(self.fd, self.read_ready)
+        else:
+            self.schedule_read()
+
+    # Arm the timer of a port without file descriptor
+    def schedule_read(self):
+        if self.paused or self.closing or self.fd is not None:
+            return
+        if self.timer:
+            self.timer.cancel()
+        if hasattr(self.port, 'next_ready'):
+            ready = self.port.next_ready()
+            self.timer = self.loop.call_at(ready, self.read_ready) if ready is not None else None
+        else:
+            self.timer = self.loop.call_later(self.POLL_INTERVAL, self.read_ready)
+
+    def read_ready(self):
+        self.timer = None
+        try:
+            if self.fd is not None:
+                data = os.read(self.fd, self.READ_SIZE)
+            else:
+                data = self.port.read(self.port.in_waiting)
+        except (BlockingIOError, InterruptedError):
+            data = None
+        except OSError as error:
+            self.fatal(error)
+            return
+        if data:
+            self.protocol.data_received(data)
+        self.schedule_read()
+
+    # writing
+
+    def write(self, data):
+        if self.closing:
+            return
+        self.buffer.extend(data)
+        if len(self.buffer) == len(data):
+            self.write_ready()
+        self.check_high_water()
+
+    def write_ready(self):
+        try:
+            if self.fd is not None:
+                sent = os.write(self.fd, self.buffer)
+            else:
+                sent = self.port.write(self.buffer)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as error:
+            self.fatal(error)
+            return
+        del self.buffer[:sent]
+        if self.fd is not None:
+            if self.buffer:
+                self.loop.add_writer(self.fd, self.write_ready)
+            else:
+                self.loop.remove_writer(self.fd)
+        elif self.buffer:
+            self.loop.call_later(self.POLL_INTERVAL, self.write_ready)
+        # an emulated device answers on write, its answer is due from now on
+        self.schedule_read()
+        self.check_high_water()
+
+    def check_high_water(self):
+        if not self.writing_paused and len(self.buffer) > self.HIGH_WATER:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+        elif self.writing_paused and not self.buffer:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+
+    def get_write_buffer_size(self):
+        return len(self.buffer)
+
+    def can_write_eof(self):
+        return False
+
+    # closing
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.shutdown(None)
+
+    def abort(self):
+        self.shutdown(None)
+
+    def fatal(self, error):
+        self.shutdown(error)
+
+    def shutdown(self, error):
+        if self.closing:
+            return
+        self.closing = True
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.buffer.clear()
+        self.port.close()
+        self.loop.call_soon(self.protocol.connection_lost, error)
+
+
+# Open port and wrap it into asyncio streams, returns (reader, writer)
+async def open_serial_connection(port, limit=65536):
+    loop = asyncio.get_running_loop()
+    if not port.is_open:
+        port.open()
+    reader = asyncio.StreamReader(limit=limit, loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    transport = SerialTransport(loop, protocol, port)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+class AsyncFlipperStorage:
+    """
+    asyncio client of the Flipper storage CLI.
+
+    Same operations and answers as FlipperStorage, but nothing blocks: answers
+    are parsed by StreamReader as data arrives, so one event loop can drive many
+    devices. Operations on one client are serialized by a lock, operations on
+    different clients run concurrently. Local files are read and written by
+    worker threads, so the event loop does not wait for the disk either.
+
+    Failed transfers are not retried or resumed, chunk sizes are not tuned and
+    nothing is cached, that is left to FlipperStorage.
+    """
+    CLI_PROMPT = FlipperStorage.CLI_PROMPT.encode()
+    CLI_SOH = FlipperStorage.CLI_SOH.encode()
+    CLI_EOL = FlipperStorage.CLI_EOL.encode()
+    CLI_ETX = FlipperStorage.CLI_ETX.encode()
+    CHUNK_SIZE_MAX = FlipperStorage.CHUNK_SIZE_MAX
+    # resync drops answers until the device stays quiet that long, seconds
+    RESYNC_DELAY = 2
+
+    # answers are parsed by Answer and uploads are paced by PendingWrites, like in the blocking client
+    set_error = FlipperStorage.set_error
+    hash_local_file = FlipperStorage.hash_local_file
+    chunk_limit = FlipperStorage.chunk_limit
+    write_buffer = FlipperStorage.write_buffer
+    next_write_chunk = FlipperStorage.next_write_chunk
+
+    # port: serial-like object to talk through instead of a new serial.Serial, e.g. EmulatedSerial, its baud rate is kept
+    def __init__(self, portname: str, port=None):
+        if port is None:
+            port = serial.Serial()
+            port.baudrate = 115200
+        self.port = port
+        self.port.port = portname
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+        self.last_exception = None
+        self.last_error = ''
+        self.last_error_offset = None
+        self.events = EventSink()
+        self.hash_cache = None
+        self.send_window = 1
+        self.chunk_size = FlipperStorage.CHUNK_SIZE
+        # seconds to wait for an answer, None waits forever
+        self.timeout = None
+
+    async def start(self):
+        self.reader, self.writer = await open_serial_connection(self.port)
+        async with self.lock:
+            self.write(self.CLI_SOH)
+            await self.until(self.CLI_PROMPT)
+
+    async def stop(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    def write(self, data):
+        self.writer.write(data)
+        self.events.bytes_sent(len(data))
+
+    # Data up to eol, eol itself is consumed but not returned
+    async def until(self, eol):
+        if self.timeout is None:
+            return await self.read_until(eol)
+        return await asyncio.wait_for(self.read_until(eol), self.timeout)
+
+    async def read_until(self, eol):
+        data = bytearray()
+        while True:
+            try:
+                data += await self.reader.readuntil(eol)
+                break
+            except asyncio.LimitOverrunError as error:
+                # long answer, e.g. a big listing, take what was scanned and go on
+                data += await self.reader.readexactly(error.consumed)
+        self.events.bytes_received(len(data))
+        del data[-len(eol):]
+        return data
+
+    async def read_exactly(self, size):
+        if self.timeout is None:
+            data = await self.reader.readexactly(size)
+        else:
+            data = await asyncio.wait_for(self.reader.readexactly(size), self.timeout)
+        self.events.bytes_received(size)
+        return data
+
+    async def send_and_wait_eol(self, line):
+        self.write(Answer.encode(line))
+        return await self.until(self.CLI_EOL)
+
+    # Storage command with one line answer, caller holds the lock, parse as for FlipperStorage.command
+    async def run_command(self, command, path, parse=Answer.check):
+        self.events.command_started(command, path)
+        start = time.monotonic()
+        await self.send_and_wait_eol('storage ' + command + ' "' + path + '"\r')
+        answer = await self.until(self.CLI_EOL)
+        await self.until(self.CLI_PROMPT)
+        try:
+            result = parse(bytes(answer))
+        except StorageError as error:
+            result = error
+        ok = not isinstance(result, StorageError)
+        self.events.command_done(command, path, time.monotonic() - start, ok)
+
+        if not ok:
+            self.set_error(command, path, result)
+            return None
+        return result
+
+    # Run storage command with one line answer, returns the parsed answer or None on error
+    async def command(self, command, path, parse=Answer.check):
+        async with self.lock:
+            return await self.run_command(command, path, parse)
+
+    # Entries of one directory on Flipper, None on error
+    async def scandir(self, path):
+        path = path.replace('//', '/')
+        async with self.lock:
+            self.events.command_started('list', path)
+            start = time.monotonic()
+            await self.send_and_wait_eol('storage list "' + path + '"\r')
+            data = await self.until(self.CLI_PROMPT)
+        error = Answer.find_error(data)
+        self.events.command_done('list', path, time.monotonic() - start, error is None)
+
+        if error:
+            self.set_error('list', path, error)
+            return None
+        return list(Answer.entries(path, data))
+
+    # Entry of file or dir on Flipper, None if it does not exist
+    async def stat(self, path):
+        return await self.command('stat', path, lambda answer: Answer.stat(path, answer))
+
+    # List files and dirs on Flipper, yields one text line per entry
+    async def list_tree(self, path="/"):
+        for entry in await self.scandir(path) or []:
+            if entry.is_dir:
+                yield entry.path
+                async for line in self.list_tree(entry.path):
+                    yield line
+            else:
+                yield entry.path + ', size ' + str(entry.size) + 'b'
+
+    # Like os.walk, yields (path, dir names, file names); entries=True yields StorageEntry lists instead of names
+    async def walk(self, path="/", entries=False):
+        path = path.replace('//', '/')
+        listing = await self.scandir(path) or []
+        dirs = [entry for entry in listing if entry.is_dir]
+        nondirs = [entry for entry in listing if not entry.is_dir]
+
+        if entries:
+            yield path, dirs, nondirs
+        else:
+            yield path, [entry.name for entry in dirs], [entry.name for entry in nondirs]
+        for entry in dirs:
+            async for item in self.walk(entry.path, entries):
+                yield item
+
+    async def mkdir(self, path):
+        return await self.command('mkdir', path) is not None
+
+    async def remove(self, path):
+        return await self.command('remove', path) is not None
+
+    # Get hash of file on Flipper
+    async def hash_flipper(self, filename):
+        return await self.command('md5', filename, Answer.md5) or ''
+
+    # Hash of local file, read by a worker thread
+    async def hash_local(self, filename):
+        return await asyncio.get_running_loop().run_in_executor(None, FlipperStorage.hash_local, self, filename)
+
+    # Send file from local device to Flipper
+    # window > 1 keeps that many write_chunk commands in flight, like FlipperStorage.send_file
+    async def send_file(self, filename_from, filename_to, window=None, chunk_size=None):
+        window = max(1, window or self.send_window)
+        chunk_size = self.chunk_limit(chunk_size or self.chunk_size)
+        file = await asyncio.get_running_loop().run_in_executor(None, open, filename_from, 'rb')
+        with file:
+            filesize = os.fstat(file.fileno()).st_size
+            async with self.lock:
+                await self.run_command('remove', filename_to)
+                return await self.write_chunks(file, filename_to, filesize, window, chunk_size)
+
+    # Chunks are read by a worker thread into one reused buffer, as in FlipperStorage.write_chunks
+    async def write_chunks(self, file, filename_to, filesize, window, chunk_size):
+        loop = asyncio.get_running_loop()
+        in_flight = PendingWrites(window)
+        buffer = self.write_buffer(filename_to, chunk_size)
+        offset = 0
+        while True:
+            command, filedata = await loop.run_in_executor(None, self.next_write_chunk, file, buffer, chunk_size)
+            size = len(filedata)
+            if size == 0:
+                break
+
+            while in_flight.full():
+                if not await self.write_chunk_done(in_flight, filename_to, filesize):
+                    return False
+
+            self.events.command_started('write_chunk', filename_to)
+            start = time.monotonic()
+            if in_flight.acknowledged(offset):
+                self.write(command[:len(command) - size])
+                await self.until(self.CLI_EOL)
+                error = Answer.error(await self.until(self.CLI_EOL))
+                if error:
+                    await self.until(self.CLI_PROMPT)
+                    self.events.command_done('write_chunk', filename_to, time.monotonic() - start, False)
+                    self.set_error('write_chunk', filename_to, error, offset)
+                    return False
+                self.write(filedata)
+                in_flight.sent(offset, size, False, start)
+            else:
+                self.write(command)
+                in_flight.sent(offset, size, True, start)
+            # the transport has its own copy now, the buffer can take the next chunk
+            await self.writer.drain()
+            offset += size
+
+        while in_flight:
+            if not await self.write_chunk_done(in_flight, filename_to, filesize):
+                return False
+        return True
+
+    # Wait for the oldest in-flight write_chunk to complete
+    async def write_chunk_done(self, in_flight, filename, filesize):
+        offset, size, start, error, resync = in_flight.answered(await self.until(self.CLI_PROMPT))
+        self.events.command_done('write_chunk', filename, time.monotonic() - start, error is None)
+
+        if error:
+            self.set_error('write_chunk', filename, error, offset)
+            if resync:
+                await self.resync()
+            return False
+
+        self.events.progress(filename, offset + size, filesize)
+        return True
+
+    # Drop pending answers and get a fresh prompt
+    async def resync(self):
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(65536), self.RESYNC_DELAY)
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                # end of stream, the prompt below fails on it
+                break
+        self.write(self.CLI_ETX)
+        await self.until(self.CLI_PROMPT)
+
+    # Receive file from Flipper, and get filedata (bytes)
+    async def read_file(self, filename, chunk_size=None):
+        filedata = bytearray()
+        await self.read_file_to(filename, filedata.extend, chunk_size)
+        return filedata
+
+    # Receive file from Flipper chunk by chunk, every chunk is passed to sink(data)
+    # sink is a callable or a file object, it is called on the event loop and should not block
+    async def read_file_to(self, filename, sink, chunk_size=None):
+        if hasattr(sink, 'write'):
+            sink = sink.write
+        chunk_size = self.chunk_limit(chunk_size or self.chunk_size)
+        async with self.lock:
+            self.events.command_started('read_chunks', filename)
+            start = time.monotonic()
+            await self.send_and_wait_eol('storage read_chunks "' + filename + '" ' + str(chunk_size) + '\r')
+            try:
+                size = Answer.read_size(await self.until(self.CLI_EOL))
+            except StorageError as error:
+                await self.until(self.CLI_PROMPT)
+                self.events.command_done('read_chunks', filename, time.monotonic() - start, False)
+                self.set_error('read_chunks', filename, error)
+                return False
+            readed_size = 0
+
+            while readed_size < size:
+                await self.until(b'Ready?' + self.CLI_EOL)
+                self.write(b'y')
+                read_size = min(size - readed_size, chunk_size)
+                sink(await self.read_exactly(read_size))
+                readed_size = readed_size + read_size
+                self.events.progress(filename, readed_size, size)
+            await self.until(self.CLI_PROMPT)
+            self.events.command_done('read_chunks', filename, time.monotonic() - start, True)
+            return True
+
+    # Receive file from Flipper to local storage, through a temporary file next to filename_to
+    # The file is written by a BackgroundWriter thread, opened and closed by a worker thread
+    async def receive_file(self, filename_from, filename_to):
+        loop = asyncio.get_running_loop()
+        directory = os.path.dirname(os.path.abspath(filename_to))
+        prefix = '.' + os.path.basename(filename_to) + '.'
+        open_temporary = functools.partial(tempfile.NamedTemporaryFile, 'wb', dir=directory, prefix=prefix, suffix='.part', delete=False)
+        file = await loop.run_in_executor(None, open_temporary)
+        try:
+            writer = BackgroundWriter(file)
+            try:
+                done = await self.read_file_to(filename_from, writer)
+            finally:
+                await loop.run_in_executor(None, self.close_writer, writer)
+            if done:
+                await loop.run_in_executor(None, os.replace, file.name, filename_to)
+            return done
+        finally:
+            if os.path.exists(file.name):
+                os.remove(file.name)
+
+    # Wait for the writes of writer and close its file, raises the error of a write
+    @staticmethod
+    def close_writer(writer):
+        try:
+            writer.close()
+        finally:
+            writer.file.close()
@@ -0,0 +1,425 @@
+import os
+import time
+import hashlib
+from collections import deque
+from serial.serialutil import SerialBase, SerialException
+
+
+class MemoryTree:
+    """
+    In-memory storage backend, paths are Flipper-style ("/ext/dir/file")
+    """
+    def __init__(self):
+        self.nodes = {'/': None, '/ext': None, '/int': None}
+
+    def stat(self, path):
+        if path not in self.nodes:
+            return None
+        node = self.nodes[path]
+        if node is None:
+            return ('dir', 0)
+        return ('file', len(node))
+
+    def listdir(self, path):
+        prefix = path.rstrip('/') + '/'
+        names = []
+        for key, node in self.nodes.items():
+            if key != path and key.startswith(prefix) and '/' not in key[len(prefix):]:
+                names.append((key[len(prefix):], 'dir' if node is None else 'file', 0 if node is None else len(node)))
+        return names
+
+    def mkdir(self, path):
+        self.nodes[path] = None
+
+    def remove(self, path):
+        del self.nodes[path]
+
+    def append(self, path, data):
+        node = self.nodes.get(path)
+        self.nodes[path] = (node or b'') + bytes(data)
+
+    def read(self, path):
+        return self.nodes[path]
+
+
+class DirectoryTree:
+    """
+    Storage backend mapped onto a local directory, "/ext" is "<root>/ext"
+    """
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'ext'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'int'), exist_ok=True)
+
+    def local(self, path):
+        return os.path.join(self.root, *[part for part in path.split('/') if part])
+
+    def stat(self, path):
+        local = self.local(path)
+        if os.path.isdir(local):
+            return ('dir', 0)
+        elif os.path.isfile(local):
+            return ('file', os.path.getsize(local))
+        return None
+
+    def listdir(self, path):
+        names = []
+        with os.scandir(self.local(path)) as it:
+            for entry in it:
+                if entry.is_dir():
+                    names.append((entry.name, 'dir', 0))
+                else:
+                    names.append((entry.name, 'file', entry.stat().st_size))
+        return names
+
+    def mkdir(self, path):
+        os.mkdir(self.local(path))
+
+    def remove(self, path):
+        local = self.local(path)
+        if os.path.isdir(local):
+            os.rmdir(local)
+        else:
+            os.remove(local)
+
+    def append(self, path, data):
+        with open(self.local(path), 'ab') as file:
+            file.write(data)
+
+    def read(self, path):
+        with open(self.local(path), 'rb') as file:
+            return file.read()
+
+
+class EmulatedSerial(SerialBase):
+    """
+    In-process emulation of the Flipper storage CLI behind a pyserial-like port.
+
+    Time is modelled per direction: bytes written by the host reach the device
+    after link latency and line time, the device handles commands one by one
+    and its answers become readable only after their own latency and line time,
+    so pipelined traffic overlaps the same way it does on real hardware.
+    """
+    PROMPT = b'\r\n>: '
+
+    # tree: MemoryTree or DirectoryTree, empty MemoryTree by default
+    # command_latency: seconds the device spends on every command
+    # link_latency: one-way delay of the link, seconds
+    # byte_latency: line time of one byte, seconds, on top of baud rate throttling
+    # throttle: limit both directions to the configured baud rate
+    # md5_byte_latency: device hashing time per byte of file, seconds
+    # faults: {command: [n, ...]}, n-th call of command fails with "internal error"
+    # disconnect_after: drop the link once that many bytes were written to it
+    # stall_after: once that many bytes were written, lose everything in both directions until the port is reopened
+    def __init__(self, tree=None, command_latency=0.0, link_latency=0.0, byte_latency=0.0, throttle=False,
+                 md5_byte_latency=0.0, faults=None, disconnect_after=None, stall_after=None, *args, **kwargs):
+        self.tree = tree if tree is not None else MemoryTree()
+        self.command_latency = command_latency
+        self.link_latency = link_latency
+        self.byte_latency = byte_latency
+        self.throttle = throttle
+        self.md5_byte_latency = md5_byte_latency
+        self.faults = {name: set(calls) for name, calls in (faults or {}).items()}
+        self.disconnect_after = disconnect_after
+        self.stall_after = stall_after
+        self.stalled = False
+        self.calls = {}
+        self.written = 0
+        super().__init__(*args, **kwargs)
+
+    # pyserial interface
+
+    def open(self):
+        self.is_open = True
+        self.output = deque()
+        self.line = bytearray()
+        self.echo = bytearray()
+        self.state = None
+        self.host_free = 0.0
+        self.device_time = 0.0
+        self.device_free = 0.0
+        self.stalled = False
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self, *args, **kwargs):
+        pass
+
+    @property
+    def in_waiting(self):
+        self.check_link()
+        now = time.monotonic()
+        waiting = 0
+        for ready, data in self.output:
+            if ready > now:
+                break
+            waiting += len(data)
+        return waiting
+
+    def read(self, size=1):
+        self.check_link()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        data = bytearray()
+        while len(data) < size:
+            now = time.monotonic()
+            while self.output and self.output[0][0] <= now and len(data) < size:
+                ready, chunk = self.output[0]
+                take = size - len(data)
+                data.extend(chunk[:take])
+                if take < len(chunk):
+                    self.output[0] = (ready, chunk[take:])
+                else:
+                    self.output.popleft()
+            if len(data) >= size or not self.output:
+                break
+            wake = self.output[0][0]
+            if deadline is not None:
+                if now >= deadline:
+                    break
+                wake = min(wake, deadline)
+            time.sleep(max(0.0, wake - now))
+        return bytes(data)
+
+    def write(self, data):
+        self.check_link()
+        data = bytes(data)
+        size = len(data)
+        if self.stalled:
+            return size
+        if self.disconnect_after is not None and self.written + len(data) > self.disconnect_after:
+            data = data[:self.disconnect_after - self.written]
+            size = len(data)
+            self.disconnect()
+        stall = self.stall_after is not None and self.written + len(data) > self.stall_after
+        if stall:
+            data = data[:self.stall_after - self.written]
+            self.stall_after = None
+        self.written += len(data)
+        now = time.monotonic()
+        self.host_free = max(now, self.host_free) + len(data) * self.byte_time()
+        self.device_time = max(self.device_time, self.host_free + self.link_latency)
+        self.feed(data)
+        # what the device answers from now on is lost as well
+        self.stalled = stall
+        self.check_link()
+        return size
+
+    def reset_input_buffer(self):
+        self.output = deque()
+
+    # time.monotonic() when the next answer byte becomes readable, None if nothing is on the way
+    def next_ready(self):
+        return self.output[0][0] if self.output else None
+
+    def reset_output_buffer(self):
+        pass
+
+    # link model
+
+    def byte_time(self):
+        if self.throttle:
+            return self.byte_latency + 10.0 / self.baudrate
+        return self.byte_latency
+
+    def check_link(self):
+        if not self.is_open:
+            raise SerialException('device disconnected')
+
+    def disconnect(self):
+        self.disconnect_after = None
+        self.is_open = False
+
+    def emit(self, data):
+        self.flush_echo()
+        self.send(data)
+
+    def send(self, data):
+        if not data or self.stalled:
+            return
+        self.device_free = max(self.device_time, self.device_free) + len(data) * self.byte_time()
+        self.output.append((self.device_free + self.link_latency, bytes(data)))
+
+    def flush_echo(self):
+        if self.echo:
+            echo = bytes(self.echo)
+            self.echo = bytearray()
+            self.send(echo)
+
+    # CLI state machine
+
+    def feed(self, data):
+        i = 0
+        while i < len(data):
+            if self.state is None:
+                byte = data[i]
+                i += 1
+                if byte == 0x01:
+                    self.line = bytearray()
+                    self.emit(self.PROMPT)
+                elif byte == 0x03:
+                    self.line = bytearray()
+                    self.emit(self.PROMPT)
+                elif byte == 0x0D:
+                    line = bytes(self.line)
+                    self.line = bytearray()
+                    self.emit(b'\r\n')
+                    self.execute(line.decode('utf-8', 'replace'))
+                elif byte == 0x0A:
+                    continue
+                else:
+                    self.line.append(byte)
+                    self.echo.append(byte)
+            elif self.state[0] == 'payload':
+                _, path, need, received = self.state
+                take = min(need - len(received), len(data) - i)
+                received.extend(data[i:i + take])
+                i += take
+                if len(received) == need:
+                    self.state = None
+                    self.tree.append(path, received)
+                    self.emit(self.PROMPT)
+            elif self.state[0] == 'handshake':
+                i += 1
+                self.read_chunk()
+        self.flush_echo()
+
+    def execute(self, line):
+        self.device_time += self.command_latency
+        words = line.strip().split(' ', 2)
+        if not words[0]:
+            self.emit(self.PROMPT)
+            return
+        if words[0] != 'storage' or len(words) < 3:
+            self.emit(b'Command not found\r\n' if words[0] != 'storage' else b'Usage error\r\n')
+            self.emit(self.PROMPT)
+            return
+
+        command = words[1]
+        path, args = self.split_path(words[2])
+        self.calls[command] = self.calls.get(command, 0) + 1
+        handler = getattr(self, 'cmd_' + command, None)
+        if handler is None:
+            self.emit(b'Usage error\r\n')
+        elif self.calls[command] in self.faults.get(command, ()):
+            self.error('internal error')
+        else:
+            handler(path, args)
+        if self.state is None:
+            self.emit(self.PROMPT)
+
+    def split_path(self, text):
+        if text.startswith('"'):
+            end = text.find('"', 1)
+            if end < 0:
+                return text[1:], ''
+            return text[1:end], text[end + 1:].strip()
+        parts = text.split(' ', 1)
+        return parts[0], parts[1].strip() if len(parts) > 1 else ''
+
+    def normalize(self, path):
+        return '/' + '/'.join(part for part in path.split('/') if part)
+
+    def error(self, text):
+        self.emit(('Storage error: ' + text + '\r\n').encode())
+
+    def cmd_list(self, path, args):
+        path = self.normalize(path)
+        stat = self.tree.stat(path)
+        if stat is None or stat[0] != 'dir':
+            self.error('file/dir not exist' if stat is None else 'invalid parameter')
+            return
+        entries = self.tree.listdir(path)
+        if not entries:
+            self.emit(b'Empty\r\n')
+        for name, kind, size in entries:
+            if kind == 'dir':
+                self.emit(('\t[D] ' + name + '\r\n').encode())
+            else:
+                self.emit(('\t[F] ' + name + ' ' + str(size) + 'b\r\n').encode())
+
+    def cmd_stat(self, path, args):
+        path = self.normalize(path)
+        if path in ('/', '/ext', '/int'):
+            self.emit(b'Storage, 1000000KiB total, 500000KiB free\r\n')
+            return
+        stat = self.tree.stat(path)
+        if stat is None:
+            self.error('file/dir not exist')
+        elif stat[0] == 'dir':
+            self.emit(b'Directory\r\n')
+        else:
+            self.emit(('File, size: ' + str(stat[1]) + 'b\r\n').encode())
+
+    def cmd_mkdir(self, path, args):
+        path = self.normalize(path)
+        parent = path.rsplit('/', 1)[0] or '/'
+        if self.tree.stat(path) is not None:
+            self.error('file/dir already exist')
+        elif parent in ('/',) or self.tree.stat(parent) is None:
+            self.error('file/dir not exist')
+        else:
+            self.tree.mkdir(path)
+
+    def cmd_remove(self, path, args):
+        path = self.normalize(path)
+        stat = self.tree.stat(path)
+        if stat is None or path in ('/', '/ext', '/int'):
+            self.error('file/dir not exist' if stat is None else 'access denied')
+        elif stat[0] == 'dir' and self.tree.listdir(path):
+            self.error('access denied')
+        else:
+            self.tree.remove(path)
+
+    def cmd_md5(self, path, args):
+        path = self.normalize(path)
+        stat = self.tree.stat(path)
+        if stat is None or stat[0] != 'file':
+            self.error('file/dir not exist' if stat is None else 'invalid parameter')
+            return
+        self.device_time += stat[1] * self.md5_byte_latency
+        self.emit((hashlib.md5(self.tree.read(path)).hexdigest() + '\r\n').encode())
+
+    def cmd_write_chunk(self, path, args):
+        path = self.normalize(path)
+        stat = self.tree.stat(path)
+        parent = path.rsplit('/', 1)[0] or '/'
+        if not args.isdigit():
+            self.emit(b'Usage error\r\n')
+        elif (stat is not None and stat[0] != 'file') or self.tree.stat(parent) is None or parent == '/':
+            self.error('file/dir not exist' if stat is None else 'access denied')
+        else:
+            if stat is None:
+                self.tree.append(path, b'')
+            self.emit(b'Ready\r\n')
+            if int(args) > 0:
+                self.state = ('payload', path, int(args), bytearray())
+
+    def cmd_read_chunks(self, path, args):
+        path = self.normalize(path)
+        stat = self.tree.stat(path)
+        if not args.isdigit():
+            self.emit(b'Usage error\r\n')
+        elif stat is None or stat[0] != 'file':
+            self.error('file/dir not exist' if stat is None else 'access denied')
+        else:
+            data = self.tree.read(path)
+            self.emit(('Size: ' + str(len(data)) + '\r\n').encode())
+            self.state = ('handshake', data, int(args), 0)
+            self.next_chunk()
+
+    def next_chunk(self):
+        _, data, chunk_size, offset = self.state
+        if offset < len(data) and chunk_size > 0:
+            self.emit(b'\r\nReady?\r\n')
+        else:
+            self.state = None
+            self.emit(b'\r\n')
+
+    def read_chunk(self):
+        _, data, chunk_size, offset = self.state
+        self.emit(data[offset:offset + chunk_size])
+        self.state = ('handshake', data, chunk_size, offset + chunk_size)
+        self.next_chunk()
+        if self.state is None:
+            self.emit(self.PROMPT)
@@ -1,8 +1,16 @@
 import os
 import serial
 import time
+import bisect
+import fnmatch
+import logging
+import posixpath
 import hashlib
-import math
+import json
+import queue
+import tempfile
+import threading
+from collections import deque, OrderedDict
 
 def timing(func):
     """
@@ -12,46 +20,890 @@ def timing(func):
         time1 = time.monotonic()
         ret = func(*args, **kwargs)
         time2 = time.monotonic()
-        print('{:s} function took {:.3f} ms'.format(func.__name__, (time2 - time1) * 1000.0))
+        logging.getLogger(__name__).debug('{:s} function took {:.3f} ms'.format(func.__name__, (time2 - time1) * 1000.0))
         return ret
     return wrapper
 
+# Directory for manifests and journals, under the user cache directory
+def cache_dir():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'flipper-storage')
+
 class BufferedRead:
-    def __init__(self, stream):
+    """
+    Receive buffer over a serial stream.
+
+    Consumed data is skipped by offset and dropped in bulk, delimiter search
+    resumes where the previous scan stopped, so reading n bytes costs O(n).
+    """
+    COMPACT_SIZE = 4096
+
+    # on_data(count) is called for every block taken from the stream
+    def __init__(self, stream, on_data=None):
         self.buffer = bytearray()
+        self.start = 0
+        self.scanned = 0
         self.stream = stream
+        self.on_data = on_data
+        # seconds without any data before until() gives up, None waits forever
+        self.timeout = None
+
+    # Read whatever the stream has, blocking for the first byte up to the stream timeout
+    def fill(self):
+        data = self.stream.read(max(1, self.stream.in_waiting))
+        if data:
+            self.buffer.extend(data)
+            waiting = self.stream.in_waiting
+            if waiting:
+                more = self.stream.read(waiting)
+                self.buffer.extend(more)
+                data += more
+            if self.on_data:
+                self.on_data(len(data))
+        return len(data)
+
+    def consume(self, end):
+        self.start = end
+        self.scanned = max(self.scanned, end)
+        if self.start >= self.COMPACT_SIZE and self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+
+    def clear(self):
+        self.buffer = bytearray()
+        self.start = 0
+        self.scanned = 0
 
     def until(self, eol='\n', cut_eol=True):
         eol = eol.encode()
+        idle_since = time.monotonic()
         while True:
-            # search in buffer
-            i = self.buffer.find(eol)
+            # search in the part of buffer not scanned yet
+            i = self.buffer.find(eol, self.scanned)
             if i >= 0:
                 if cut_eol:
-                    read = self.buffer[:i]
+                    read = self.buffer[self.start:i]
                 else:
-                    read = self.buffer[:i + len(eol)]
-                self.buffer = self.buffer[i + len(eol):]
+                    read = self.buffer[self.start:i + len(eol)]
+                self.consume(i + len(eol))
                 return read
+            self.scanned = max(self.start, len(self.buffer) - len(eol) + 1)
 
             # read and append to buffer
-            i = max(1, self.stream.in_waiting)
-            data = self.stream.read(i)
-            self.buffer.extend(data)
+            if self.fill():
+                idle_since = time.monotonic()
+            elif self.timeout is not None and time.monotonic() - idle_since > self.timeout:
+                raise TimeoutError('no answer from device')
+
+    # Fill view with raw bytes, buffered ones first, returns count (less only on stream timeout)
+    def readinto(self, view):
+        count = min(len(view), len(self.buffer) - self.start)
+        view[:count] = self.buffer[self.start:self.start + count]
+        self.consume(self.start + count)
+        while count < len(view):
+            received = self.stream.readinto(view[count:])
+            if not received:
+                break
+            if self.on_data:
+                self.on_data(received)
+            count += received
+        return count
+
+
+class ChunkTuner:
+    """
+    Hill-climbing chunk size picker, driven by measured throughput
+    """
+    SAMPLE_CHUNKS = 4
+
+    def __init__(self, size, minimum, maximum):
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.best_size = size
+        self.best_rate = 0.0
+        self.settled = False
+        self.sample_bytes = 0
+        self.sample_time = 0.0
+        self.sample_chunks = 0
+
+    # Account one finished chunk, samples taken with another size are ignored
+    def update(self, size, nbytes, seconds):
+        if size != self.size:
+            return
+        self.sample_bytes += nbytes
+        self.sample_time += seconds
+        self.sample_chunks += 1
+        if self.sample_chunks < self.SAMPLE_CHUNKS or self.sample_time <= 0:
+            return
+
+        rate = self.sample_bytes / self.sample_time
+        self.sample_bytes = 0
+        self.sample_time = 0.0
+        self.sample_chunks = 0
+
+        if not self.settled:
+            if rate > self.best_rate:
+                # bigger chunks helped, keep growing
+                self.best_rate = rate
+                self.best_size = self.size
+                if self.size * 2 <= self.maximum:
+                    self.size = self.size * 2
+                else:
+                    self.settled = True
+            else:
+                # went too far, step back to the best one
+                self.size = self.best_size
+                self.settled = True
+        elif rate < self.best_rate / 2 and self.size // 2 >= self.minimum:
+            # link got worse, shrink and start climbing again from there
+            self.size = self.size // 2
+            self.best_size = self.size
+            self.best_rate = 0.0
+            self.settled = False
+
+
+class EventSink:
+    """
+    Instrumentation interface of FlipperStorage, does nothing by itself
+    """
+    # storage command was sent
+    def command_started(self, command, path):
+        pass
+
+    # storage command finished, ok is False when the device reported an error
+    def command_done(self, command, path, seconds, ok):
+        pass
+
+    def bytes_sent(self, count):
+        pass
+
+    def bytes_received(self, count):
+        pass
+
+    # done of total bytes of path are transferred
+    def progress(self, path, done, total):
+        pass
+
+    def retry(self, command, path, reason):
+        pass
+
+    def error(self, command, path, message):
+        pass
+
+
+class LogSink(EventSink):
+    """
+    Writes commands, retries and errors to a logger
+    """
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+
+    def command_done(self, command, path, seconds, ok):
+        self.logger.debug('{:s} "{:s}" took {:.3f} ms{:s}'.format(command, path, seconds * 1000.0, '' if ok else ', failed'))
+
+    def retry(self, command, path, reason):
+        self.logger.debug('{:s} "{:s}" retried: {:s}'.format(command, path, reason))
+
+    def error(self, command, path, message):
+        self.logger.debug('{:s} "{:s}" error: {:s}'.format(command, path, message))
+
+
+class MetricsSink(EventSink):
+    """
+    Counters and per-command latency histograms
+    """
+    # upper bounds of latency buckets, ms, the last bucket takes everything above
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.counters = {'commands': 0, 'errors': 0, 'retries': 0, 'bytes_sent': 0, 'bytes_received': 0}
+        self.latency = {}
+
+    def command_done(self, command, path, seconds, ok):
+        self.counters['commands'] += 1
+        ms = seconds * 1000.0
+        if command not in self.latency:
+            self.latency[command] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)}
+        histogram = self.latency[command]
+        histogram['count'] += 1
+        histogram['total_ms'] += ms
+        histogram['max_ms'] = max(histogram['max_ms'], ms)
+        histogram['buckets'][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+    def bytes_sent(self, count):
+        self.counters['bytes_sent'] += count
+
+    def bytes_received(self, count):
+        self.counters['bytes_received'] += count
+
+    def retry(self, command, path, reason):
+        self.counters['retries'] += 1
+
+    def error(self, command, path, message):
+        self.counters['errors'] += 1
+
+
+class MultiSink(EventSink):
+    """
+    Passes every event to several sinks
+    """
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def command_started(self, command, path):
+        for sink in self.sinks:
+            sink.command_started(command, path)
+
+    def command_done(self, command, path, seconds, ok):
+        for sink in self.sinks:
+            sink.command_done(command, path, seconds, ok)
+
+    def bytes_sent(self, count):
+        for sink in self.sinks:
+            sink.bytes_sent(count)
+
+    def bytes_received(self, count):
+        for sink in self.sinks:
+            sink.bytes_received(count)
+
+    def progress(self, path, done, total):
+        for sink in self.sinks:
+            sink.progress(path, done, total)
+
+    def retry(self, command, path, reason):
+        for sink in self.sinks:
+            sink.retry(command, path, reason)
+
+    def error(self, command, path, message):
+        for sink in self.sinks:
+            sink.error(command, path, message)
+
+
+class StorageEntry:
+    """
+    File or directory on Flipper, as reported by storage list or stat
+    """
+    # depth is set by traverse, levels below the directory it started from
+    def __init__(self, name, path, is_dir, size=0, depth=0):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.depth = depth
+
+    def __repr__(self):
+        return 'StorageEntry({!r}, {:s}, {:d})'.format(self.path, 'dir' if self.is_dir else 'file', self.size)
+
+
+class StorageError(Exception):
+    """
+    Error reported by Flipper, or met while talking to it
+    """
+    # offset is where a transfer stopped, None if it was not a transfer error
+    def __init__(self, message, command=None, path=None, offset=None):
+        super().__init__(message)
+        self.message = message
+        self.command = command
+        self.path = path
+        self.offset = offset
+
+    def __str__(self):
+        if self.offset is None:
+            return self.message
+        return self.message + ' at offset ' + str(self.offset)
+
+    # StorageError of the text of a "Storage error" line, subclassed for errors callers check for
+    @staticmethod
+    def from_message(message):
+        for cls in (NotExistError, ExistError):
+            if message == cls.MESSAGE:
+                return cls(message)
+        return StorageError(message)
+
+
+class NotExistError(StorageError):
+    MESSAGE = 'file/dir not exist'
+
+
+class ExistError(StorageError):
+    MESSAGE = 'file/dir already exist'
+
+
+class ProtocolError(StorageError):
+    """
+    Answer that is not what the command should answer
+    """
+
+
+class Answer:
+    """
+    Parsers of storage CLI answers, on bytes as they come from the port.
+
+    Names are decoded as UTF-8, bytes that are not are kept as surrogates and
+    encode() turns them back, so every name can be used in a command again.
+    Error lines raise StorageError.
+    """
+    ERROR = b'Storage error'
+
+    @staticmethod
+    def encode(text):
+        return text.encode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def decode(data):
+        return bytes(data).decode('utf-8', 'surrogateescape')
+
+    # StorageError of an error line, None for any other line
+    @classmethod
+    def error(cls, line):
+        line = line.strip()
+        if not line.startswith(cls.ERROR):
+            return None
+        message = line[len(cls.ERROR):].lstrip(b':').strip()
+        return StorageError.from_message(cls.decode(message) or 'unknown error')
+
+    # line, StorageError raised if it is an error line
+    @classmethod
+    def check(cls, line):
+        error = cls.error(line)
+        if error:
+            raise error
+        return line
+
+    # StorageError of the first error line of a multi line answer, None if there is none
+    @classmethod
+    def find_error(cls, data):
+        if data.find(cls.ERROR) == -1:
+            return None
+        for line in cls.lines(data):
+            error = cls.error(line)
+            if error:
+                return error
+        return None
+
+    # Lines of data, one at a time without splitting all of it
+    @staticmethod
+    def lines(data):
+        start = 0
+        while start < len(data):
+            end = data.find(b'\r\n', start)
+            if end == -1:
+                end = len(data)
+            yield data[start:end]
+            start = end + 2
+
+    # Size in bytes from text like b"123b"
+    @staticmethod
+    def size(text):
+        digits = bytes(ch for ch in text if 0x30 <= ch <= 0x39)
+        return int(digits or 0)
+
+    # Yields StorageEntry of every entry line of a list answer for directory path
+    @classmethod
+    def entries(cls, path, data):
+        prefix = path.rstrip('/') + '/'
+        for line in cls.lines(data):
+            line = cls.check(line).strip()
+            if line.startswith(b'[D] '):
+                name = cls.decode(line[4:])
+                yield StorageEntry(name, prefix + name, True)
+            elif line.startswith(b'[F] '):
+                name, _, size = line[4:].rpartition(b' ')
+                name = cls.decode(name)
+                yield StorageEntry(name, prefix + name, False, cls.size(size))
+            # "Empty" and anything unknown are not entries
+
+    # StorageEntry of path from the answer line of stat
+    @classmethod
+    def stat(cls, path, line):
+        line = cls.check(line).strip()
+        name = path.rstrip('/').rsplit('/', 1)[-1]
+        if line.startswith(b'File, size:'):
+            return StorageEntry(name, path, False, cls.size(line[len(b'File, size:'):]))
+        if line.startswith(b'Directory') or line.startswith(b'Storage'):
+            return StorageEntry(name, path, True)
+        raise ProtocolError('unexpected stat answer: ' + cls.decode(line))
+
+    # File size from the first answer line of read_chunks
+    @classmethod
+    def read_size(cls, line):
+        line = cls.check(line).strip()
+        if not line.startswith(b'Size: ') or not line[6:].isdigit():
+            raise ProtocolError('unexpected read_chunks answer: ' + cls.decode(line))
+        return int(line[6:])
+
+    # Hex digest from the answer line of md5
+    @classmethod
+    def md5(cls, line):
+        line = cls.check(line).strip()
+        if len(line) != 32 or any(ch not in b'0123456789abcdefABCDEF' for ch in line):
+            raise ProtocolError('unexpected md5 answer: ' + cls.decode(line))
+        return line.decode('ascii').lower()
+
+
+class SyncManifest:
+    """
+    Persistent record of files a sync has confirmed equal on both sides.
+
+    A file whose local size and mtime and remote size are the ones recorded
+    can be skipped without hashing it on either side.
+    """
+    VERSION = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        try:
+            with open(filename) as file:
+                data = json.load(file)
+            if data.get('version') == self.VERSION:
+                self.files = data['files']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # Manifest file for a sync of port to flipper_path
+    @staticmethod
+    def path_for(port, flipper_path):
+        key = hashlib.sha1((port + '\0' + flipper_path).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir(), key + '.json')
+
+    # Record of flipper_path if local_path is still the same file
+    def record(self, flipper_path, local_path, stat):
+        record = self.files.get(flipper_path)
+        if record is None:
+            return None
+        if record['local_path'] != os.path.abspath(local_path):
+            return None
+        if record['size'] != stat.st_size or record['mtime'] != stat.st_mtime_ns:
+            return None
+        return record
+
+    # Is file unchanged on both sides since it was confirmed
+    def unchanged(self, flipper_path, local_path, stat, remote_size):
+        record = self.record(flipper_path, local_path, stat)
+        return record is not None and record['remote_size'] == remote_size and record['remote_hash'] == record['local_hash']
+
+    # Local hash remembered for unchanged local file, None otherwise
+    def local_hash(self, flipper_path, local_path, stat):
+        record = self.record(flipper_path, local_path, stat)
+        return record['local_hash'] if record else None
+
+    def confirm(self, flipper_path, local_path, stat, local_hash, remote_size, remote_hash):
+        self.files[flipper_path] = {
+            'local_path': os.path.abspath(local_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'local_hash': local_hash,
+            'remote_size': remote_size,
+            'remote_hash': remote_hash,
+        }
+
+    def forget(self, flipper_path):
+        self.files.pop(flipper_path, None)
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.part', delete=False) as file:
+            json.dump({'version': self.VERSION, 'files': self.files}, file)
+        os.replace(file.name, self.filename)
+
+
+class HashCache:
+    """
+    MD5 of local files by path, size and mtime, shared between threads
+    """
+    def __init__(self):
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(filename, stat):
+        return (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+
+    # Cached hash of filename, compute(filename) runs once per file version
+    def get(self, filename, compute):
+        key = self.key(filename, os.stat(filename))
+        with self.lock:
+            entry = self.hashes.get(key)
+            if entry is None:
+                entry = self.hashes[key] = [threading.Lock(), None]
+        # other threads asking for the same file wait here instead of hashing it again
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = compute(filename)
+            return entry[1]
+
+    # Remember hash of filename computed elsewhere, stat as taken before reading it
+    def put(self, filename, stat, digest):
+        key = self.key(filename, stat)
+        with self.lock:
+            self.hashes.setdefault(key, [threading.Lock(), None])[1] = digest
+
+
+class MetadataCache:
+    """
+    Entries on Flipper seen in list and stat answers or changed by this client.
+
+    A path maps to its StorageEntry, or to None if it is known not to exist.
+    Paths missing from a cached directory listing are known not to exist too.
+    Up to size paths are kept, least recently used are dropped first.
+    """
+    def __init__(self, size=4096):
+        self.size = size
+        self.entries = OrderedDict()
+        # directory: cached paths directly inside it
+        self.children = {}
+        # directories with all their entries cached
+        self.complete = set()
+
+    @staticmethod
+    def key(path):
+        return path.replace('//', '/').rstrip('/') or '/'
+
+    # (True, entry or None) if path is known, (False, None) otherwise
+    def lookup(self, path):
+        path = self.key(path)
+        if path in self.entries:
+            self.entries.move_to_end(path)
+            return True, self.entries[path]
+        if path != '/' and posixpath.dirname(path) in self.complete:
+            return True, None
+        return False, None
+
+    # Remember entry of path, None if it does not exist
+    def put(self, path, entry):
+        if self.size <= 0:
+            return
+        path = self.key(path)
+        self.entries[path] = entry
+        self.entries.move_to_end(path)
+        if path != '/':
+            self.children.setdefault(posixpath.dirname(path), set()).add(path)
+        while len(self.entries) > self.size:
+            evicted, _ = self.entries.popitem(last=False)
+            parent = posixpath.dirname(evicted)
+            self.children.get(parent, set()).discard(evicted)
+            # listing is incomplete without one of its entries
+            self.complete.discard(parent)
+
+    # Remember full listing of directory path
+    def listed(self, path, entries):
+        path = self.key(path)
+        paths = set(self.key(entry.path) for entry in entries)
+        for gone in self.children.get(path, set()) - paths:
+            self.drop(gone)
+        for entry in entries:
+            self.put(entry.path, entry)
+        if self.size > len(entries):
+            self.complete.add(path)
+        # only a directory can be listed
+        if self.lookup(path)[1] is None:
+            self.put(path, StorageEntry(posixpath.basename(path), path, True))
+
+    # This client removed path
+    def removed(self, path):
+        self.drop(self.key(path))
+        self.put(path, None)
+
+    # Forget path and everything below it, None forgets everything
+    def invalidate(self, path=None):
+        if path is None:
+            self.entries.clear()
+            self.children.clear()
+            self.complete.clear()
+            return
+        path = self.key(path)
+        self.drop(path)
+        self.complete.discard(posixpath.dirname(path))
+
+    # Remove path and everything cached below it
+    def drop(self, path):
+        self.children.get(posixpath.dirname(path), set()).discard(path)
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            self.entries.pop(path, None)
+            self.complete.discard(path)
+            stack.extend(self.children.pop(path, ()))
+
+
+class TransferJournal:
+    """
+    Uploads in progress, so that a later run can resume an interrupted one
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.files = {}
+        try:
+            with open(filename) as file:
+                self.files = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    # Journal file of uploads to port
+    @staticmethod
+    def path_for(port):
+        key = hashlib.sha1(port.encode()).hexdigest()[:16]
+        return os.path.join(cache_dir(), 'journal-' + key + '.json')
+
+    def identity(self, local_path, stat):
+        return {'local_path': os.path.abspath(local_path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    # Was upload of the same local file to remote_path interrupted
+    def pending(self, remote_path, local_path, stat):
+        return self.files.get(remote_path) == self.identity(local_path, stat)
+
+    def begin(self, remote_path, local_path, stat):
+        self.files[remote_path] = self.identity(local_path, stat)
+        self.save()
+
+    def end(self, remote_path):
+        if self.files.pop(remote_path, None) is not None:
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.part', delete=False) as file:
+            json.dump(self.files, file)
+        os.replace(file.name, self.filename)
+
+
+class TransferPlan:
+    """
+    Transfers of a sync job in the order they will run, with the time they should take.
+
+    Time of a file is predicted as file_time plus its size at rate. While the job
+    runs, predictions are scaled by how long the files done so far actually took,
+    and save() keeps the corrected rate and file_time for the next job on the port.
+    """
+    POLICIES = ('walk', 'small-first', 'large-first')
+    # used until a job on the port has measured them, bytes per second and seconds per file
+    RATE = 30000.0
+    FILE_TIME = 0.05
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.rate = self.RATE
+        self.file_time = self.FILE_TIME
+        # (path, size, item) in walk order
+        self.items = []
+        # predicted and actual seconds of the files done
+        self.predicted = 0.0
+        self.actual = 0.0
+        if filename:
+            try:
+                with open(filename) as file:
+                    data = json.load(file)
+                self.rate = float(data['rate'])
+                self.file_time = float(data['file_time'])
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+
+    # Measured rates of transfers to port
+    @staticmethod
+    def path_for(port):
+        key = hashlib.sha1(port.encode()).hexdigest()[:16]
+        return os.path.join(cache_dir(), 'rate-' + key + '.json')
+
+    def add(self, path, size, item):
+        self.items.append((path, size, item))
+
+    # Items ordered by policy, paths matching a priority glob pattern go first, in the order of the patterns
+    def ordered(self, policy='walk', priority=()):
+        if policy not in self.POLICIES:
+            raise ValueError('policy must be one of ' + ', '.join(self.POLICIES))
+
+        def rank(entry):
+            path, size, item = entry
+            for index, pattern in enumerate(priority):
+                if fnmatch.fnmatchcase(path, pattern) or fnmatch.fnmatchcase(posixpath.basename(path), pattern):
+                    return index
+            return len(priority)
+
+        items = sorted(self.items, key=rank)
+        if policy == 'small-first':
+            items.sort(key=lambda entry: (rank(entry), entry[1]))
+        elif policy == 'large-first':
+            items.sort(key=lambda entry: (rank(entry), -entry[1]))
+        return items
+
+    def size(self):
+        return sum(size for path, size, item in self.items)
+
+    # Seconds files of size bytes in total should take, scaled by what was measured so far
+    def estimate(self, size, files=1):
+        seconds = files * self.file_time + size / self.rate
+        if self.predicted > 0:
+            seconds *= self.actual / self.predicted
+        return seconds
+
+    # files of size bytes in total took seconds
+    def done(self, size, seconds, files=1):
+        self.predicted += files * self.file_time + size / self.rate
+        self.actual += seconds
+
+    def save(self):
+        if not self.filename or self.predicted <= 0:
+            return
+        factor = self.actual / self.predicted
+        data = {'rate': self.rate / factor, 'file_time': self.file_time * factor}
+        directory = os.path.dirname(self.filename)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.part', delete=False) as file:
+            json.dump(data, file)
+        os.replace(file.name, self.filename)
+
+
+class PendingWrites:
+    """
+    write_chunk commands sent and not answered yet, oldest first.
+
+    Shared by the blocking and the asyncio client, which do the I/O: this decides which
+    chunk waits for "Ready" before its payload goes out, and what an answer means.
+    A chunk is pipelined if its payload went out right behind its command. A held chunk
+    had its command sent behind the chunks in flight, its payload waits for their answers and "Ready".
+    """
+    # first is the offset the upload starts at
+    def __init__(self, window, first=0):
+        self.window = window
+        self.first = first
+        self.chunks = deque()
+        # (offset, payload, start) of the held chunk
+        self.held = None
+
+    def __len__(self):
+        return len(self.chunks)
+
+    # Is there no room in the window for another chunk
+    def full(self):
+        return len(self.chunks) >= self.window
+
+    # Does the chunk at offset wait for "Ready" before its payload, nothing may be in flight when that is read
+    # The first chunk always does, so a file that cannot be opened never puts payload into the CLI
+    def acknowledged(self, offset):
+        return self.window == 1 or offset == self.first
+
+    def sent(self, offset, size, pipelined, start):
+        self.chunks.append((offset, size, pipelined, start))
+
+    def hold(self, offset, filedata, start):
+        self.held = (offset, filedata, start)
+
+    # Take the held chunk, (offset, payload, start)
+    def release(self):
+        held, self.held = self.held, None
+        return held
+
+    # (offset, size) of the oldest chunk
+    def oldest(self):
+        return self.chunks[0][:2]
+
+    # Take the answer of the oldest chunk, data up to the prompt, returns (offset, size, start, error, resync)
+    # Nothing is in flight after an error, resync tells if the CLI has to be brought back to a clean prompt
+    def answered(self, data):
+        offset, size, pipelined, start = self.chunks.popleft()
+        error = Answer.find_error(data)
+        resync = False
+        if error:
+            # payload was not consumed by write_chunk if the device did not answer "Ready",
+            # so it went to the CLI as text, drop everything and start from a clean prompt
+            resync = bool(self.chunks) or self.held is not None or (pipelined and b'Ready' not in data[:data.find(Answer.ERROR)])
+            self.chunks.clear()
+        return offset, size, start, error, resync
+
+
+class BackgroundWriter:
+    """
+    Writes to a file from a thread, so that reading the serial link does not wait for the disk
+    """
+    QUEUE_SIZE = 64
+
+    # hash_md5 is updated with everything written
+    def __init__(self, file, hash_md5=None):
+        self.file = file
+        self.hash_md5 = hash_md5
+        self.error = None
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queue a copy of data, raises the error of an earlier write
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.queue.put(bytes(data))
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is None:
+                try:
+                    self.file.write(data)
+                    if self.hash_md5:
+                        self.hash_md5.update(data)
+                except OSError as error:
+                    self.error = error
+
+    # Wait for queued writes, raises their error
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
 
 
 class FlipperStorage:
     CLI_PROMPT = '>: '
+    ERROR_NOT_EXIST = NotExistError.MESSAGE
     CLI_SOH = '\x01'
     CLI_EOL = '\r\n'
+    CLI_ETX = '\x03'
+    CHUNK_SIZE = 512
+    CHUNK_SIZE_MIN = 64
+    CHUNK_SIZE_MAX = 8192
 
-    def __init__(self, portname: str):
-        self.port = serial.Serial()
+    # chunk tuners per (port, direction), shared by all instances in this process
+    tuners = {}
+
+    # port: serial-like object to talk through instead of a new serial.Serial, e.g. EmulatedSerial, its baud rate is kept
+    def __init__(self, portname: str, port=None):
+        if port is None:
+            port = serial.Serial()
+            port.baudrate = 115200
+        self.port = port
         self.port.port = portname
         self.port.timeout = 2
-        self.port.baudrate = 115200
-        self.read = BufferedRead(self.port)
+        self.read = BufferedRead(self.port, self.received)
+        # a device silent for that long is taken for a broken link, transfers are retried then
+        self.read.timeout = 5 * self.port.timeout
+        # StorageError of the last failed call, last_error is its text
+        self.last_exception = None
         self.last_error = ''
+        # offset of the transfer error in last_error, None if it was not a transfer error
+        self.last_error_offset = None
+        self.events = EventSink()
+        # failed transfers are retried with delays of retry_delay, doubled every time
+        self.retries = 3
+        self.retry_delay = 0.5
+        # TransferJournal to resume uploads interrupted in earlier runs
+        self.journal = None
+        # HashCache for hash_local, filled by uploads too, may be shared with other instances
+        self.hash_cache = HashCache()
+        self.send_window = 1
+        self.chunk_size = self.CHUNK_SIZE
+        self.adaptive = False
+        # list command sent ahead as (path, start time), its answer not read yet
+        self.list_pending = None
+        # answer of a list command sent ahead, as (path, data)
+        self.prefetched = None
+        # what is known about paths on Flipper, MetadataCache(0) disables it
+        self.cache = MetadataCache()
 
     def start(self):
         self.port.open()
@@ -60,8 +912,26 @@ class FlipperStorage:
     def stop(self):
         self.port.close()
 
+    # Reopen port and start over with a clean CLI session
+    def reconnect(self):
+        self.port.close()
+        self.read.clear()
+        self.list_pending = None
+        self.prefetched = None
+        self.start()
+
+    def write(self, data):
+        # answer of a list sent ahead comes first, take it out of the way
+        if self.list_pending is not None:
+            self.prefetched = self.list_answer()
+        self.port.write(data)
+        self.events.bytes_sent(len(data))
+
+    def received(self, count):
+        self.events.bytes_received(count)
+
     def send(self, line):
-        self.port.write(line.encode())
+        self.write(Answer.encode(line))
 
     def send_and_wait_eol(self, line):
         self.send(line)
@@ -71,281 +941,758 @@ class FlipperStorage:
         self.send(line)
         return self.read.until(self.CLI_PROMPT)
 
-    # Is data has error
-    def has_error(self, data):
-        if data.find(b'Storage error') != -1:
-            return True
-        else:
+    # Remember error as last_exception and last_error and report it, offset is where a transfer stopped
+    # error is a StorageError or a message for one
+    def set_error(self, command, path, error, offset=None):
+        if not isinstance(error, StorageError):
+            error = StorageError(error)
+        error.command = command
+        error.path = path
+        error.offset = offset
+        self.last_exception = error
+        self.last_error = str(error)
+        self.last_error_offset = offset
+        self.events.error(command, path, self.last_error)
+
+    # Wait before retry number attempt of a failed transfer and reconnect, False if there is no retry left
+    # Broken link and errors after the first chunk are retried, errors of the first chunk are final
+    def retry(self, command, path, attempt, link_failed):
+        if attempt >= self.retries:
             return False
+        if not link_failed and not self.last_error_offset:
+            return False
+        self.events.retry(command, path, self.last_error)
+        time.sleep(self.retry_delay * 2 ** attempt)
+        try:
+            self.reconnect()
+        except OSError as error:
+            self.set_error(command, path, str(error) or type(error).__name__, self.last_error_offset)
+        return True
 
-    # Extract error text from data and print it
-    def get_error(self, data):
-        return data.decode('ascii').split(': ')[1].strip()
+    # Run storage command with one line answer, returns the answer or None on error
+    # parse(answer) turns it into the result, a StorageError it raises is an error too
+    def command(self, command, path, parse=Answer.check):
+        self.events.command_started(command, path)
+        start = time.monotonic()
+        self.send_and_wait_eol('storage ' + command + ' "' + path + '"\r')
+        answer = self.read.until(self.CLI_EOL)
+        self.read.until(self.CLI_PROMPT)
+        try:
+            result = parse(answer)
+        except StorageError as error:
+            result = error
+        ok = not isinstance(result, StorageError)
+        self.events.command_done(command, path, time.monotonic() - start, ok)
 
-    # List files and dirs on Flipper
-    def list_tree(self, path="/", level=0):
-        path = path.replace('//', '/')
+        if command in ('mkdir', 'remove'):
+            self.changed(path)
+        if not ok:
+            self.set_error(command, path, result)
+            return None
+        return result
 
-        self.send_and_wait_eol('storage list "' + path + '"\r')
+    # Forget what was read ahead about path and its directory, this client changed them
+    def changed(self, path):
+        if self.prefetched is not None:
+            listed = self.prefetched[0]
+            if listed == posixpath.dirname(path) or listed == path or listed.startswith(path + '/'):
+                self.prefetched = None
 
-        data = self.read.until(self.CLI_PROMPT)
-        data = data.split(b'\r\n')
+    # List directory on Flipper, returns the answer or None on error
+    def list_data(self, path):
+        if self.list_pending is not None:
+            self.prefetched = self.list_answer()
+        if self.prefetched is not None and self.prefetched[0] == path:
+            data = self.prefetched[1]
+        else:
+            self.list_request(path)
+            data = self.list_answer()[1]
+        self.prefetched = None
 
-        for line in data:
-            try:
-                # TODO: better decoding, considering non-ascii characters
-                line = line.decode("ascii")
-            except:
-                continue
+        error = Answer.find_error(data)
+        if error:
+            self.set_error('list', path, error)
+            return None
+        return data
 
-            line = line.strip()
+    # Send list command without waiting for the answer
+    def list_request(self, path):
+        self.events.command_started('list', path)
+        self.send('storage list "' + path + '"\r')
+        self.list_pending = (path, time.monotonic())
 
-            if len(line) == 0:
-                continue
+    # Read answer of the list command sent by list_request, returns (path, data)
+    def list_answer(self):
+        path, start = self.list_pending
+        self.list_pending = None
+        self.read.until(self.CLI_EOL)
+        data = self.read.until(self.CLI_PROMPT)
+        self.events.command_done('list', path, time.monotonic() - start, Answer.find_error(data) is None)
+        return path, data
 
-            if self.has_error(line.encode()):
-                print(self.get_error(line.encode()))
-                continue
+    # Have the device list path while the caller is busy, list_data picks the answer up
+    def list_ahead(self, path):
+        if self.list_pending is None and self.prefetched is None:
+            self.list_request(path.replace('//', '/'))
 
-            if line == 'Empty':
-                continue
+    # Entries of one directory on Flipper, None on error
+    def scandir(self, path):
+        path = path.replace('//', '/')
+        data = self.list_data(path)
+        if data is None:
+            return None
+        entries = list(Answer.entries(path, data))
+        self.cache.listed(path, entries)
+        return entries
 
-            line = line.split(" ", 1)
-            if line[0] == '[D]':
-                # Print directory name
-                print((path + '/' + line[1]).replace('//', '/'))
-                # And recursively go inside
-                self.list_tree(path + '/' + line[1], level + 1)
-            elif line[0] == '[F]':
-                line = line[1].rsplit(" ", 1)
-                # Print file name and size
-                print((path + '/' + line[0]).replace('//', '/') + ', size ' + line[1])
-            else:
-                # Somthing wrong
-                pass
+    # Entry of file or dir on Flipper, None if it does not exist
+    # Served from self.cache when possible
+    def stat(self, path):
+        known, entry = self.cache.lookup(path)
+        if known:
+            if entry is None:
+                self.set_error('stat', path, NotExistError(NotExistError.MESSAGE))
+            return entry
+        entry = self.command('stat', path, lambda answer: Answer.stat(path, answer))
+        if entry is None:
+            if isinstance(self.last_exception, NotExistError):
+                self.cache.put(path, None)
+            return None
+        self.cache.put(path, entry)
+        return entry
 
-    def walk(self, path="/"):
-        dirs = []
-        nondirs = []
-        walk_dirs = []
+    # List files and dirs on Flipper, yields one text line per entry, arguments as for traverse
+    def list_tree(self, path="/", order='dfs', max_depth=None, pattern=None):
+        for entry in self.traverse(path, order, max_depth, pattern):
+            if entry.is_dir:
+                # Directory name
+                yield entry.path
+            else:
+                # File name and size
+                yield entry.path + ', size ' + str(entry.size) + 'b'
 
+    # Yields StorageEntry of everything below path, with depth set
+    # order 'dfs' puts the contents of a directory right after it, 'bfs' goes level by level
+    # max_depth limits the levels entered, 0 lists path only
+    # pattern filters yielded entries by name, directories are entered anyway
+    # prefetch has the device list the next directory while the caller handles the current entry
+    def traverse(self, path="/", order='dfs', max_depth=None, pattern=None, prefetch=True):
+        if order not in ('dfs', 'bfs'):
+            raise ValueError('order must be "dfs" or "bfs"')
         path = path.replace('//', '/')
-        self.send_and_wait_eol('storage list "' + path + '"\r')
-        data = self.read.until(self.CLI_PROMPT)
-        data = data.split(b'\r\n')
-
-        for line in data:
-            try:
-                # TODO: better decoding, considering non-ascii characters
-                line = line.decode("ascii")
-            except:
+        # dfs: stack of listings being iterated, bfs: queue of directories to list
+        listings = [(iter(self.scandir(path) or []), 0)]
+        queue = deque()
+        while listings:
+            entries, depth = listings[-1]
+            entry = next(entries, None)
+            if entry is None:
+                listings.pop()
+                if queue:
+                    path, depth = queue.popleft()
+                    listings.append((iter(self.scandir(path) or []), depth))
                 continue
 
-            line = line.strip()
+            entry.depth = depth
+            enter = entry.is_dir and (max_depth is None or depth < max_depth)
+            if enter and order == 'bfs':
+                queue.append((entry.path, depth + 1))
+            if prefetch and enter and order == 'dfs':
+                self.list_ahead(entry.path)
+            elif prefetch and queue:
+                self.list_ahead(queue[0][0])
 
-            if len(line) == 0:
-                continue
+            if pattern is None or fnmatch.fnmatchcase(entry.name, pattern):
+                yield entry
+            if enter and order == 'dfs':
+                listings.append((iter(self.scandir(entry.path) or []), depth + 1))
 
-            if self.has_error(line.encode()):
-                print(self.get_error(line.encode()))
-                continue
+    # Like os.walk, yields (path, dir names, file names); entries=True yields StorageEntry lists instead of names
+    # Directories the caller removes from the yielded list are not entered, max_depth and prefetch as for traverse
+    def walk(self, path="/", entries=False, max_depth=None, prefetch=True):
+        stack = [(path.replace('//', '/'), 0)]
+        while stack:
+            path, depth = stack.pop()
+            listing = self.scandir(path) or []
+            dirs = [entry for entry in listing if entry.is_dir]
+            nondirs = [entry for entry in listing if not entry.is_dir]
+            enter = max_depth is None or depth < max_depth
 
-            if line == 'Empty':
-                continue
+            if prefetch and enter and dirs:
+                self.list_ahead(dirs[0].path)
+            elif prefetch and stack:
+                self.list_ahead(stack[-1][0])
 
-            line = line.split(" ", 1)
-            if line[0] == '[D]':
-                # Print directory name
-                dirs.append(line[1])
-                walk_dirs.append((path + '/' + line[1]).replace('//', '/'))
-                # print((path + '/' + line[1]).replace('//', '/'))
-
-            elif line[0] == '[F]':
-                line = line[1].rsplit(" ", 1)
-                # Print file name and size
-                nondirs.append(line[0])
-                # print((path + '/' + line[0]).replace('//', '/') + ', size ' + line[1])
+            if entries:
+                yield path, dirs, nondirs
             else:
-                # Somthing wrong
-                pass
-        
-        yield path, dirs, nondirs
-        for new_path in walk_dirs:
-            yield from self.walk(new_path)
+                dirnames = [entry.name for entry in dirs]
+                yield path, dirnames, [entry.name for entry in nondirs]
+                dirs = [entry for entry in dirs if entry.name in dirnames]
+            if enter:
+                stack.extend((entry.path, depth + 1) for entry in reversed(dirs))
+
+    # Chunk size limited to what write_chunk and read_chunks take
+    @classmethod
+    def chunk_limit(cls, chunk_size):
+        return min(max(chunk_size, cls.CHUNK_SIZE_MIN), cls.CHUNK_SIZE_MAX)
+
+    # Chunk tuner of this port for "write" or "read" direction
+    def tuner(self, direction):
+        key = (self.port.port, direction)
+        if key not in self.tuners:
+            self.tuners[key] = ChunkTuner(self.chunk_limit(self.chunk_size), self.CHUNK_SIZE_MIN, self.CHUNK_SIZE_MAX)
+        return self.tuners[key]
 
     # Send file from local device to Flipper
-    def send_file(self, filename_from, filename_to):
-        self.remove(filename_to)
-        
-        file = open(filename_from, 'rb')
-        filesize = os.fstat(file.fileno()).st_size
+    # window > 1 keeps that many write_chunk commands in flight, answers are checked as they come back
+    # chunk_size overrides self.chunk_size, with self.adaptive it is tuned while sending
+    # resume continues after the part already on Flipper if it matches the local file,
+    # an upload interrupted in an earlier run is resumed if it is in self.journal
+    def send_file(self, filename_from, filename_to, window=None, chunk_size=None, resume=False):
+        if window is None:
+            window = self.send_window
+        window = max(1, window)
+        tuner = self.tuner('write') if self.adaptive and chunk_size is None else None
+        chunk_size = self.chunk_limit(chunk_size or self.chunk_size)
+
+        with open(filename_from, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            if self.journal:
+                if self.journal.pending(filename_to, filename_from, stat):
+                    resume = True
+                self.journal.begin(filename_to, filename_from, stat)
+
+            attempt = 0
+            while True:
+                link_failed = False
+                try:
+                    offset, hash_md5 = self.resume_offset(file, filename_to, stat.st_size) if resume else (0, hashlib.md5())
+                    # nothing to remove if the file is known not to exist
+                    if offset == 0 and self.cache.lookup(filename_to) != (True, None):
+                        self.remove(filename_to)
+                    done = self.write_chunks(file, filename_to, stat.st_size, offset, window, chunk_size, tuner, hash_md5)
+                except OSError as error:
+                    self.set_error('write_chunk', filename_to, str(error) or type(error).__name__)
+                    done = False
+                    link_failed = True
+                if not done:
+                    # part of the file may be written, or not
+                    self.cache.invalidate(filename_to)
+                if done or not self.retry('write_chunk', filename_to, attempt, link_failed):
+                    break
+                attempt += 1
+                resume = True
+
+        self.changed(filename_to)
+        if done:
+            self.cache.put(filename_to, StorageEntry(posixpath.basename(filename_to), filename_to, False, stat.st_size))
+            # file was read in full on the way, hash_local needs no second pass
+            if self.hash_cache is not None:
+                self.hash_cache.put(filename_from, stat, hash_md5.hexdigest())
+        if done and self.journal:
+            self.journal.end(filename_to)
+        return done
+
+    # Size of the part of filename_to already on Flipper if it is a prefix of local file, 0 otherwise,
+    # and MD5 of the local file up to there, to be continued by write_chunks
+    def resume_offset(self, file, filename_to, filesize):
+        entry = self.stat(filename_to)
+        if entry is None or entry.is_dir or entry.size == 0 or entry.size > filesize:
+            return 0, hashlib.md5()
+
+        hash_md5 = hashlib.md5()
+        file.seek(0)
+        buffer = memoryview(bytearray(65536))
+        left = entry.size
+        while left > 0:
+            size = file.readinto(buffer[:min(left, len(buffer))])
+            if not size:
+                break
+            hash_md5.update(buffer[:size])
+            left -= size
+        if self.hash_flipper(filename_to) != hash_md5.hexdigest():
+            return 0, hashlib.md5()
+        return entry.size, hash_md5
+
+    # Buffer for next_write_chunk, fits the command line for filename_to and a chunk of up to CHUNK_SIZE_MAX or chunk_size
+    def write_buffer(self, filename_to, chunk_size):
+        prefix = Answer.encode('storage write_chunk "' + filename_to + '" ')
+        # room for the size digits and "\r"
+        reserve = len(prefix) + 24
+        return prefix, reserve, bytearray(reserve + max(chunk_size, self.CHUNK_SIZE_MAX))
+
+    # Read up to chunk_size bytes of file right behind its write_chunk command line in buffer
+    # returns views of the whole command with payload and of the payload alone, empty at end of file
+    def next_write_chunk(self, file, write_buffer, chunk_size):
+        prefix, reserve, buffer = write_buffer
+        view = memoryview(buffer)
+        size = file.readinto(view[reserve:reserve + chunk_size])
+        line = prefix + str(size).encode() + b'\r'
+        begin = reserve - len(line)
+        view[begin:reserve] = line
+        return view[begin:reserve + size], view[reserve:reserve + size]
 
-        buffer_size = 512
+    # Send file starting from offset with write_chunk commands, hash_md5 is updated with everything read
+    # Chunks are read into one reused buffer and written from there
+    def write_chunks(self, file, filename_to, filesize, offset, window, chunk_size, tuner, hash_md5):
+        file.seek(offset)
+        in_flight = PendingWrites(window, offset)
+        progress = [time.monotonic()]
+        buffer = self.write_buffer(filename_to, chunk_size)
         while True:
-            filedata = file.read(buffer_size)
+            if tuner:
+                chunk_size = tuner.size
+            offset = file.tell()
+            command, filedata = self.next_write_chunk(file, buffer, chunk_size)
             size = len(filedata)
             if size == 0:
                 break
+            hash_md5.update(filedata)
 
-            self.send_and_wait_eol('storage write_chunk "' + filename_to +  '" ' + str(size) + '\r')
-            error = self.read.until(self.CLI_EOL)
-            if self.has_error(error):
-                self.last_error = self.get_error(error)
-                self.read.until(self.CLI_PROMPT)
-                file.close()
+            while in_flight.full():
+                if not self.write_chunk_done(in_flight, filename_to, filesize, progress, tuner):
+                    return False
+
+            if in_flight.acknowledged(offset):
+                if not self.write_acknowledged(command, filedata, filename_to, offset, in_flight):
+                    return False
+            else:
+                self.events.command_started('write_chunk', filename_to)
+                self.write(command)
+                in_flight.sent(offset, size, True, time.monotonic())
+
+        while in_flight:
+            if not self.write_chunk_done(in_flight, filename_to, filesize, progress, tuner):
                 return False
+        return True
+
+    # Send write_chunk command, and its payload only after the device answered "Ready"
+    # Nothing may be in flight, the answer read here has to be the one of this command
+    def write_acknowledged(self, command, filedata, filename_to, offset, in_flight):
+        self.write_held(command, filedata, filename_to, offset, in_flight)
+        return self.write_released(filename_to, in_flight)
 
-            self.port.write(filedata)
+    # Send write_chunk command without its payload, which is held in in_flight until write_released
+    def write_held(self, command, filedata, filename_to, offset, in_flight):
+        self.events.command_started('write_chunk', filename_to)
+        in_flight.hold(offset, filedata, time.monotonic())
+        self.write(command[:len(command) - len(filedata)])
+
+    # Send the payload of the held write_chunk after the device answered "Ready"
+    # Everything sent before it has to be answered, the answer read here has to be the one of this command
+    def write_released(self, filename_to, in_flight):
+        offset, filedata, start = in_flight.release()
+        self.read.until(self.CLI_EOL)
+        error = Answer.error(self.read.until(self.CLI_EOL))
+        if error:
             self.read.until(self.CLI_PROMPT)
+            self.events.command_done('write_chunk', filename_to, time.monotonic() - start, False)
+            self.set_error('write_chunk', filename_to, error, offset)
+            return False
+        self.write(filedata)
+        in_flight.sent(offset, len(filedata), False, start)
+        return True
+
+    # Wait for the oldest in-flight write_chunk to complete
+    def write_chunk_done(self, in_flight, filename, filesize, progress, tuner):
+        offset, size, start, error, resync = in_flight.answered(self.read.until(self.CLI_PROMPT))
+        now = time.monotonic()
+        self.events.command_done('write_chunk', filename, now - start, error is None)
 
-            percent = str(math.ceil(file.tell() / filesize * 100))
-            total_chunks = str(math.ceil(filesize / buffer_size))
-            current_chunk = str(math.ceil(file.tell() / buffer_size))
-            print(percent + '%, chunk ' + current_chunk + ' of ' + total_chunks, end='\r')
-        file.close()
-        print()
+        if error:
+            self.set_error('write_chunk', filename, error, offset)
+            if resync:
+                if in_flight.held:
+                    # the held command may have got "Ready" and wait for its payload, ETX fills it,
+                    # and is dropped by the CLI if it did not
+                    self.events.command_done('write_chunk', filename, 0, False)
+                    self.send(self.CLI_ETX * len(in_flight.release()[1]))
+                self.resync()
+            return False
+
+        if tuner:
+            tuner.update(size, size, now - progress[0])
+        progress[0] = now
+
+        self.events.progress(filename, offset + size, filesize)
         return True
 
+    # Send many files with write_chunk commands of all of them pipelined, files is a list of (filename_from, filename_to)
+    # A file known not to exist in a directory known to exist is sent here without removing it first, the command
+    # of its first chunk goes out behind the chunks in flight, its payload only after they are answered and
+    # the device answered "Ready" to it, the rest is pipelined across files
+    # Other files and files hit by an error go through send_file. Returns filename_to of files that failed
+    def send_files(self, files, window=None, chunk_size=None):
+        window = max(1, window or self.send_window)
+        chunk_size = self.chunk_limit(chunk_size or self.chunk_size)
+        in_flight = PendingWrites(window)
+        # (filename_from, filename_to, filesize) of every chunk in flight
+        owners = deque()
+        single = []
+        progress = [time.monotonic()]
+        broken = False
+        for filename_from, filename_to in files:
+            if broken or not self.can_pipeline(filename_to):
+                single.append((filename_from, filename_to))
+                continue
+            with open(filename_from, 'rb') as file:
+                stat = os.fstat(file.fileno())
+                filesize = stat.st_size
+                if filesize == 0:
+                    single.append((filename_from, filename_to))
+                    continue
+                self.changed(filename_to)
+                buffer = self.write_buffer(filename_to, chunk_size)
+                hash_md5 = hashlib.md5()
+                offset = 0
+                while offset < filesize:
+                    while in_flight.full() and not broken:
+                        broken = not self.send_files_done(in_flight, owners, single, progress)
+                    command, filedata = self.next_write_chunk(file, buffer, chunk_size)
+                    if broken or not filedata:
+                        # part of it may be written already
+                        self.cache.invalidate(filename_to)
+                        single.append((filename_from, filename_to))
+                        break
+                    hash_md5.update(filedata)
+                    if in_flight.acknowledged(offset):
+                        self.write_held(command, filedata, filename_to, offset, in_flight)
+                        while in_flight and not broken:
+                            broken = not self.send_files_done(in_flight, owners, single, progress)
+                        if broken or not self.write_released(filename_to, in_flight):
+                            # send_file reports it if it fails again
+                            self.cache.invalidate(filename_to)
+                            single.append((filename_from, filename_to))
+                            break
+                    else:
+                        self.events.command_started('write_chunk', filename_to)
+                        self.write(command)
+                        in_flight.sent(offset, len(filedata), True, time.monotonic())
+                    owners.append((filename_from, filename_to, filesize))
+                    offset += len(filedata)
+                else:
+                    if self.hash_cache is not None:
+                        self.hash_cache.put(filename_from, stat, hash_md5.hexdigest())
+
+        while in_flight and not broken:
+            broken = not self.send_files_done(in_flight, owners, single, progress)
+        # a file may have been queued twice, once per broken chunk
+        single = list(dict.fromkeys(single))
+        return [filename_to for filename_from, filename_to in single if not self.send_file(filename_from, filename_to, window, chunk_size)]
+
+    # Can filename_to be written without removing it first
+    def can_pipeline(self, filename_to):
+        known, entry = self.cache.lookup(filename_to)
+        parent_known, parent = self.cache.lookup(posixpath.dirname(filename_to))
+        return known and entry is None and parent_known and parent is not None and parent.is_dir
+
+    # Wait for the oldest write_chunk of send_files, False if it failed
+    # Files with chunks that failed or were dropped are added to single
+    def send_files_done(self, in_flight, owners, single, progress):
+        filename_from, filename_to, filesize = owners.popleft()
+        offset, size = in_flight.oldest()
+        if self.write_chunk_done(in_flight, filename_to, filesize, progress, None):
+            if offset + size == filesize:
+                self.cache.put(filename_to, StorageEntry(posixpath.basename(filename_to), filename_to, False, filesize))
+            return True
+        # write_chunk_done dropped everything in flight, those files are in unknown state
+        for filename_from, filename_to, filesize in [(filename_from, filename_to, filesize)] + list(owners):
+            self.cache.invalidate(filename_to)
+            single.append((filename_from, filename_to))
+        owners.clear()
+        return False
+
+    # Drop pending answers and get a fresh prompt
+    def resync(self):
+        time.sleep(self.port.timeout)
+        self.port.reset_input_buffer()
+        self.read.clear()
+        self.list_pending = None
+        self.send_and_wait_prompt(self.CLI_ETX)
+
     # Receive file from Flipper, and get filedata (bytes)
-    def read_file(self, filename):
-        buffer_size = 512
-        self.send_and_wait_eol('storage read_chunks "' + filename + '" ' + str(buffer_size) + '\r')
-        size = self.read.until(self.CLI_EOL)
+    def read_file(self, filename, chunk_size=None):
         filedata = bytearray()
-        if self.has_error(size):
-            self.last_error = self.get_error(size)
+        self.read_file_to(filename, filedata.extend, chunk_size)
+        return filedata
+
+    # Receive file from Flipper chunk by chunk, every chunk is passed to sink(data)
+    # sink is a callable or a file object, data is a view of a reused buffer and is only valid during the call
+    # chunk size is fixed for one read_chunks command, with self.adaptive the next read is tuned
+    # An OSError of sink is raised once the rest of the answer is dropped
+    def read_file_to(self, filename, sink, chunk_size=None):
+        if hasattr(sink, 'write'):
+            sink = sink.write
+        tuner = self.tuner('read') if self.adaptive and chunk_size is None else None
+        chunk_size = self.chunk_limit(chunk_size or (tuner.size if tuner else self.chunk_size))
+        self.events.command_started('read_chunks', filename)
+        transfer_start = time.monotonic()
+        self.send_and_wait_eol('storage read_chunks "' + filename + '" ' + str(chunk_size) + '\r')
+        try:
+            size = Answer.read_size(self.read.until(self.CLI_EOL))
+        except StorageError as error:
             self.read.until(self.CLI_PROMPT)
-            return filedata
-        size = int(size.split(b': ')[1])
+            self.events.command_done('read_chunks', filename, time.monotonic() - transfer_start, False)
+            self.set_error('read_chunks', filename, error)
+            return False
         readed_size = 0
+        buffer = memoryview(bytearray(chunk_size))
 
         while readed_size < size:
+            start = time.monotonic()
             self.read.until('Ready?' + self.CLI_EOL)
             self.send('y')
-            read_size = min(size - readed_size, buffer_size)
-            filedata.extend(self.port.read(read_size))
+            read_size = min(size - readed_size, chunk_size)
+            received = self.read.readinto(buffer[:read_size])
+            if received < read_size:
+                self.events.command_done('read_chunks', filename, time.monotonic() - transfer_start, False)
+                self.set_error('read_chunks', filename, 'timeout', readed_size + received)
+                self.drop_chunks(read_size - received, size - readed_size - read_size, chunk_size)
+                return False
+            try:
+                sink(buffer[:read_size])
+            except OSError:
+                # the device goes on sending, the CLI has to be back at its prompt
+                self.events.command_done('read_chunks', filename, time.monotonic() - transfer_start, False)
+                self.drop_chunks(0, size - readed_size - read_size, chunk_size)
+                raise
             readed_size = readed_size + read_size
+            if tuner:
+                tuner.update(chunk_size, read_size, time.monotonic() - start)
 
-            percent = str(math.ceil(readed_size / size * 100))
-            total_chunks = str(math.ceil(size / buffer_size))
-            current_chunk = str(math.ceil(readed_size / buffer_size))
-            print(percent + '%, chunk ' + current_chunk + ' of ' + total_chunks, end='\r')
-        print()
+            self.events.progress(filename, readed_size, size)
+        self.read.until(self.CLI_PROMPT)
+        self.events.command_done('read_chunks', filename, time.monotonic() - transfer_start, True)
+        return True
+
+    # Read and drop the rest of a read_chunks answer, pending bytes of the current chunk and left bytes after it
+    # The command cannot be stopped, ETX would be taken as a confirmation, so every chunk is confirmed until the prompt
+    def drop_chunks(self, pending, left, chunk_size):
+        buffer = memoryview(bytearray(chunk_size))
+        idle_since = time.monotonic()
+        while True:
+            while pending:
+                received = self.read.readinto(buffer[:pending])
+                if received:
+                    idle_since = time.monotonic()
+                elif self.read.timeout is not None and time.monotonic() - idle_since > self.read.timeout:
+                    raise TimeoutError('no answer from device')
+                pending -= received
+            if not left:
+                break
+            self.read.until('Ready?' + self.CLI_EOL)
+            self.send('y')
+            pending = min(left, chunk_size)
+            left -= pending
         self.read.until(self.CLI_PROMPT)
-        return filedata
 
     # Receive file from Flipper to local storage
-    def receive_file(self, filename_from, filename_to):
-        with open(filename_to, 'wb') as file:
-            data = self.read_file(filename_from)
-            if not data:
-                return False
-            else:
-                file.write(data)
-                return True
+    # Data goes to a temporary file next to filename_to, which replaces it only on success,
+    # it is written and hashed by a BackgroundWriter while the next chunks come in
+    # verify compares MD5 computed on the fly with the one reported by Flipper
+    # A broken transfer is retried from the start, read_chunks cannot skip what was already received
+    def receive_file(self, filename_from, filename_to, verify=False):
+        directory = os.path.dirname(os.path.abspath(filename_to))
+        prefix = '.' + os.path.basename(filename_to) + '.'
+        file = tempfile.NamedTemporaryFile('wb', dir=directory, prefix=prefix, suffix='.part', delete=False)
 
-    # Is file or dir exist on Flipper
-    def exist(self, path):
-        self.send_and_wait_eol('storage stat "' + path + '"\r')
-        answer = self.read.until(self.CLI_EOL)
-        self.read.until(self.CLI_PROMPT)
+        try:
+            with file:
+                attempt = 0
+                while True:
+                    file.seek(0)
+                    file.truncate()
+                    hash_md5 = hashlib.md5()
+                    writer = BackgroundWriter(file, hash_md5)
+                    link_failed = False
+                    try:
+                        try:
+                            done = self.read_file_to(filename_from, writer)
+                        finally:
+                            writer.close()
+                    except OSError as error:
+                        # reading again does not help if the local file cannot be written
+                        link_failed = writer.error is None
+                        error = writer.error or error
+                        self.set_error('read_chunks', filename_from, str(error) or type(error).__name__)
+                        done = False
+                    if done or not self.retry('read_chunks', filename_from, attempt, link_failed):
+                        break
+                    attempt += 1
+            if done and verify:
+                hash_flipper = self.hash_flipper(filename_from)
+                if hash_flipper != hash_md5.hexdigest():
+                    if hash_flipper:
+                        self.set_error('md5', filename_from, 'hash mismatch')
+                    done = False
+            if done:
+                os.replace(file.name, filename_to)
+                if self.hash_cache is not None:
+                    self.hash_cache.put(filename_to, os.stat(filename_to), hash_md5.hexdigest())
+            return done
+        finally:
+            if os.path.exists(file.name):
+                os.remove(file.name)
+
+    # Receive many small files with read_chunks commands pipelined, files is a list of (filename_from, filename_to, size)
+    # with sizes as listed; files up to chunk size get their "Ready?" confirmed in advance, larger ones and files hit by
+    # an unexpected answer go through receive_file. verify is as for receive_file. Returns filename_from of files that failed
+    def receive_files(self, files, window=8, chunk_size=None, verify=False):
+        chunk_size = self.chunk_limit(chunk_size or self.chunk_size)
+        in_flight = deque()
+        single = []
+        received = []
+        broken = False
+        for item in files:
+            filename_from, filename_to, size = item
+            while len(in_flight) >= window and not broken:
+                broken = not self.receive_files_done(in_flight, single, received, chunk_size)
+            if broken or size == 0 or size > chunk_size:
+                single.append(item)
+                continue
+            self.events.command_started('read_chunks', filename_from)
+            self.write(Answer.encode('storage read_chunks "' + filename_from + '" ' + str(chunk_size) + '\r') + b'y')
+            in_flight.append((item, time.monotonic()))
+
+        while in_flight and not broken:
+            broken = not self.receive_files_done(in_flight, single, received, chunk_size)
+
+        failed = []
+        for filename_from, filename_to, temporary, hash_local in received:
+            if verify:
+                hash_flipper = self.hash_flipper(filename_from)
+                if hash_flipper != hash_local:
+                    if hash_flipper:
+                        self.set_error('md5', filename_from, 'hash mismatch')
+                    os.remove(temporary)
+                    failed.append(filename_from)
+                    continue
+            os.replace(temporary, filename_to)
+            if self.hash_cache is not None:
+                self.hash_cache.put(filename_to, os.stat(filename_to), hash_local)
+        for filename_from, filename_to, size in single:
+            if not self.receive_file(filename_from, filename_to, verify):
+                failed.append(filename_from)
+        return failed
 
-        if self.has_error(answer):
-            self.last_error = self.get_error(answer)
+    # Read the oldest answer of receive_files into a temporary file next to its target, False if it was unexpected
+    # Files of unexpected and dropped answers are added to single
+    def receive_files_done(self, in_flight, single, received, chunk_size):
+        (filename_from, filename_to, size), start = in_flight.popleft()
+        self.read.until(self.CLI_EOL)
+        try:
+            size = Answer.read_size(self.read.until(self.CLI_EOL))
+        except StorageError as error:
+            self.set_error('read_chunks', filename_from, error)
+            size = 0
+        if 0 < size <= chunk_size:
+            self.read.until('Ready?' + self.CLI_EOL)
+            data = bytearray(size)
+            if self.read.readinto(memoryview(data)) < size:
+                self.set_error('read_chunks', filename_from, 'timeout', 0)
+                size = 0
+        if not 0 < size <= chunk_size:
+            # confirmation sent in advance went to the CLI, or the device still waits for one
+            self.events.command_done('read_chunks', filename_from, time.monotonic() - start, False)
+            self.resync()
+            single.append((filename_from, filename_to, size))
+            single.extend(item for item, start in in_flight)
+            in_flight.clear()
             return False
-        else:
-            return True
 
-    # Is dir exist on Flipper
-    def exist_dir(self, path):
-        self.send_and_wait_eol('storage stat "' + path + '"\r')
-        answer = self.read.until(self.CLI_EOL)
         self.read.until(self.CLI_PROMPT)
+        self.events.command_done('read_chunks', filename_from, time.monotonic() - start, True)
+        self.events.progress(filename_from, size, size)
+        directory = os.path.dirname(os.path.abspath(filename_to))
+        prefix = '.' + os.path.basename(filename_to) + '.'
+        with tempfile.NamedTemporaryFile('wb', dir=directory, prefix=prefix, suffix='.part', delete=False) as file:
+            file.write(data)
+        received.append((filename_from, filename_to, file.name, hashlib.md5(data).hexdigest()))
+        return True
 
-        if self.has_error(answer):
-            self.last_error = self.get_error(answer)
-            return False
-        else:
-            if answer.find(b'Directory') != -1:
-                return True
-            elif answer.find(b'Storage') != -1:
-                return True
-            else: 
-                return False
+    # Is file or dir exist on Flipper
+    def exist(self, path):
+        return self.stat(path) is not None
+
+    # Is dir exist on Flipper
+    def exist_dir(self, path):
+        entry = self.stat(path)
+        return entry is not None and entry.is_dir
 
     # Is file exist on Flipper
     def exist_file(self, path):
-        self.send_and_wait_eol('storage stat "' + path + '"\r')
-        answer = self.read.until(self.CLI_EOL)
-        self.read.until(self.CLI_PROMPT)
-
-        if self.has_error(answer):
-            self.last_error = self.get_error(answer)
-            return False
-        else:
-            if answer.find(b'File, size:') != -1:
-                return True
-            else: 
-                return False
+        entry = self.stat(path)
+        return entry is not None and not entry.is_dir
 
     # file size on Flipper
     def size(self, path):
-        self.send_and_wait_eol('storage stat "' + path + '"\r')
-        answer = self.read.until(self.CLI_EOL)
-        self.read.until(self.CLI_PROMPT)
-
-        if self.has_error(answer):
-            self.last_error = self.get_error(answer)
-            return False
+        entry = self.stat(path)
+        if entry is None:
+            return -1
         else:
-            if answer.find(b'File, size:') != -1:
-                size = int(''.join(ch for ch in answer.split(b': ')[1].decode() if ch.isdigit()))
-                return size
+            if not entry.is_dir:
+                return entry.size
             else:
-                self.last_error = 'access denied'
+                self.set_error('stat', path, 'access denied')
                 return -1
 
     # Create a directory on Flipper
     def mkdir(self, path):
-        self.send_and_wait_eol('storage mkdir "' + path + '"\r')
-        answer = self.read.until(self.CLI_EOL)
-        self.read.until(self.CLI_PROMPT)
-
-        if self.has_error(answer):
-            self.last_error = self.get_error(answer)
+        if self.command('mkdir', path) is None:
+            self.cache.invalidate(path)
             return False
-        else:
-            return True
+        self.cache.put(path, StorageEntry(posixpath.basename(path.rstrip('/')), path, True))
+        # mkdir fails on existing paths, so the new directory is empty
+        self.cache.listed(path, [])
+        return True
 
     # Remove file or directory on Flipper
     def remove(self, path):
-        self.send_and_wait_eol('storage remove "' + path + '"\r')
-        answer = self.read.until(self.CLI_EOL)
-        self.read.until(self.CLI_PROMPT)
-
-        if self.has_error(answer):
-            self.last_error = self.get_error(answer)
+        if self.command('remove', path) is None:
+            self.cache.invalidate(path)
             return False
-        else:
+        self.cache.removed(path)
+        return True
+
+    # Remove file or directory with everything inside on Flipper, missing path is not an error
+    def remove_tree(self, path):
+        if not self.exist(path):
+            return True
+        if self.exist_dir(path):
+            dirs = []
+            for dirpath, dirnames, filenames in self.walk(path):
+                dirs.append(dirpath)
+                for filename in filenames:
+                    if not self.remove(dirpath + '/' + filename):
+                        return False
+            for dirpath in reversed(dirs):
+                if not self.remove(dirpath):
+                    return False
             return True
+        return self.remove(path)
 
     # Hash of local file
     def hash_local(self, filename):
+        if self.hash_cache is not None:
+            return self.hash_cache.get(filename, self.hash_local_file)
+        return self.hash_local_file(filename)
+
+    # Hash of local file, bypassing hash_cache
+    def hash_local_file(self, filename):
         hash_md5 = hashlib.md5()
+        buffer = memoryview(bytearray(65536))
         with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
+            for size in iter(lambda: f.readinto(buffer), 0):
+                hash_md5.update(buffer[:size])
         return hash_md5.hexdigest()
 
     # Get hash of file on Flipper
     def hash_flipper(self, filename):
-        self.send_and_wait_eol('storage md5 "' + filename + '"\r')
-        hash = self.read.until(self.CLI_EOL)
-        self.read.until(self.CLI_PROMPT)
-
-        if self.has_error(hash):
-            self.last_error = self.get_error(hash)
-            return ''
-        else:
-            return hash.decode('ascii')
+        # the device says nothing while it hashes, for as long as the file takes
+        timeout, self.read.timeout = self.read.timeout, None
+        try:
+            return self.command('md5', filename, Answer.md5) or ''
+        finally:
+            self.read.timeout = timeout
 
@@ -0,0 +1,302 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import types
+
+from flipper_storage_lib import FlipperStorage, EventSink, HashCache, StorageEntry, cache_dir
+from flipper_storage_lib import StorageError, NotExistError, ExistError, ProtocolError
+
+
+# FlipperStorage methods served to clients
+METHODS = (
+    'stat', 'scandir', 'exist', 'exist_dir', 'exist_file', 'size', 'mkdir', 'remove', 'remove_tree',
+    'list_tree', 'traverse', 'walk', 'read_file', 'hash_flipper',
+    'send_file', 'send_files', 'receive_file', 'receive_files',
+)
+# methods that return generators, their items are sent one per line
+GENERATORS = ('list_tree', 'traverse', 'walk')
+# FlipperStorage attributes a client sets along with every call
+OPTIONS = ('chunk_size', 'adaptive', 'retries', 'send_window')
+
+
+ERRORS = {cls.__name__: cls for cls in (StorageError, NotExistError, ExistError, ProtocolError)}
+
+
+# Value as JSON, StorageEntry, StorageError and bytes are tagged
+def encode(value):
+    if isinstance(value, StorageError):
+        return {'error': [type(value).__name__, value.message, value.command, value.path, value.offset]}
+    if isinstance(value, StorageEntry):
+        return {'entry': [value.name, value.path, value.is_dir, value.size, value.depth]}
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict):
+        if 'entry' in value:
+            return StorageEntry(*value['entry'])
+        if 'error' in value:
+            name, message, command, path, offset = value['error']
+            return ERRORS.get(name, StorageError)(message, command, path, offset)
+        if 'bytes' in value:
+            return bytearray(base64.b64decode(value['bytes']))
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+# Session socket of a port
+def socket_path(port):
+    key = hashlib.sha1(port.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir(), 'session-' + key + '.sock')
+
+
+def available():
+    return hasattr(socket, 'AF_UNIX')
+
+
+class ForwardSink(EventSink):
+    """
+    Passes events of one call to its client, they are replayed on the client's sink
+    """
+    def __init__(self, send):
+        self.send = send
+
+    def command_started(self, command, path):
+        self.send({'event': 'command_started', 'args': [command, path]})
+
+    def command_done(self, command, path, seconds, ok):
+        self.send({'event': 'command_done', 'args': [command, path, seconds, ok]})
+
+    def bytes_sent(self, count):
+        self.send({'event': 'bytes_sent', 'args': [count]})
+
+    def bytes_received(self, count):
+        self.send({'event': 'bytes_received', 'args': [count]})
+
+    def progress(self, path, done, total):
+        self.send({'event': 'progress', 'args': [path, done, total]})
+
+    def retry(self, command, path, reason):
+        self.send({'event': 'retry', 'args': [command, path, reason]})
+
+    def error(self, command, path, message):
+        self.send({'event': 'error', 'args': [command, path, message]})
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    """
+    One call per connection: a JSON request line in, event and item lines, then a result line out
+    """
+    def send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+        self.wfile.flush()
+
+    # Serialized by the server lock, returns (result, last_exception), generators are run through
+    def run(self, request):
+        server = self.server
+        storage = server.storage
+        if time.monotonic() - server.last_call > server.CACHE_IDLE:
+            # files may have been changed on the device itself meanwhile
+            storage.cache.invalidate()
+        for name, value in request.get('options', {}).items():
+            if name in OPTIONS:
+                setattr(storage, name, value)
+        storage.events = ForwardSink(self.send)
+        storage.last_exception = None
+        storage.last_error = ''
+        # calls are serialized, so the working directory can follow the client's for relative local paths
+        os.chdir(request.get('cwd') or server.cwd)
+        try:
+            method = request['method']
+            if method == 'ping':
+                return None, None
+            result = getattr(storage, method)(*decode(request.get('args', [])), **{name: decode(value) for name, value in request.get('kwargs', {}).items()})
+            if isinstance(result, types.GeneratorType):
+                # the client may run other calls while it goes through the items
+                result = list(result)
+            return result, storage.last_exception
+        finally:
+            storage.events = EventSink()
+            os.chdir(server.cwd)
+            server.calls += 1
+            server.last_call = time.monotonic()
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            self.send({'exception': 'bad request'})
+            return
+        method = request.get('method')
+        if method == 'shutdown':
+            self.send({'result': None, 'last_exception': None})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if method != 'ping' and method not in METHODS:
+            self.send({'exception': f'unknown method "{method}"'})
+            return
+
+        try:
+            with self.server.lock:
+                result, last_exception = self.run(request)
+            if request['method'] in GENERATORS:
+                for item in result:
+                    self.send({'item': encode(item)})
+                result = None
+            self.send({'result': encode(result), 'last_exception': encode(last_exception)})
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as error:
+            try:
+                self.send({'exception': f'{type(error).__name__}: {error}', 'last_exception': encode(self.server.storage.last_exception)})
+            except OSError:
+                pass
+
+
+class SessionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps one port open and serves FlipperStorage calls of other processes over a Unix socket.
+
+    Calls are run one at a time, the device answers one command at a time anyway, and
+    the metadata and hash caches of the open FlipperStorage stay warm between them.
+    """
+    daemon_threads = True
+    # seconds without calls after which cached listings are dropped
+    CACHE_IDLE = 5.0
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.last_call = time.monotonic()
+        self.cwd = os.getcwd()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, SessionHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class SessionClient:
+    """
+    Stand-in for FlipperStorage that runs its calls in a SessionServer.
+
+    Local paths are resolved by the server against the client's working directory.
+    Events of a call are replayed on self.events, options are sent with every call.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.events = EventSink()
+        self.last_exception = None
+        self.last_error = ''
+        self.chunk_size = FlipperStorage.CHUNK_SIZE
+        self.adaptive = False
+        self.retries = 3
+        self.send_window = 1
+        # local files are hashed here, the server has its own journal
+        self.hash_cache = HashCache()
+        self.journal = None
+
+    # Is a server listening on path
+    @staticmethod
+    def connect(path):
+        if not available() or not os.path.exists(path):
+            return None
+        client = SessionClient(path)
+        try:
+            client.call('ping')
+        except OSError:
+            return None
+        return client
+
+    # the server keeps the port open
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def shutdown(self):
+        self.call('shutdown')
+
+    hash_local = FlipperStorage.hash_local
+    hash_local_file = FlipperStorage.hash_local_file
+
+    # Run method on the server, generators give an iterator, others wait for the result
+    def call(self, method, *args, **kwargs):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            stream = connection.makefile('rwb')
+            request = {
+                'method': method,
+                'args': encode(list(args)),
+                'kwargs': {name: encode(value) for name, value in kwargs.items()},
+                'options': {name: getattr(self, name) for name in OPTIONS},
+                'cwd': os.getcwd(),
+            }
+            stream.write(json.dumps(request).encode() + b'\n')
+            stream.flush()
+        except OSError:
+            connection.close()
+            raise
+        replies = self.replies(connection, stream)
+        if method in GENERATORS:
+            return self.items(replies)
+        for reply in replies:
+            if 'result' in reply:
+                return decode(reply['result'])
+
+    def items(self, replies):
+        for reply in replies:
+            if 'item' in reply:
+                yield self.item(reply['item'])
+
+    @staticmethod
+    def item(value):
+        value = decode(value)
+        return tuple(value) if isinstance(value, list) else value
+
+    # Reply lines with events replayed, up to the result
+    def replies(self, connection, stream):
+        try:
+            for line in stream:
+                reply = json.loads(line)
+                if 'event' in reply:
+                    getattr(self.events, reply['event'])(*reply['args'])
+                    continue
+                if 'last_exception' in reply:
+                    self.last_exception = decode(reply['last_exception'])
+                    self.last_error = str(self.last_exception) if self.last_exception else ''
+                if 'exception' in reply:
+                    raise OSError(reply['exception'])
+                yield reply
+                if 'result' in reply:
+                    return
+            raise ConnectionResetError('session closed')
+        finally:
+            stream.close()
+            connection.close()
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
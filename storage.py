@@ -1,17 +1,153 @@
-from flipper_storage_lib import FlipperStorage
+from flipper_storage_lib import FlipperStorage, EventSink, MetricsSink, MultiSink, SyncManifest, TransferJournal, TransferPlan, HashCache
+from flipper_storage_emulator import EmulatedSerial, DirectoryTree
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import argparse
+import copy
+import glob
+import json
 import os
+import re
+import socket
 import sys
 import binascii
 import posixpath
+import queue
+import threading
+import time
+
+
+# Sessions run over Unix domain sockets, flipper_storage_session is only imported where they exist
+def sessions_available():
+    return hasattr(socket, 'AF_UNIX')
+
+
+# argparse type of --chunk-size, sizes above the device limit are clamped by FlipperStorage
+def chunk_size(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError('chunk size must be at least 1, got ' + text)
+    return value
+
+
+class Progress(EventSink):
+    """
+    Transfer progress line, redrawn at most every INTERVAL seconds
+    """
+    INTERVAL = 0.1
+
+    def __init__(self):
+        self.shown = 0.0
+
+    def progress(self, path, done, total):
+        now = time.monotonic()
+        if done < total and now - self.shown < self.INTERVAL:
+            return
+        self.shown = now
+        percent = done * 100 // total if total else 100
+        print(f'{percent}%, {done} of {total} bytes', end='\r' if done < total else '\n')
+
+class DeviceLog(logging.Filter):
+    """
+    Prefixes records of one device worker with its port and counts errors
+    """
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+        self.errors = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            self.errors += 1
+        record.msg = f'[{self.port}] {record.msg}'
+        return True
+
+class LocalScan:
+    """
+    Local tree scanned with os.scandir from a thread, directories come out in os.walk top-down order
+    through a bounded queue. Files passed to hash() are hashed by jobs threads meanwhile, into the
+    hash cache that the sync reads them from.
+    """
+    QUEUE_SIZE = 64
+
+    def __init__(self, root, hash_local, jobs=0):
+        self.root = root
+        self.hash_local = hash_local
+        self.pool = ThreadPoolExecutor(max_workers=jobs) if jobs else None
+        # files hashed or waiting to be hashed, bounded too
+        self.pending = threading.Semaphore(self.QUEUE_SIZE)
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.stopped = False
+        self.done = False
+        self.thread = threading.Thread(target=self.scan, daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        while not self.done:
+            item = self.queue.get()
+            if item is None:
+                self.done = True
+                return
+            yield item
+
+    def scan(self):
+        stack = [self.root]
+        try:
+            while stack and not self.stopped:
+                dirpath = stack.pop()
+                dirnames = []
+                filenames = []
+                try:
+                    with os.scandir(dirpath) as entries:
+                        for entry in entries:
+                            try:
+                                is_dir = entry.is_dir()
+                            except OSError:
+                                is_dir = False
+                            if is_dir:
+                                dirnames.append(entry)
+                            else:
+                                filenames.append(entry.name)
+                except OSError:
+                    # os.walk skips directories it cannot list as well
+                    continue
+                dirnames.sort(key=lambda entry: entry.name)
+                filenames.sort()
+                self.queue.put((dirpath, [entry.name for entry in dirnames], filenames))
+                stack.extend(entry.path for entry in reversed(dirnames) if not entry.is_symlink())
+        finally:
+            self.queue.put(None)
+
+    # Start hashing a file, errors are left to the sync to run into
+    def hash(self, path):
+        if not self.pool:
+            return
+        self.pending.acquire()
+        future = self.pool.submit(self.hash_local, path)
+        future.add_done_callback(lambda future: self.pending.release())
+
+    # Stop scanning and hashing, waits for the threads
+    def close(self):
+        self.stopped = True
+        for _ in self:
+            pass
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+
 
 class Main:
+    # files in one send_files call of send --bundle
+    BUNDLE_FILES = 64
+
     def __init__(self):
         # command args
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument("-d", "--debug", action="store_true", help="Debug")
-        self.parser.add_argument("-p", "--port", help="CDC Port", required=True)
+        self.parser.add_argument("-p", "--port", help="CDC Port, or emu:DIR for a device emulated on top of DIR. Several comma separated ports or glob patterns run the command on all of them at once", required=True)
+        self.parser.add_argument("-c", "--chunk-size", help="Transfer chunk size, bytes, " + str(FlipperStorage.CHUNK_SIZE_MIN) + " to " + str(FlipperStorage.CHUNK_SIZE_MAX), type=chunk_size, default=FlipperStorage.CHUNK_SIZE)
+        self.parser.add_argument("-a", "--adaptive", help="Tune chunk size by measured throughput", action="store_true")
+        self.parser.add_argument("-r", "--retries", help="Retries of a broken transfer", type=int, default=3)
+        self.parser.add_argument("--no-session", help="Open the port even if a session serves it", action="store_true")
         self.subparsers = self.parser.add_subparsers(help="sub-command help")
 
         self.parser_mkdir = self.subparsers.add_parser("mkdir", help="Create directory")
@@ -33,20 +169,61 @@ class Main:
         self.parser_receive = self.subparsers.add_parser("receive", help="Receive file")
         self.parser_receive.add_argument("-fp", "--flipper-path", help="Flipper path", required=True)
         self.parser_receive.add_argument("-lp", "--local-path", help="Local path", required=True)
+        self.parser_receive.add_argument("-v", "--verify", help="Verify received files by MD5", action="store_true")
+        self.parser_receive.add_argument("-b", "--bundle", help="Pipeline reads of small files across files", action="store_true")
+        self.parser_receive.add_argument("-i", "--incremental", help="Only receive files that are new or differ from local ones", action="store_true")
+        self.parser_receive.add_argument("--no-manifest", help="Do not read or write the sync manifest", action="store_true")
+        self.parser_receive.add_argument("--delete", help="Remove local files and dirs that do not exist on Flipper", action="store_true")
         self.parser_receive.set_defaults(func=self.receive)
 
         self.parser_send = self.subparsers.add_parser("send", help="Send file or directory")
         self.parser_send.add_argument("-fp", "--flipper-path", help="Flipper path", required=True)
         self.parser_send.add_argument("-lp", "--local-path", help="Local path", required=True)
         self.parser_send.add_argument("-f", "--force", help="Force sending", action="store_true")
+        self.parser_send.add_argument("-w", "--window", help="Chunks in flight while sending", type=int, default=1)
+        self.parser_send.add_argument("-v", "--verify", help="Compare every file, ignoring what the last sync confirmed", action="store_true")
+        self.parser_send.add_argument("--no-manifest", help="Do not read or write the sync manifest", action="store_true")
+        self.parser_send.add_argument("-D", "--delta", help="Only append the new tail of files that grew, if the rest is unchanged", action="store_true")
+        self.parser_send.add_argument("-b", "--bundle", help="Send new files together, write commands pipelined across files", action="store_true")
+        self.parser_send.add_argument("--order", help="Order of transfers, walk keeps the order of the local tree", choices=TransferPlan.POLICIES, default='walk')
+        self.parser_send.add_argument("--priority", help="Send files matching this glob pattern first, may be repeated", action="append", default=[])
+        self.parser_send.add_argument("--time-budget", help="Stop before a transfer that would end later than this many seconds after the start", type=float)
+        self.parser_send.add_argument("-n", "--dry-run", help="Print what would be sent and how long it should take, change nothing", action="store_true")
+        self.parser_send.add_argument("-j", "--jobs", help="Threads hashing local files ahead of the sync, 0 hashes them only when compared", type=int, default=min(4, os.cpu_count() or 1))
         self.parser_send.set_defaults(func=self.send)
 
         self.parser_list = self.subparsers.add_parser("list", help="Recursively list files and dirs")
         self.parser_list.add_argument("-fp", "--flipper-path", help="Flipper path", default='/')
+        self.parser_list.add_argument("--depth", help="Levels to enter, 0 lists the path only", type=int)
+        self.parser_list.add_argument("--pattern", help="Only show names matching this glob pattern")
+        self.parser_list.add_argument("--bfs", help="List level by level instead of depth first", action="store_true")
+        self.parser_list.add_argument("--json", help="One JSON object per line: path, type, size, depth", action="store_true")
         self.parser_list.set_defaults(func=self.list)
 
+        self.parser_session = self.subparsers.add_parser("session", help="Keep the port open and serve the other commands run on it")
+        self.parser_session.add_argument("--stop", help="Stop the session of the port", action="store_true")
+        self.parser_session.set_defaults(func=self.session)
+
         # logging
         self.logger = logging.getLogger()
+        # files confirmed by previous syncs, see SyncManifest
+        self.manifest = None
+        # append to grown files instead of sending them again
+        self.delta = False
+        # uploads of send put off until the tree is compared, see TransferPlan, None sends every file at once
+        self.plan = None
+        # time.monotonic() the job has to end by, None for no limit
+        self.deadline = None
+        # local file hashes, shared by all device workers
+        self.hash_cache = None
+        # progress line, off when several devices share the terminal
+        self.progress = True
+        # name of the device in local paths of a fan-out receive, None for a single device
+        self.device = None
+        # per device totals for the fan-out summary
+        self.metrics = MetricsSink()
+        self.files = 0
+        self.skipped = 0
 
     def __call__(self):
         self.args = self.parser.parse_args()
@@ -60,11 +237,124 @@ class Main:
         self.formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
         self.handler.setFormatter(self.formatter)
         self.logger.addHandler(self.handler)
-        # execute requested function
-        self.args.func()
+        # execute requested function, on every port
+        ports = self.expand_ports(self.args.port)
+        if not ports:
+            self.parser.error(f'No port matches "{self.args.port}"')
+        if len(ports) == 1:
+            self.args.port = ports[0]
+            self.args.func()
+        else:
+            self.fan_out(ports)
+
+    # Ports from comma separated names and glob patterns, emu: prefix kept
+    def expand_ports(self, text):
+        ports = []
+        for name in text.split(','):
+            prefix = 'emu:' if name.startswith('emu:') else ''
+            pattern = name[len(prefix):]
+            matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+            for match in matches:
+                if prefix + match not in ports:
+                    ports.append(prefix + match)
+        return ports
+
+    # Run the command on all ports concurrently, one worker per device
+    def fan_out(self, ports):
+        hash_cache = HashCache()
+        workers = []
+        for port in ports:
+            worker = copy.copy(self)
+            worker.args = copy.copy(self.args)
+            worker.args.port = port
+            if self.args.func == self.receive:
+                # keep devices apart, files with the same path would collide
+                worker.device = re.sub(r'[^\w.-]+', '_', port).strip('_')
+            worker.log = DeviceLog(port)
+            worker.logger = self.logger.getChild(port)
+            worker.logger.addFilter(worker.log)
+            worker.hash_cache = hash_cache
+            worker.progress = False
+            worker.metrics = MetricsSink()
+            workers.append(worker)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(workers)) as pool:
+            durations = list(pool.map(Main.run_worker, workers))
+
+        for worker, duration in zip(workers, durations):
+            counters = worker.metrics.counters
+            self.logger.info(
+                f'{worker.args.port}: {worker.files} files, {worker.skipped} skipped, {worker.log.errors} errors, '
+                f'{counters["bytes_sent"]} bytes sent, {counters["bytes_received"]} bytes received, {duration:.2f} s'
+            )
+        self.logger.info(f'{len(workers)} devices, {time.monotonic() - start:.2f} s')
+
+    # Execute the command bound to this worker, returns seconds taken
+    def run_worker(self):
+        start = time.monotonic()
+        try:
+            getattr(self, self.args.func.__name__)()
+        except Exception as error:
+            self.logger.error(f'Error: {error}')
+        return time.monotonic() - start
+
+    # Port object for FlipperStorage, None lets it open args.port itself
+    def new_port(self):
+        if self.args.port.startswith('emu:'):
+            return EmulatedSerial(DirectoryTree(self.args.port[len('emu:'):]))
+        return None
+
+    def new_storage(self):
+        storage = self.connect_session() or FlipperStorage(self.args.port, self.new_port())
+        storage.chunk_size = self.args.chunk_size
+        storage.events = MultiSink(Progress(), self.metrics) if self.progress else self.metrics
+        if self.hash_cache is not None:
+            storage.hash_cache = self.hash_cache
+        storage.adaptive = self.args.adaptive
+        storage.retries = self.args.retries
+        storage.journal = TransferJournal(TransferJournal.path_for(self.args.port))
+        return storage
+
+    # Client of the session serving the port, None to open the port here
+    def connect_session(self):
+        if self.args.no_session or self.args.func.__name__ == 'session' or not sessions_available():
+            return None
+        from flipper_storage_session import SessionClient, socket_path
+        client = SessionClient.connect(socket_path(self.args.port))
+        if client:
+            self.logger.debug(f'Using session of "{self.args.port}"')
+        return client
+
+    def session(self):
+        if not sessions_available():
+            self.logger.error('Error: sessions need Unix domain sockets')
+            return
+        from flipper_storage_session import SessionServer, SessionClient, socket_path
+        path = socket_path(self.args.port)
+        if self.args.stop:
+            client = SessionClient.connect(path)
+            if not client:
+                self.logger.error(f'Error: no session of "{self.args.port}"')
+            else:
+                client.shutdown()
+            return
+
+        storage = self.new_storage()
+        storage.start()
+        server = SessionServer(storage, path)
+        self.logger.info(f'Serving "{self.args.port}" on "{path}"')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            storage.stop()
+        self.logger.info(f'Session of "{self.args.port}" stopped, {server.calls} calls served')
 
     def mkdir(self):
-        storage = FlipperStorage(self.args.port)
+        storage = self.new_storage()
         storage.start()
         self.logger.debug(f'Creating "{self.args.flipper_path}"')
         if not storage.mkdir(self.args.flipper_path):
@@ -72,7 +362,7 @@ class Main:
         storage.stop()
 
     def remove(self):
-        storage = FlipperStorage(self.args.port)
+        storage = self.new_storage()
         storage.start()
         self.logger.debug(f'Removing "{self.args.flipper_path}"')
         if not storage.remove(self.args.flipper_path):
@@ -80,96 +370,302 @@ class Main:
         storage.stop()
 
     def receive(self):
-        storage = FlipperStorage(self.args.port)
+        storage = self.new_storage()
+        if self.args.incremental and not self.args.no_manifest:
+            self.manifest = SyncManifest(SyncManifest.path_for(self.args.port, self.args.flipper_path))
         storage.start()
-        
-        if storage.exist_dir(self.args.flipper_path):
-            for dirpath, dirnames, filenames in storage.walk(self.args.flipper_path):
-                self.logger.debug(f'Processing directory "{os.path.normpath(dirpath)}"'.replace(os.sep, '/'))
-                dirnames.sort()
-                filenames.sort()
+        try:
+            local_path = self.device_path(storage) if self.device else self.args.local_path
+            self.receive_from_storage(storage, self.args.flipper_path, local_path)
+        finally:
+            if self.manifest:
+                self.manifest.save()
+        storage.stop()
 
-                rel_path = os.path.relpath(dirpath, self.args.flipper_path)
+    # Local path of a fan-out receive: a folder is received into a folder of the device inside local_path,
+    # a file next to local_path with the device in its name
+    def device_path(self, storage):
+        entry = storage.stat(self.args.flipper_path)
+        if entry is not None and entry.is_dir:
+            local_path = os.path.join(self.args.local_path, self.device)
+            os.makedirs(local_path, exist_ok=True)
+            return local_path
+        stem, extension = os.path.splitext(self.args.local_path)
+        return f'{stem}.{self.device}{extension}'
 
-                for dirname in dirnames:
-                    local_dir_path = os.path.join(self.args.local_path, rel_path, dirname)
-                    local_dir_path = os.path.normpath(local_dir_path)
-                    os.makedirs(local_dir_path, exist_ok=True)
+    # receive file or folder recursively, with --delete local leftovers of a folder are removed
+    def receive_from_storage(self, storage, flipper_path, local_path):
+        entry = storage.stat(flipper_path)
+        if entry is None or not entry.is_dir:
+            size = entry.size if entry else -1
+            self.receive_file_from_storage(storage, flipper_path, local_path, size)
+            return
 
-                for filename in filenames:
-                    local_file_path = os.path.join(self.args.local_path, rel_path, filename)
-                    local_file_path = os.path.normpath(local_file_path)
-                    flipper_file_path = os.path.normpath(os.path.join(dirpath, filename)).replace(os.sep, '/')
-                    self.logger.info(f'Receiving "{flipper_file_path}" to "{local_file_path}"')
-                    if not storage.receive_file(flipper_file_path, local_file_path):
-                        self.logger.error(f'Error: {storage.last_error}')
-                    
+        bundle = [] if self.args.bundle else None
+        errors = self.metrics.counters['errors']
+        local_dirs = {os.path.normpath(local_path)}
+        local_files = set()
+        for dirpath, dirs, files in storage.walk(flipper_path, True):
+            self.logger.debug(f'Processing directory "{os.path.normpath(dirpath)}"'.replace(os.sep, '/'))
+            dirnames = sorted(entry.name for entry in dirs)
+            sizes = {entry.name: entry.size for entry in files}
+            filenames = sorted(sizes)
+
+            rel_path = os.path.relpath(dirpath, flipper_path)
+
+            for dirname in dirnames:
+                local_dir_path = os.path.join(local_path, rel_path, dirname)
+                local_dir_path = os.path.normpath(local_dir_path)
+                local_dirs.add(local_dir_path)
+                os.makedirs(local_dir_path, exist_ok=True)
+
+            for filename in filenames:
+                local_file_path = os.path.join(local_path, rel_path, filename)
+                local_file_path = os.path.normpath(local_file_path)
+                local_files.add(local_file_path)
+                flipper_file_path = os.path.normpath(os.path.join(dirpath, filename)).replace(os.sep, '/')
+                self.receive_file_from_storage(storage, flipper_file_path, local_file_path, sizes[filename], bundle)
+
+        if bundle:
+            self.receive_bundle(storage, bundle)
+
+        if self.args.delete:
+            # a listing that failed looks empty, do not take it for files gone from Flipper
+            if self.metrics.counters['errors'] != errors:
+                self.logger.error(f'Error: not removing local files, "{flipper_path}" was not received without errors')
+            else:
+                self.prune_local(flipper_path, local_path, local_dirs, local_files)
+
+    # receive file unless it is known to be equal to the local one, size is as listed
+    # with bundle set the file is put off to be received by receive_bundle
+    def receive_file_from_storage(self, storage, flipper_file_path, local_file_path, size, bundle=None):
+        if self.args.incremental and self.local_unchanged(storage, flipper_file_path, local_file_path, size):
+            self.skipped += 1
+            return
+        self.logger.info(f'Receiving "{flipper_file_path}" to "{local_file_path}"')
+        if bundle is not None:
+            bundle.append((flipper_file_path, local_file_path, size))
+        elif not storage.receive_file(flipper_file_path, local_file_path, self.args.verify):
+            self.logger.error(f'Error: {storage.last_error}')
+            if self.manifest:
+                self.manifest.forget(flipper_file_path)
         else:
-            self.logger.info(f'Receiving "{self.args.flipper_path}" to "{self.args.local_path}"')
-            if not storage.receive_file(self.args.flipper_path, self.args.local_path):
-                self.logger.error(f'Error: {storage.last_error}')
-        storage.stop()
+            self.downloaded(storage, flipper_file_path, local_file_path)
+
+    # is local file equal to the one on Flipper by size and hash, manifest saves hashing the local file
+    def local_unchanged(self, storage, flipper_file_path, local_file_path, size):
+        try:
+            stat = os.stat(local_file_path)
+        except OSError:
+            self.logger.debug(f'"{local_file_path}" not exist')
+            return False
+        if stat.st_size != size:
+            self.logger.debug(f'"{local_file_path}" size differs from "{flipper_file_path}"')
+            return False
+
+        # listings carry no mtime, a file rewritten on Flipper with the same size is only told apart by its hash
+        self.logger.debug(f'"{local_file_path}" exist, compare hash with "{flipper_file_path}"')
+        hash_local = self.manifest.local_hash(flipper_file_path, local_file_path, stat) if self.manifest else None
+        if not hash_local:
+            hash_local = storage.hash_local(local_file_path)
+        hash_flipper = storage.hash_flipper(flipper_file_path)
+        if not hash_flipper:
+            self.logger.error(f'Error: {storage.last_error}')
+            return False
+        if hash_local != hash_flipper:
+            self.logger.debug(f'"{local_file_path}" are not equal to "{flipper_file_path}"')
+            return False
+        self.logger.debug(f'"{local_file_path}" are equal to "{flipper_file_path}"')
+        if self.manifest:
+            self.manifest.confirm(flipper_file_path, local_file_path, stat, hash_local, size, hash_flipper)
+        return True
+
+    # receive files put off by receive_file_from_storage in one go
+    def receive_bundle(self, storage, bundle):
+        self.logger.debug(f'Receiving {len(bundle)} files together')
+        failed = set(storage.receive_files(bundle, verify=self.args.verify))
+        for flipper_file_path, local_file_path, size in bundle:
+            if flipper_file_path in failed:
+                self.logger.error(f'Error: "{flipper_file_path}" not received, {storage.last_error}')
+                if self.manifest:
+                    self.manifest.forget(flipper_file_path)
+            else:
+                self.downloaded(storage, flipper_file_path, local_file_path)
+
+    # count file received and record it in manifest, the hash of a received file is cached by storage
+    def downloaded(self, storage, flipper_file_path, local_file_path):
+        self.files += 1
+        if self.manifest:
+            stat = os.stat(local_file_path)
+            hash_local = storage.hash_local(local_file_path)
+            self.manifest.confirm(flipper_file_path, local_file_path, stat, hash_local, stat.st_size, hash_local)
+
+    # remove local files and dirs under local_path that were not listed on Flipper
+    def prune_local(self, flipper_path, local_path, local_dirs, local_files):
+        for dirpath, dirnames, filenames in os.walk(local_path, topdown=False):
+            for filename in filenames:
+                local_file_path = os.path.normpath(os.path.join(dirpath, filename))
+                if local_file_path in local_files:
+                    continue
+                self.logger.info(f'Removing "{local_file_path}", not on Flipper')
+                os.remove(local_file_path)
+                if self.manifest:
+                    rel_path = os.path.relpath(local_file_path, local_path)
+                    self.manifest.forget(posixpath.normpath(posixpath.join(flipper_path, rel_path.replace(os.sep, '/'))))
+            for dirname in dirnames:
+                local_dir_path = os.path.normpath(os.path.join(dirpath, dirname))
+                if local_dir_path in local_dirs:
+                    continue
+                self.logger.info(f'Removing "{local_dir_path}", not on Flipper')
+                if os.path.islink(local_dir_path):
+                    os.remove(local_dir_path)
+                else:
+                    os.rmdir(local_dir_path)
 
     def send(self):
-        storage = FlipperStorage(self.args.port)
+        if self.args.time_budget is not None:
+            self.deadline = time.monotonic() + self.args.time_budget
+        storage = self.new_storage()
+        storage.send_window = self.args.window
+        self.delta = self.args.delta
+        self.plan = TransferPlan(TransferPlan.path_for(self.args.port))
+        if not self.args.no_manifest:
+            self.manifest = SyncManifest(SyncManifest.path_for(self.args.port, self.args.flipper_path))
         storage.start()
-        self.send_to_storage(storage, self.args.flipper_path, self.args.local_path, self.args.force)
+        try:
+            self.send_to_storage(storage, self.args.flipper_path, self.args.local_path, self.args.force, self.args.verify)
+            self.run_plan(storage)
+        finally:
+            if self.manifest and not self.args.dry_run:
+                self.manifest.save()
         storage.stop()
 
     # send file or folder recursively
-    def send_to_storage(self, storage, flipper_path, local_path, force):
+    # verify ignores the manifest and compares every existing file by hash
+    def send_to_storage(self, storage, flipper_path, local_path, force, verify=False):
         if not os.path.exists(local_path):
             self.logger.error(f'Error: "{local_path}" is not exist')
+            return
 
         if os.path.isdir(local_path):
-            # create parent dir
-            self.mkdir_on_storage(storage, flipper_path)
+            # create parent dir, remote listings are taken once per directory
+            flipper_path = os.path.normpath(flipper_path).replace(os.sep, '/')
+            listings = {flipper_path: self.mkdir_on_storage(storage, flipper_path)}
 
-            for dirpath, dirnames, filenames in os.walk(local_path):
-                self.logger.debug(f'Processing directory "{os.path.normpath(dirpath)}"')
-                dirnames.sort()
-                filenames.sort()
-                rel_path = os.path.relpath(dirpath, local_path)
-
-                # create subdirs
-                for dirname in dirnames:
-                    flipper_dir_path = os.path.join(flipper_path, rel_path, dirname)
-                    flipper_dir_path = os.path.normpath(flipper_dir_path).replace(os.sep, '/')
-                    self.mkdir_on_storage(storage, flipper_dir_path)
-
-                # send files
-                for filename in filenames:
-                    flipper_file_path = os.path.join(flipper_path, rel_path, filename)
-                    flipper_file_path = os.path.normpath(flipper_file_path).replace(os.sep, '/')
-                    local_file_path = os.path.normpath(os.path.join(dirpath, filename))
-                    self.send_file_to_storage(storage, flipper_file_path, local_file_path, force)
+            scan = self.scan_local(storage, local_path, force)
+            try:
+                self.send_tree_to_storage(storage, flipper_path, local_path, force, verify, scan, listings)
+            finally:
+                scan.close()
         else:
-            self.send_file_to_storage(storage, flipper_path, local_path, force)
+            self.send_file_to_storage(storage, flipper_path, local_path, force, storage.stat(flipper_path), verify)
 
-    # make directory with exist check
+    # local tree to send, nothing is compared by hash with force
+    def scan_local(self, storage, local_path, force):
+        jobs = 0 if force else self.args.jobs
+        return LocalScan(local_path, storage.hash_local, jobs)
+
+    # hash files of a directory ahead that send_file_to_storage is going to compare by hash:
+    # the ones of the same size as on Flipper, unless the manifest knows their hash
+    def hash_ahead(self, scan, flipper_dir, dirpath, filenames, remote, verify):
+        for filename in filenames:
+            entry = remote.get(filename)
+            if entry is None or entry.is_dir:
+                continue
+            local_file_path = os.path.normpath(os.path.join(dirpath, filename))
+            try:
+                stat = os.stat(local_file_path)
+            except OSError:
+                continue
+            if stat.st_size != entry.size:
+                continue
+            if not verify and self.manifest and self.manifest.local_hash(posixpath.join(flipper_dir, filename), local_file_path, stat):
+                continue
+            scan.hash(local_file_path)
+
+    # send directories of scan, listings are remote listings taken ahead as {flipper path: {name: entry}}
+    def send_tree_to_storage(self, storage, flipper_path, local_path, force, verify, scan, listings):
+        for dirpath, dirnames, filenames in scan:
+            self.logger.debug(f'Processing directory "{os.path.normpath(dirpath)}"')
+            rel_path = os.path.relpath(dirpath, local_path)
+            flipper_dir = os.path.normpath(os.path.join(flipper_path, rel_path)).replace(os.sep, '/')
+            remote = listings.pop(flipper_dir, None)
+            if remote is None:
+                remote = self.list_on_storage(storage, flipper_dir)
+            if not force:
+                self.hash_ahead(scan, flipper_dir, dirpath, filenames, remote, verify)
+
+            # create subdirs
+            for dirname in dirnames:
+                flipper_dir_path = os.path.join(flipper_path, rel_path, dirname)
+                flipper_dir_path = os.path.normpath(flipper_dir_path).replace(os.sep, '/')
+                entry = remote.get(dirname)
+                if entry is None:
+                    self.logger.debug(f'"{flipper_dir_path}" not exist, creating')
+                    if self.args.dry_run or storage.mkdir(flipper_dir_path):
+                        listings[flipper_dir_path] = {}
+                    else:
+                        self.logger.error(f'Error: {storage.last_error}')
+                elif entry.is_dir:
+                    self.logger.debug(f'"{flipper_dir_path}" already exist')
+                else:
+                    self.logger.error(f'Error: "{flipper_dir_path}" is a file')
+
+            # send files
+            for filename in filenames:
+                flipper_file_path = os.path.join(flipper_path, rel_path, filename)
+                flipper_file_path = os.path.normpath(flipper_file_path).replace(os.sep, '/')
+                local_file_path = os.path.normpath(os.path.join(dirpath, filename))
+                self.send_file_to_storage(storage, flipper_file_path, local_file_path, force, remote.get(filename), verify)
+
+    # list directory as {name: entry}, empty if it does not exist
+    def list_on_storage(self, storage, flipper_dir_path):
+        entries = storage.scandir(flipper_dir_path)
+        if entries is None:
+            self.logger.error(f'Error: {storage.last_error}')
+            return {}
+        return {entry.name: entry for entry in entries}
+
+    # make directory with exist check, returns its listing
     def mkdir_on_storage(self, storage, flipper_dir_path):
-        if not storage.exist_dir(flipper_dir_path):
+        entries = storage.scandir(flipper_dir_path)
+        if entries is None:
             self.logger.debug(f'"{flipper_dir_path}" not exist, creating')
-            if not storage.mkdir(flipper_dir_path):
+            if not self.args.dry_run and not storage.mkdir(flipper_dir_path):
                 self.logger.error(f'Error: {storage.last_error}')
+            return {}
         else:
             self.logger.debug(f'"{flipper_dir_path}" already exist')
+            return {entry.name: entry for entry in entries}
 
-    # send file with exist check and hash check
-    def send_file_to_storage(self, storage, flipper_file_path, local_file_path, force):
-        if not storage.exist_file(flipper_file_path):
+    # send file with exist check, size check and hash check
+    # entry is the remote file as listed before, None if it does not exist
+    def send_file_to_storage(self, storage, flipper_file_path, local_file_path, force, entry, verify=False):
+        stat = os.stat(local_file_path)
+        if entry is None:
             self.logger.debug(f'"{flipper_file_path}" not exist, sending "{local_file_path}"')
-            self.logger.info(f'Sending "{local_file_path}" to "{flipper_file_path}"')
-            if not storage.send_file(local_file_path, flipper_file_path):
-                self.logger.error(f'Error: {storage.last_error}')
+            self.upload_to_storage(storage, flipper_file_path, local_file_path, stat)
+        elif entry.is_dir:
+            self.logger.error(f'Error: "{flipper_file_path}" is a directory')
         elif force:
             self.logger.debug(f'"{flipper_file_path}" exist, but will be overwritten by "{local_file_path}"')
-            self.logger.info(f'Sending "{local_file_path}" to "{flipper_file_path}"')
-            if not storage.send_file(local_file_path, flipper_file_path):
-                self.logger.error(f'Error: {storage.last_error}')
+            self.upload_to_storage(storage, flipper_file_path, local_file_path, stat)
+        elif not verify and self.manifest and self.manifest.unchanged(flipper_file_path, local_file_path, stat, entry.size):
+            self.logger.debug(f'"{flipper_file_path}" and "{local_file_path}" unchanged since last sync')
+            self.skipped += 1
+        elif self.delta and 0 < entry.size < stat.st_size:
+            self.logger.debug(f'"{flipper_file_path}" is shorter than "{local_file_path}", appending if it is a prefix')
+            self.upload_to_storage(storage, flipper_file_path, local_file_path, stat, True, stat.st_size - entry.size)
+        elif entry.size != stat.st_size:
+            self.logger.debug(f'"{flipper_file_path}" size differs from "{local_file_path}"')
+            self.upload_to_storage(storage, flipper_file_path, local_file_path, stat)
         else:
             self.logger.debug(f'"{flipper_file_path}" exist, compare hash with "{local_file_path}"')
-            hash_local = storage.hash_local(local_file_path)
+            hash_local = None
+            if not verify and self.manifest:
+                hash_local = self.manifest.local_hash(flipper_file_path, local_file_path, stat)
+            if not hash_local:
+                hash_local = storage.hash_local(local_file_path)
             hash_flipper = storage.hash_flipper(flipper_file_path)
 
             if not hash_flipper:
@@ -177,14 +673,99 @@ class Main:
 
             if hash_local == hash_flipper:
                 self.logger.debug(f'"{flipper_file_path}" are equal to "{local_file_path}"')
+                self.skipped += 1
+                if self.manifest:
+                    self.manifest.confirm(flipper_file_path, local_file_path, stat, hash_local, entry.size, hash_flipper)
             else:
                 self.logger.debug(f'"{flipper_file_path}" are not equal to "{local_file_path}"')
-                self.logger.info(f'Sending "{local_file_path}" to "{flipper_file_path}"')
-                if not storage.send_file(local_file_path, flipper_file_path):
-                    self.logger.error(f'Error: {storage.last_error}')
+                self.upload_to_storage(storage, flipper_file_path, local_file_path, stat)
+
+    # send file and record the result in manifest, stat is taken before sending
+    # resume keeps what is on Flipper if it is a prefix of the local file and sends only the rest
+    # with self.plan set the file is put off, size is the number of bytes it should take to send
+    def upload_to_storage(self, storage, flipper_file_path, local_file_path, stat, resume=False, size=None):
+        if self.plan is not None:
+            self.logger.debug(f'Planning to send "{local_file_path}" to "{flipper_file_path}"')
+            size = stat.st_size if size is None else size
+            self.plan.add(flipper_file_path, size, (flipper_file_path, local_file_path, stat, resume))
+            return
+        self.logger.info(f'Sending "{local_file_path}" to "{flipper_file_path}"')
+        self.send_planned(storage, flipper_file_path, local_file_path, stat, resume)
+
+    # send file now, arguments as for upload_to_storage
+    def send_planned(self, storage, flipper_file_path, local_file_path, stat, resume=False):
+        if not storage.send_file(local_file_path, flipper_file_path, resume=resume):
+            self.logger.error(f'Error: {storage.last_error}')
+            if self.manifest:
+                self.manifest.forget(flipper_file_path)
+            return
+        self.uploaded(storage, flipper_file_path, local_file_path, stat)
+
+    # send files put off by upload_to_storage, ordered by --order and --priority
+    # with --bundle new files go in batches of send_files, no transfer is started that should end after the deadline
+    def run_plan(self, storage):
+        plan = self.plan
+        self.plan = None
+        items = plan.ordered(self.args.order, self.args.priority)
+        left = plan.size()
+        if not items:
+            self.logger.debug('Nothing to send')
+            return
+        self.logger.info(f'{len(items)} files, {left} bytes to send, about {plan.estimate(left, len(items)):.1f} s')
+        if self.args.dry_run:
+            for flipper_file_path, size, (_, local_file_path, stat, resume) in items:
+                action = 'Appending' if resume else 'Sending'
+                self.logger.info(f'{action} "{local_file_path}" to "{flipper_file_path}", {size} bytes')
+            return
+
+        index = 0
+        while index < len(items):
+            batch = items[index:index + 1]
+            if self.args.bundle and not batch[0][2][3]:
+                for item in items[index + 1:index + self.BUNDLE_FILES]:
+                    if item[2][3]:
+                        break
+                    batch.append(item)
+            batch_size = sum(item[1] for item in batch)
+            if self.deadline is not None and time.monotonic() + plan.estimate(batch_size, len(batch)) > self.deadline:
+                self.logger.info(f'Time budget reached, {len(items) - index} files, {left} bytes not sent')
+                break
+
+            eta = plan.estimate(left, len(items) - index)
+            for number, (flipper_file_path, size, (_, local_file_path, stat, resume)) in enumerate(batch, index + 1):
+                action = 'Appending' if resume else 'Sending'
+                self.logger.info(f'{action} "{local_file_path}" to "{flipper_file_path}" ({number} of {len(items)}, about {eta:.1f} s left)')
+            start = time.monotonic()
+            if len(batch) == 1:
+                self.send_planned(storage, *batch[0][2])
+            else:
+                self.send_bundle(storage, [item for path, size, item in batch])
+            plan.done(batch_size, time.monotonic() - start, len(batch))
+            left -= batch_size
+            index += len(batch)
+        plan.save()
+
+    # send files as (flipper path, local path, stat, resume) with send_files
+    def send_bundle(self, storage, bundle):
+        self.logger.debug(f'Sending {len(bundle)} files together')
+        failed = set(storage.send_files([(local_file_path, flipper_file_path) for flipper_file_path, local_file_path, stat, resume in bundle]))
+        for flipper_file_path, local_file_path, stat, resume in bundle:
+            if flipper_file_path in failed:
+                self.logger.error(f'Error: "{flipper_file_path}" not sent, {storage.last_error}')
+                if self.manifest:
+                    self.manifest.forget(flipper_file_path)
+            else:
+                self.uploaded(storage, flipper_file_path, local_file_path, stat)
+
+    # count file sent and record it in manifest
+    def uploaded(self, storage, flipper_file_path, local_file_path, stat):
+        self.files += 1
+        if self.manifest:
+            hash_local = storage.hash_local(local_file_path)
+            self.manifest.confirm(flipper_file_path, local_file_path, stat, hash_local, stat.st_size, hash_local)
 
     def read(self):
-        storage = FlipperStorage(self.args.port)
+        storage = self.new_storage()
         storage.start()
         self.logger.debug(f'Reading "{self.args.flipper_path}"')
         data = storage.read_file(self.args.flipper_path)
@@ -200,7 +781,7 @@ class Main:
         storage.stop()
 
     def size(self):
-        storage = FlipperStorage(self.args.port)
+        storage = self.new_storage()
         storage.start()
         self.logger.debug(f'Getting size of "{self.args.flipper_path}"')
         size = storage.size(self.args.flipper_path)
@@ -211,10 +792,19 @@ class Main:
         storage.stop()
 
     def list(self):
-        storage = FlipperStorage(self.args.port)
+        storage = self.new_storage()
         storage.start()
         self.logger.debug(f'Listing "{self.args.flipper_path}"')
-        storage.list_tree(self.args.flipper_path)
+        order = 'bfs' if self.args.bfs else 'dfs'
+        if self.args.json:
+            for entry in storage.traverse(self.args.flipper_path, order, self.args.depth, self.args.pattern):
+                record = {'path': entry.path, 'type': 'dir' if entry.is_dir else 'file', 'size': entry.size, 'depth': entry.depth}
+                print(json.dumps(record), flush=True)
+        else:
+            for line in storage.list_tree(self.args.flipper_path, order, self.args.depth, self.args.pattern):
+                print(line)
+        if storage.last_error:
+            self.logger.error(f'Error: {storage.last_error}')
         storage.stop()
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flipper_storage_lib import FlipperStorage
+from flipper_storage_emulator import EmulatedSerial, MemoryTree
+from storage import Main
+
+
+# Started FlipperStorage on an emulated device, tree and EmulatedSerial options as for EmulatedSerial
+# Timeouts and retry delays are short, so broken links are noticed and retried quickly
+@pytest.fixture
+def connect():
+    opened = []
+
+    def connect(tree=None, **kwargs):
+        storage = FlipperStorage('emulator', EmulatedSerial(tree if tree is not None else MemoryTree(), **kwargs))
+        storage.port.timeout = 0.05
+        storage.read.timeout = 0.5
+        storage.retry_delay = 0.01
+        storage.start()
+        opened.append(storage)
+        return storage
+
+    yield connect
+    for storage in opened:
+        storage.stop()
+
+
+# Local file of random data, returns (path, data)
+@pytest.fixture
+def local_file(tmp_path):
+    def local_file(size, name='file.bin', data=None):
+        if data is None:
+            data = os.urandom(size)
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path), data
+
+    return local_file
+
+
+# Run storage.py in-process with argv, on an emulated device with "-p emu:DIR"
+# Caches go to a temporary directory, sessions are not used unless use_session is set. Returns the Main instance
+@pytest.fixture
+def storage_cli(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+    def storage_cli(*argv, use_session=False):
+        monkeypatch.setattr(sys, 'argv', ['storage.py'] + ([] if use_session else ['--no-session']) + list(argv))
+        main = Main()
+        try:
+            main()
+        finally:
+            if hasattr(main, 'handler'):
+                main.logger.removeHandler(main.handler)
+            main.logger.setLevel(logging.WARNING)
+        return main
+
+    return storage_cli
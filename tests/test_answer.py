@@ -0,0 +1,101 @@
+import pytest
+
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import Answer, StorageError, NotExistError, ExistError, ProtocolError
+
+
+def test_entries_non_ascii_names():
+    data = '[D] Документы\r\n[F] café.txt 12b\r\n[F] name with spaces.bin 3000b\r\n'.encode() + b'[F] bad\xff.bin 1b'
+    entries = list(Answer.entries('/ext/', data))
+    assert [(entry.name, entry.path, entry.is_dir, entry.size) for entry in entries] == [
+        ('Документы', '/ext/Документы', True, 0),
+        ('café.txt', '/ext/café.txt', False, 12),
+        ('name with spaces.bin', '/ext/name with spaces.bin', False, 3000),
+        ('bad\udcff.bin', '/ext/bad\udcff.bin', False, 1),
+    ]
+    # names that are not UTF-8 go back to the device as they came
+    assert Answer.encode(entries[3].name) == b'bad\xff.bin'
+
+
+def test_entries_empty():
+    assert list(Answer.entries('/ext', b'\tEmpty\r\n')) == []
+
+
+def test_entries_error():
+    with pytest.raises(NotExistError):
+        list(Answer.entries('/ext/missing', b'Storage error: file/dir not exist'))
+
+
+@pytest.mark.parametrize('line, cls', [
+    (b'Storage error: file/dir not exist', NotExistError),
+    (b'Storage error: file/dir already exist\r\n', ExistError),
+    (b'Storage error: internal error', StorageError),
+])
+def test_error_lines(line, cls):
+    error = Answer.error(line)
+    assert type(error) is cls
+    assert error.message == line.decode().split(': ', 1)[1].strip()
+    with pytest.raises(cls):
+        Answer.check(line)
+
+
+def test_error_not_ascii():
+    assert Answer.error('Storage error: ошибка'.encode()).message == 'ошибка'
+
+
+def test_no_error():
+    assert Answer.error(b'File, size: 10b') is None
+    assert Answer.check(b'Ready') == b'Ready'
+    assert Answer.find_error(b'Ready\r\n\r\n>: ') is None
+
+
+def test_find_error():
+    error = Answer.find_error(b'Ready\r\nStorage error: internal error\r\n\r\n>: ')
+    assert error.message == 'internal error'
+
+
+def test_stat():
+    assert Answer.stat('/ext/a', b'File, size: 42b').size == 42
+    assert Answer.stat('/ext/dir', b'Directory').is_dir
+    assert Answer.stat('/ext', b'Storage, 1000KiB total, 500KiB free').is_dir
+    with pytest.raises(ProtocolError):
+        Answer.stat('/ext/a', b'something else')
+
+
+def test_read_size():
+    assert Answer.read_size(b'Size: 1234') == 1234
+    with pytest.raises(NotExistError):
+        Answer.read_size(b'Storage error: file/dir not exist')
+    with pytest.raises(ProtocolError):
+        Answer.read_size(b'Size: twelve')
+
+
+def test_md5():
+    assert Answer.md5(b'D41D8CD98F00B204E9800998ECF8427E') == 'd41d8cd98f00b204e9800998ecf8427e'
+    with pytest.raises(ProtocolError):
+        Answer.md5(b'not a hash')
+
+
+def test_storage_non_ascii_names(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree)
+    path, data = local_file(1000)
+
+    assert storage.mkdir('/ext/Документы')
+    assert storage.send_file(path, '/ext/Документы/café.txt')
+    assert tree.read('/ext/Документы/café.txt') == data
+    storage.cache.invalidate()
+    assert [(entry.name, entry.size) for entry in storage.scandir('/ext/Документы')] == [('café.txt', 1000)]
+    assert bytes(storage.read_file('/ext/Документы/café.txt')) == data
+
+
+def test_storage_error_line(connect):
+    storage = connect()
+
+    assert not storage.mkdir('/ext/missing/dir')
+    assert isinstance(storage.last_exception, NotExistError)
+    assert storage.last_exception.command == 'mkdir'
+    assert storage.last_error == 'file/dir not exist'
+    assert storage.mkdir('/ext/dir')
+    assert not storage.mkdir('/ext/dir')
+    assert isinstance(storage.last_exception, ExistError)
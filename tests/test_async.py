@@ -0,0 +1,74 @@
+import asyncio
+import os
+
+import pytest
+
+from flipper_storage_async import AsyncFlipperStorage
+from flipper_storage_emulator import EmulatedSerial, MemoryTree
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+
+async def started(tree, **kwargs):
+    storage = AsyncFlipperStorage('emulator', EmulatedSerial(tree, **kwargs))
+    storage.timeout = 2
+    await storage.start()
+    return storage
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_round_trip(local_file, tmp_path, window):
+    tree = MemoryTree()
+    path, data = local_file(20000)
+    target = str(tmp_path / 'received.bin')
+
+    async def main():
+        storage = await started(tree)
+        assert await storage.send_file(path, '/ext/file.bin', window, 1024)
+        assert await storage.hash_flipper('/ext/file.bin') == await storage.hash_local(path)
+        assert await storage.receive_file('/ext/file.bin', target)
+        await storage.stop()
+
+    run(main())
+    assert tree.read('/ext/file.bin') == data
+    with open(target, 'rb') as file:
+        assert file.read() == data
+
+
+def test_send_error_offset(local_file):
+    path, data = local_file(5000)
+
+    async def main():
+        storage = await started(MemoryTree(), faults={'write_chunk': [3]})
+        storage.RESYNC_DELAY = 0.1
+        assert not await storage.send_file(path, '/ext/file.bin', 8, 512)
+        assert storage.last_error_offset == 1024
+        # the CLI is usable again
+        assert await storage.mkdir('/ext/dir')
+        await storage.stop()
+
+    run(main())
+
+
+def test_receive_missing_file(tmp_path):
+    async def main():
+        storage = await started(MemoryTree())
+        assert not await storage.receive_file('/ext/missing.bin', str(tmp_path / 'missing.bin'))
+        assert storage.last_error == 'file/dir not exist'
+        await storage.stop()
+
+    run(main())
+    assert os.listdir(tmp_path) == []
+
+
+def test_resync_at_end_of_stream():
+    async def main():
+        storage = await started(MemoryTree())
+        storage.reader.feed_eof()
+        with pytest.raises(asyncio.IncompleteReadError):
+            await storage.resync()
+        await storage.stop()
+
+    run(main())
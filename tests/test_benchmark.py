@@ -0,0 +1,27 @@
+from benchmark import Main, SyncRun
+from flipper_storage_emulator import MemoryTree
+
+
+def benchmark(*argv):
+    main = Main()
+    main.args = main.parser.parse_args(list(argv))
+    main.tree = MemoryTree()
+    return main
+
+
+def test_baudrate_reaches_emulated_port(tmp_path):
+    main = benchmark('--baudrate', '57600')
+    main.scratch = str(tmp_path)
+    storage = main.open_storage()
+    assert storage.port.baudrate == 57600
+    assert storage.port.throttle
+    storage.stop()
+    # storage.py commands of the sync group open their own ports
+    run = SyncRun(main, ['--no-session', '-p', 'emulator', 'mkdir', '-fp', '/ext/dir'])
+    assert run.new_port().baudrate == 57600
+
+
+def test_no_throttle_by_default():
+    storage = benchmark().open_storage()
+    assert not storage.port.throttle
+    storage.stop()
@@ -0,0 +1,74 @@
+import pytest
+
+from flipper_storage_lib import BufferedRead
+
+
+class Stream:
+    """
+    Serial-like stream handing out prepared blocks, like USB packets, then nothing
+    """
+    def __init__(self, *blocks):
+        self.blocks = [bytes(block) for block in blocks]
+
+    @property
+    def in_waiting(self):
+        return len(self.blocks[0]) if self.blocks else 0
+
+    def read(self, size=1):
+        if not self.blocks:
+            return b''
+        block = self.blocks.pop(0)
+        if size < len(block):
+            self.blocks.insert(0, block[size:])
+        return block[:size]
+
+    def readinto(self, view):
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+def test_until_across_blocks():
+    read = BufferedRead(Stream(b'first\r', b'\nsec', b'ond\r\n>: '))
+    assert read.until('\r\n') == b'first'
+    assert read.until('\r\n') == b'second'
+    assert read.until('>: ', cut_eol=False) == b'>: '
+
+
+def test_until_counts_received_bytes():
+    counts = []
+    read = BufferedRead(Stream(b'ab', b'c\n'), counts.append)
+    assert read.until() == b'abc'
+    assert sum(counts) == 4
+
+
+def test_readinto_takes_buffered_bytes_first():
+    read = BufferedRead(Stream(b'Size: 6\r\n123', b'456>: '))
+    assert read.until('\r\n') == b'Size: 6'
+    view = memoryview(bytearray(6))
+    assert read.readinto(view) == 6
+    assert bytes(view) == b'123456'
+    assert read.until('>: ') == b''
+
+
+def test_readinto_short_at_end_of_stream():
+    read = BufferedRead(Stream(b'12'))
+    view = memoryview(bytearray(4))
+    assert read.readinto(view) == 2
+
+
+def test_consumed_data_is_dropped():
+    lines = [b'line %d\n' % index for index in range(5000)]
+    read = BufferedRead(Stream(*lines))
+    longest = 0
+    for line in lines:
+        assert read.until() == line[:-1]
+        longest = max(longest, len(read.buffer))
+    assert longest < 2 * BufferedRead.COMPACT_SIZE + 64
+
+
+def test_timeout():
+    read = BufferedRead(Stream(b'no end'))
+    read.timeout = 0.01
+    with pytest.raises(TimeoutError):
+        read.until('\r\n')
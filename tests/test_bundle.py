@@ -0,0 +1,125 @@
+import os
+import time
+
+from flipper_storage_emulator import MemoryTree
+
+
+def test_send_files_with_faults(connect, local_file):
+    tree = MemoryTree()
+    # the first chunk of file0 fails, then the second chunk of file2 with more chunks in flight
+    storage = connect(tree, faults={'write_chunk': [1, 7]})
+    storage.mkdir('/ext/bundle')
+    storage.scandir('/ext/bundle')
+    files = [local_file(2000, 'file' + str(index)) for index in range(10)]
+
+    failed = storage.send_files([(path, '/ext/bundle/' + os.path.basename(path)) for path, data in files], 4, 512)
+    assert failed == []
+    assert storage.port.calls['write_chunk'] > 40
+    for path, data in files:
+        assert tree.read('/ext/bundle/' + os.path.basename(path)) == data
+
+
+def test_send_files_reports_failed(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree)
+    storage.mkdir('/ext/bundle')
+    first, first_data = local_file(100, 'first')
+    second, second_data = local_file(100, 'second')
+
+    failed = storage.send_files([(first, '/ext/bundle/first'), (second, '/ext/missing/second')], 4)
+    assert failed == ['/ext/missing/second']
+    assert tree.read('/ext/bundle/first') == first_data
+
+
+def test_send_files_never_runs_payload(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree, faults={'write_chunk': [1]})
+    storage.mkdir('/ext/important')
+    storage.mkdir('/ext/bundle')
+    storage.scandir('/ext/bundle')
+    path, data = local_file(0, data=b'storage remove "/ext/important"\r')
+
+    assert storage.send_files([(path, '/ext/bundle/file.bin')], 4) == []
+    assert tree.stat('/ext/important') == ('dir', 0)
+    assert tree.read('/ext/bundle/file.bin') == data
+
+
+# the command of a file's first chunk goes out while the chunks before it are in flight
+def test_send_files_faster_than_send_file(connect, local_file):
+    files = [local_file(300, 'file' + str(index)) for index in range(40)]
+    took = {}
+    for pipelined in (False, True):
+        tree = MemoryTree()
+        storage = connect(tree, link_latency=0.005)
+        storage.mkdir('/ext/bundle')
+        storage.scandir('/ext/bundle')
+        start = time.monotonic()
+        if pipelined:
+            assert storage.send_files([(path, '/ext/bundle/' + os.path.basename(path)) for path, data in files], 4) == []
+        else:
+            for path, data in files:
+                assert storage.send_file(path, '/ext/bundle/' + os.path.basename(path), 4)
+        took[pipelined] = time.monotonic() - start
+        for path, data in files:
+            assert tree.read('/ext/bundle/' + os.path.basename(path)) == data
+    # about two round trips per file one by one, one pipelined
+    assert took[True] < took[False] * 0.75
+
+
+def test_send_files_fills_held_command(connect, local_file):
+    tree = MemoryTree()
+    # the third chunk of file0 fails while the command of file1 waits for its answer, its payload
+    # goes to the CLI as empty lines and file1 gets "Ready", resync must not be taken as its payload
+    storage = connect(tree, faults={'write_chunk': [3]})
+    storage.mkdir('/ext/bundle')
+    storage.scandir('/ext/bundle')
+    files = [local_file(2000, 'file' + str(index), b'\r' * 2000) for index in range(4)]
+
+    assert storage.send_files([(path, '/ext/bundle/' + os.path.basename(path)) for path, data in files], 4, 512) == []
+    for path, data in files:
+        assert tree.read('/ext/bundle/' + os.path.basename(path)) == data
+    assert storage.mkdir('/ext/dir')
+
+
+def test_receive_files_with_faults(connect, tmp_path):
+    tree = MemoryTree()
+    tree.mkdir('/ext/bundle')
+    files = {}
+    for index in range(10):
+        files['/ext/bundle/file' + str(index)] = os.urandom(200 * index + 1)
+        tree.append('/ext/bundle/file' + str(index), files['/ext/bundle/file' + str(index)])
+    # files up to 512 bytes are read pipelined, the second of them fails with more in flight
+    storage = connect(tree, faults={'read_chunks': [2]})
+    listed = [(path, str(tmp_path / os.path.basename(path)), len(data)) for path, data in files.items()]
+    listed.append(('/ext/bundle/missing', str(tmp_path / 'missing'), 10))
+
+    failed = storage.receive_files(listed, 4, 512, verify=True)
+    assert failed == ['/ext/bundle/missing']
+    assert storage.port.calls['read_chunks'] > 11
+    for path, data in files.items():
+        with open(tmp_path / os.path.basename(path), 'rb') as file:
+            assert file.read() == data
+    assert not os.path.exists(tmp_path / 'missing')
+
+
+def test_storage_send_and_receive_bundle(tmp_path, storage_cli):
+    device = tmp_path / 'device'
+    (device / 'ext').mkdir(parents=True)
+    local = tmp_path / 'local'
+    files = {}
+    for index in range(30):
+        path = local / ('dir' + str(index % 3)) / ('file' + str(index))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        files[path.relative_to(local).as_posix()] = os.urandom(100 + index * 50)
+        path.write_bytes(files[path.relative_to(local).as_posix()])
+
+    main = storage_cli('-p', 'emu:' + str(device), 'send', '-fp', '/ext/sent', '-lp', str(local), '-b', '-w', '4')
+    assert main.files == 30
+    for name, data in files.items():
+        assert (device / 'ext' / 'sent' / name).read_bytes() == data
+
+    received = tmp_path / 'received'
+    main = storage_cli('-p', 'emu:' + str(device), 'receive', '-fp', '/ext/sent', '-lp', str(received), '-b')
+    assert main.files == 30
+    for name, data in files.items():
+        assert (received / name).read_bytes() == data
@@ -0,0 +1,118 @@
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import MetadataCache, StorageEntry
+
+
+def entry(path, is_dir=False, size=0):
+    return StorageEntry(path.rsplit('/', 1)[-1], path, is_dir, size)
+
+
+def test_lookup_put():
+    cache = MetadataCache()
+    assert cache.lookup('/ext/a') == (False, None)
+    cache.put('/ext/a', entry('/ext/a', size=10))
+    known, found = cache.lookup('/ext/a/')
+    assert known and found.size == 10
+    cache.put('/ext/b', None)
+    assert cache.lookup('/ext/b') == (True, None)
+
+
+def test_listed_directory_knows_missing_paths():
+    cache = MetadataCache()
+    cache.listed('/ext/dir', [entry('/ext/dir/a'), entry('/ext/dir/sub', True)])
+    assert cache.lookup('/ext/dir')[1].is_dir
+    assert cache.lookup('/ext/dir/a')[0]
+    assert cache.lookup('/ext/dir/missing') == (True, None)
+    # nothing is known below a directory that was not listed
+    assert cache.lookup('/ext/dir/sub/a') == (False, None)
+
+
+def test_listing_again_drops_gone_entries():
+    cache = MetadataCache()
+    cache.listed('/ext/dir', [entry('/ext/dir/a'), entry('/ext/dir/sub', True)])
+    cache.listed('/ext/dir/sub', [entry('/ext/dir/sub/b')])
+    cache.listed('/ext/dir', [entry('/ext/dir/a')])
+    assert cache.lookup('/ext/dir/sub') == (True, None)
+    assert cache.lookup('/ext/dir/sub/b') == (False, None)
+
+
+def test_removed():
+    cache = MetadataCache()
+    cache.listed('/ext/dir', [entry('/ext/dir/a')])
+    cache.removed('/ext/dir')
+    assert cache.lookup('/ext/dir') == (True, None)
+    assert cache.lookup('/ext/dir/a') == (False, None)
+
+
+def test_invalidate_path():
+    cache = MetadataCache()
+    cache.listed('/ext/dir', [entry('/ext/dir/a'), entry('/ext/dir/sub', True)])
+    cache.listed('/ext/dir/sub', [entry('/ext/dir/sub/b')])
+    cache.invalidate('/ext/dir/sub')
+    assert cache.lookup('/ext/dir/sub') == (False, None)
+    assert cache.lookup('/ext/dir/sub/b') == (False, None)
+    # the listing of its parent is not complete any more
+    assert cache.lookup('/ext/dir/missing') == (False, None)
+    assert cache.lookup('/ext/dir/a')[0]
+
+
+def test_invalidate_all():
+    cache = MetadataCache()
+    cache.listed('/ext/dir', [entry('/ext/dir/a')])
+    cache.invalidate()
+    assert cache.lookup('/ext/dir') == (False, None)
+    assert cache.lookup('/ext/dir/a') == (False, None)
+    assert cache.lookup('/ext/dir/missing') == (False, None)
+
+
+def test_eviction_breaks_listing():
+    cache = MetadataCache(3)
+    cache.listed('/ext/dir', [entry('/ext/dir/a'), entry('/ext/dir/b')])
+    cache.put('/int/x', None)
+    assert cache.lookup('/ext/dir/missing') == (False, None)
+    assert len(cache.entries) == 3
+
+
+def test_disabled():
+    cache = MetadataCache(0)
+    cache.listed('/ext/dir', [entry('/ext/dir/a')])
+    cache.put('/ext/b', None)
+    assert cache.lookup('/ext/dir/a') == (False, None)
+    assert cache.lookup('/ext/dir/missing') == (False, None)
+    assert cache.lookup('/ext/b') == (False, None)
+
+
+def test_storage_answers_stat_from_listing(connect):
+    tree = MemoryTree()
+    tree.mkdir('/ext/dir')
+    tree.append('/ext/dir/a', b'12345')
+    storage = connect(tree)
+
+    storage.scandir('/ext/dir')
+    assert storage.size('/ext/dir/a') == 5
+    assert not storage.exist('/ext/dir/missing')
+    assert 'stat' not in storage.port.calls
+
+
+def test_storage_changes_update_cache(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree)
+    path, data = local_file(100)
+
+    assert storage.mkdir('/ext/dir')
+    assert storage.send_file(path, '/ext/dir/a')
+    assert storage.size('/ext/dir/a') == 100
+    assert storage.remove('/ext/dir/a')
+    assert not storage.exist('/ext/dir/a')
+    assert 'stat' not in storage.port.calls
+
+
+def test_storage_invalidate_sees_device_changes(connect):
+    tree = MemoryTree()
+    tree.mkdir('/ext/dir')
+    storage = connect(tree)
+
+    storage.scandir('/ext/dir')
+    tree.append('/ext/dir/a', b'123')
+    assert not storage.exist('/ext/dir/a')
+    storage.cache.invalidate('/ext/dir')
+    assert storage.size('/ext/dir/a') == 3
@@ -0,0 +1,77 @@
+import argparse
+
+import pytest
+
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import ChunkTuner
+from storage import chunk_size as chunk_size_argument
+
+
+@pytest.mark.parametrize('chunk_size', [1, 64, 8192, 100000])
+def test_chunk_size_is_clamped(connect, local_file, chunk_size):
+    tree = MemoryTree()
+    storage = connect(tree)
+    path, data = local_file(10000)
+
+    assert storage.send_file(path, '/ext/file.bin', 4, chunk_size)
+    assert tree.read('/ext/file.bin') == data
+    assert bytes(storage.read_file('/ext/file.bin', chunk_size)) == data
+
+
+def test_chunk_size_argument():
+    assert chunk_size_argument('100000') == 100000
+    for text in ('0', '-1'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            chunk_size_argument(text)
+
+
+# feed SAMPLE_CHUNKS chunks of the tuner's size at rate bytes per second
+def sample(tuner, rate):
+    for _ in range(ChunkTuner.SAMPLE_CHUNKS):
+        tuner.update(tuner.size, tuner.size, tuner.size / rate)
+
+
+def test_tuner_grows_while_it_helps():
+    tuner = ChunkTuner(512, 64, 8192)
+    sample(tuner, 1000)
+    assert tuner.size == 1024
+    sample(tuner, 2000)
+    assert tuner.size == 2048
+    # slower than at 1024, back to it
+    sample(tuner, 1500)
+    assert tuner.size == 1024 and tuner.settled
+
+
+def test_tuner_stops_at_maximum():
+    tuner = ChunkTuner(4096, 64, 8192)
+    sample(tuner, 1000)
+    sample(tuner, 2000)
+    assert tuner.size == 8192 and tuner.settled
+
+
+def test_tuner_shrinks_when_link_gets_worse():
+    tuner = ChunkTuner(512, 64, 8192)
+    sample(tuner, 1000)
+    sample(tuner, 500)
+    assert tuner.size == 512 and tuner.settled
+    sample(tuner, 100)
+    assert tuner.size == 256 and not tuner.settled
+
+
+def test_tuner_ignores_other_sizes():
+    tuner = ChunkTuner(512, 64, 8192)
+    for _ in range(ChunkTuner.SAMPLE_CHUNKS):
+        tuner.update(256, 256, 0.001)
+    assert tuner.size == 512
+
+
+def test_adaptive_round_trip(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree)
+    storage.adaptive = True
+    path, data = local_file(100000)
+
+    assert storage.send_file(path, '/ext/file.bin', 4)
+    assert tree.read('/ext/file.bin') == data
+    assert bytes(storage.read_file('/ext/file.bin')) == data
+    assert sorted(storage.tuners) == [('emulator', 'read'), ('emulator', 'write')]
@@ -0,0 +1,120 @@
+import time
+
+import pytest
+from serial.serialutil import SerialException
+
+from flipper_storage_emulator import EmulatedSerial, MemoryTree, DirectoryTree
+
+PROMPT = b'\r\n>: '
+
+
+# Open port with the prompt read
+def opened(tree=None, **kwargs):
+    port = EmulatedSerial(tree if tree is not None else MemoryTree(), **kwargs)
+    port.timeout = 0.5
+    port.open()
+    port.write(b'\x01')
+    assert read_until(port, PROMPT) == PROMPT
+    return port
+
+
+def read_until(port, end):
+    data = b''
+    while not data.endswith(end):
+        byte = port.read(1)
+        assert byte, data
+        data += byte
+    return data
+
+
+# Answer to a command line, without its echo and the prompt
+def command(port, line):
+    port.write(line.encode() + b'\r')
+    answer = read_until(port, PROMPT)
+    echo = line.encode() + b'\r\n'
+    assert answer.startswith(echo)
+    return answer[len(echo):-len(PROMPT)]
+
+
+def test_commands():
+    port = opened()
+    assert command(port, 'storage mkdir "/ext/dir"') == b''
+    assert command(port, 'storage mkdir "/ext/dir"') == b'Storage error: file/dir already exist\r\n'
+    assert command(port, 'storage stat "/ext/dir"') == b'Directory\r\n'
+    assert command(port, 'storage stat "/ext/missing"') == b'Storage error: file/dir not exist\r\n'
+    assert command(port, 'storage list "/ext"') == b'\t[D] dir\r\n'
+    assert command(port, 'storage remove "/ext/dir"') == b''
+    assert command(port, 'storage list "/ext"') == b'Empty\r\n'
+    assert command(port, 'help') == b'Command not found\r\n'
+    assert port.calls == {'mkdir': 2, 'stat': 2, 'list': 2, 'remove': 1}
+
+
+def test_write_chunk_waits_for_payload():
+    tree = MemoryTree()
+    port = opened(tree)
+    port.write(b'storage write_chunk "/ext/file" 5\r')
+    assert read_until(port, b'Ready\r\n').endswith(b'\r\nReady\r\n')
+    assert port.in_waiting == 0
+    # a carriage return in the payload is data, not the end of a command
+    port.write(b'ab\rcd')
+    assert read_until(port, PROMPT) == PROMPT
+    assert tree.read('/ext/file') == b'ab\rcd'
+
+
+def test_read_chunks_waits_for_confirmation():
+    tree = MemoryTree()
+    tree.append('/ext/file', b'0123456789')
+    port = opened(tree)
+    port.write(b'storage read_chunks "/ext/file" 4\r')
+    assert read_until(port, b'Size: 10\r\n').endswith(b'Size: 10\r\n')
+    chunks = []
+    for size in (4, 4, 2):
+        assert read_until(port, b'\r\nReady?\r\n') == b'\r\nReady?\r\n'
+        port.write(b'y')
+        chunks.append(port.read(size))
+    assert read_until(port, PROMPT).endswith(PROMPT)
+    assert b''.join(chunks) == b'0123456789'
+
+
+def test_faults():
+    port = opened(faults={'mkdir': [2]})
+    assert command(port, 'storage mkdir "/ext/a"') == b''
+    assert command(port, 'storage mkdir "/ext/b"') == b'Storage error: internal error\r\n'
+    assert command(port, 'storage mkdir "/ext/b"') == b''
+
+
+def test_disconnect():
+    port = opened(disconnect_after=10)
+    with pytest.raises(SerialException):
+        port.write(b'storage mkdir "/ext/a"\r')
+    with pytest.raises(SerialException):
+        port.read(1)
+
+
+def test_stall_until_reopened():
+    port = opened()
+    port.stall_after = port.written + 5
+    port.write(b'storage mkdir "/ext/a"\r')
+    # the echo of what got through, nothing after it
+    assert port.read(100) == b'stora'
+    port.close()
+    port.open()
+    assert command(port, 'storage mkdir "/ext/a"') == b''
+
+
+def test_command_latency():
+    port = opened(command_latency=0.05)
+    start = time.monotonic()
+    command(port, 'storage stat "/ext"')
+    assert time.monotonic() - start >= 0.05
+
+
+def test_directory_tree(tmp_path):
+    port = opened(DirectoryTree(str(tmp_path)))
+    assert command(port, 'storage mkdir "/ext/dir"') == b''
+    port.write(b'storage write_chunk "/ext/dir/file" 3\r')
+    read_until(port, b'Ready\r\n')
+    port.write(b'abc')
+    read_until(port, PROMPT)
+    assert (tmp_path / 'ext' / 'dir' / 'file').read_bytes() == b'abc'
+    assert command(port, 'storage remove "/ext/dir"') == b'Storage error: access denied\r\n'
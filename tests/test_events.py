@@ -0,0 +1,75 @@
+import logging
+
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import EventSink, LogSink, MetricsSink, MultiSink
+
+
+class Recorder(EventSink):
+    def __init__(self):
+        self.events = []
+
+    def command_done(self, command, path, seconds, ok):
+        self.events.append(('done', command, path, ok))
+
+    def progress(self, path, done, total):
+        self.events.append(('progress', path, done, total))
+
+    def retry(self, command, path, reason):
+        self.events.append(('retry', command, path))
+
+    def error(self, command, path, message):
+        self.events.append(('error', command, path))
+
+
+def test_metrics_counts_transfers(connect, local_file):
+    storage = connect(MemoryTree())
+    metrics = MetricsSink()
+    storage.events = metrics
+    path, data = local_file(3000)
+
+    assert storage.send_file(path, '/ext/file.bin', 1, 1024)
+    assert bytes(storage.read_file('/ext/file.bin')) == data
+    assert metrics.counters['bytes_sent'] >= 3000
+    assert metrics.counters['bytes_received'] >= 3000
+    # the upload starts by removing a file that is not there yet
+    assert metrics.counters['errors'] == 1
+    assert metrics.latency['write_chunk']['count'] == 3
+    assert sum(metrics.latency['write_chunk']['buckets']) == 3
+
+
+def test_metrics_histogram_buckets():
+    metrics = MetricsSink()
+    metrics.command_done('stat', '/ext/a', 0.0005, True)
+    metrics.command_done('stat', '/ext/a', 0.003, True)
+    metrics.command_done('stat', '/ext/a', 10.0, False)
+    histogram = metrics.latency['stat']
+    assert histogram['count'] == 3
+    assert histogram['max_ms'] == 10000.0
+    assert histogram['buckets'][0] == 1
+    assert histogram['buckets'][metrics.BUCKETS.index(5)] == 1
+    assert histogram['buckets'][-1] == 1
+
+
+def test_progress_and_errors(connect, local_file):
+    storage = connect(MemoryTree())
+    recorder = Recorder()
+    metrics = MetricsSink()
+    storage.events = MultiSink(recorder, metrics)
+    path, data = local_file(2048)
+
+    assert storage.send_file(path, '/ext/ok.bin', 1, 1024)
+    assert [event for event in recorder.events if event[0] == 'progress'][-1] == ('progress', '/ext/ok.bin', 2048, 2048)
+    recorder.events.clear()
+    errors = metrics.counters['errors']
+    assert not storage.stat('/ext/missing.bin')
+    assert ('error', 'stat', '/ext/missing.bin') in recorder.events
+    assert metrics.counters['errors'] == errors + 1
+
+
+def test_log_sink(caplog):
+    sink = LogSink(logging.getLogger('test_events'))
+    with caplog.at_level(logging.DEBUG, logger='test_events'):
+        sink.command_done('stat', '/ext/a', 0.002, False)
+        sink.retry('write_chunk', '/ext/a', 'timeout')
+    assert 'stat "/ext/a" took 2.000 ms, failed' in caplog.text
+    assert 'write_chunk "/ext/a" retried: timeout' in caplog.text
@@ -0,0 +1,44 @@
+import os
+
+
+# Two emulated devices with the same paths and different data, yields their ports and data
+def devices(tmp_path):
+    ports = []
+    data = []
+    for index in range(2):
+        device = tmp_path / ('device' + str(index))
+        (device / 'ext' / 'dir').mkdir(parents=True)
+        data.append(os.urandom(1000 + index))
+        (device / 'ext' / 'dir' / 'a.bin').write_bytes(data[-1])
+        (device / 'ext' / 'one.txt').write_bytes(data[-1])
+        ports.append('emu:' + str(device))
+    return ports, data
+
+
+def test_receive_directory(tmp_path, storage_cli):
+    ports, data = devices(tmp_path)
+    local = tmp_path / 'local'
+
+    storage_cli('-p', ','.join(ports), 'receive', '-fp', '/ext/dir', '-lp', str(local))
+    received = sorted((local / name / 'a.bin').read_bytes() for name in os.listdir(local))
+    assert received == sorted(data)
+
+
+def test_receive_file(tmp_path, storage_cli):
+    ports, data = devices(tmp_path)
+
+    storage_cli('-p', ','.join(ports), 'receive', '-fp', '/ext/one.txt', '-lp', str(tmp_path / 'one.txt'))
+    received = [path for path in os.listdir(tmp_path) if path.startswith('one.')]
+    assert len(received) == 2 and all(path.endswith('.txt') for path in received)
+    assert sorted((tmp_path / path).read_bytes() for path in received) == sorted(data)
+
+
+def test_send(tmp_path, storage_cli):
+    ports, data = devices(tmp_path)
+    local = tmp_path / 'local'
+    (local / 'sub').mkdir(parents=True)
+    (local / 'sub' / 'b.bin').write_bytes(b'b' * 3000)
+
+    storage_cli('-p', ','.join(ports), 'send', '-fp', '/ext/sent', '-lp', str(local))
+    for port in ports:
+        assert (tmp_path / port[len('emu:'):] / 'ext' / 'sent' / 'sub' / 'b.bin').read_bytes() == b'b' * 3000
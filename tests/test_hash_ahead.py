@@ -0,0 +1,93 @@
+import os
+import threading
+
+from flipper_storage_lib import StorageEntry, SyncManifest
+from storage import Main, LocalScan
+
+
+class Scan:
+    """
+    Stand-in for LocalScan, records the files passed to hash()
+    """
+    def __init__(self):
+        self.hashed = []
+
+    def hash(self, path):
+        self.hashed.append(os.path.basename(path))
+
+
+def write(root, files):
+    for path, data in files.items():
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), 'wb') as file:
+            file.write(data)
+
+
+def test_local_scan_order(tmp_path):
+    write(tmp_path, {'b/2': b'', 'a/1': b'', 'a/c/3': b'', 'top': b''})
+    scan = LocalScan(str(tmp_path), None)
+    assert [(os.path.relpath(dirpath, tmp_path), dirnames, filenames) for dirpath, dirnames, filenames in scan] == [
+        ('.', ['a', 'b'], ['top']),
+        ('a', ['c'], ['1']),
+        (os.path.join('a', 'c'), [], ['3']),
+        ('b', [], ['2']),
+    ]
+    scan.close()
+
+
+def test_local_scan_hashes_in_threads(tmp_path):
+    write(tmp_path, {str(index): b'x' for index in range(20)})
+    threads = set()
+    hashed = []
+    done = threading.Event()
+
+    def hash_local(path):
+        threads.add(threading.current_thread())
+        hashed.append(path)
+        if len(hashed) == 20:
+            done.set()
+
+    scan = LocalScan(str(tmp_path), hash_local, 2)
+    for dirpath, dirnames, filenames in scan:
+        for filename in filenames:
+            scan.hash(os.path.join(dirpath, filename))
+    assert done.wait(5)
+    scan.close()
+    assert threading.current_thread() not in threads
+
+
+def test_hash_ahead_only_files_compared_by_hash(tmp_path):
+    write(tmp_path, {'same': b'1234', 'other': b'12', 'new': b'1', 'dir': b'', 'known': b'5678'})
+    remote = {
+        'same': StorageEntry('same', '/ext/same', False, 4),
+        'other': StorageEntry('other', '/ext/other', False, 4),
+        'dir': StorageEntry('dir', '/ext/dir', True),
+        'known': StorageEntry('known', '/ext/known', False, 4),
+    }
+    filenames = ['dir', 'known', 'new', 'other', 'same']
+    main = Main()
+    main.manifest = SyncManifest(str(tmp_path / 'manifest.json'))
+    path = str(tmp_path / 'known')
+    main.manifest.confirm('/ext/known', path, os.stat(path), 'hash', 4, 'hash')
+
+    scan = Scan()
+    main.hash_ahead(scan, '/ext', str(tmp_path), filenames, remote, False)
+    assert scan.hashed == ['same']
+
+    # verify does not trust the manifest
+    scan = Scan()
+    main.hash_ahead(scan, '/ext', str(tmp_path), filenames, remote, True)
+    assert scan.hashed == ['known', 'same']
+
+
+def test_send_hashes_ahead(tmp_path, storage_cli):
+    device = tmp_path / 'device'
+    local = tmp_path / 'local'
+    files = {'dir' + str(index % 4) + '/file' + str(index): os.urandom(1000 + index) for index in range(40)}
+    write(local, files)
+    send = ('-p', 'emu:' + str(device), 'send', '-fp', '/ext/sent', '-lp', str(local), '--no-manifest')
+
+    assert storage_cli(*send, '-j', '0').files == 40
+    for jobs in ('0', '4'):
+        main = storage_cli(*send, '-j', jobs)
+        assert (main.files, main.skipped) == (0, 40)
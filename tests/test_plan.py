@@ -0,0 +1,86 @@
+import logging
+import os
+import re
+
+import pytest
+
+from flipper_storage_lib import TransferPlan
+
+
+def plan(*sizes):
+    plan = TransferPlan()
+    for index, size in enumerate(sizes):
+        plan.add('/ext/' + ('file%d.bin' % index), size, index)
+    return plan
+
+
+def test_ordered():
+    job = plan(300, 100, 200)
+    assert [item for path, size, item in job.ordered()] == [0, 1, 2]
+    assert [item for path, size, item in job.ordered('small-first')] == [1, 2, 0]
+    assert [item for path, size, item in job.ordered('large-first')] == [0, 2, 1]
+    with pytest.raises(ValueError):
+        job.ordered('random')
+
+
+def test_priority_goes_first():
+    job = plan(300, 100, 200)
+    assert [item for path, size, item in job.ordered('small-first', ['file2.bin'])] == [2, 1, 0]
+    assert [item for path, size, item in job.ordered('walk', ['/ext/file1*', 'file0*'])] == [1, 0, 2]
+
+
+def test_estimate_follows_measurements(tmp_path):
+    job = TransferPlan(str(tmp_path / 'rate.json'))
+    assert job.estimate(TransferPlan.RATE, 1) == pytest.approx(1 + TransferPlan.FILE_TIME)
+    # files take twice as long as predicted
+    job.done(TransferPlan.RATE, 2 * (1 + TransferPlan.FILE_TIME))
+    assert job.estimate(TransferPlan.RATE, 1) == pytest.approx(2 * (1 + TransferPlan.FILE_TIME))
+    job.save()
+
+    # the next job on the port starts from the measured rate
+    assert TransferPlan(str(tmp_path / 'rate.json')).estimate(TransferPlan.RATE, 1) == pytest.approx(2 * (1 + TransferPlan.FILE_TIME))
+
+
+def send_tree(tmp_path):
+    device = tmp_path / 'device'
+    local = tmp_path / 'local'
+    local.mkdir()
+    for name, size in (('big.bin', 3000), ('small.bin', 100), ('middle.bin', 1000)):
+        (local / name).write_bytes(os.urandom(size))
+    return ('-p', 'emu:' + str(device), 'send', '-fp', '/ext/sent', '-lp', str(local)), device
+
+
+def sent(caplog):
+    return [re.search(r'"([^"]+)" to', record.getMessage()).group(1).rsplit(os.sep, 1)[-1]
+            for record in caplog.records if record.getMessage().startswith(('Sending "', 'Appending "'))]
+
+
+def test_send_order(tmp_path, storage_cli, caplog):
+    send, device = send_tree(tmp_path)
+    caplog.set_level(logging.INFO)
+
+    storage_cli(*send, '--order', 'small-first', '--priority', 'big.bin')
+    assert sent(caplog) == ['big.bin', 'small.bin', 'middle.bin']
+    assert sorted(os.listdir(device / 'ext' / 'sent')) == ['big.bin', 'middle.bin', 'small.bin']
+
+
+def test_send_dry_run(tmp_path, storage_cli, caplog):
+    send, device = send_tree(tmp_path)
+    caplog.set_level(logging.INFO)
+
+    main = storage_cli(*send, '-n')
+    assert main.files == 0
+    assert sent(caplog) == ['big.bin', 'middle.bin', 'small.bin']
+    assert not (device / 'ext' / 'sent').exists()
+    # nothing was confirmed, a real run sends everything
+    assert storage_cli(*send).files == 3
+
+
+def test_send_time_budget(tmp_path, storage_cli, caplog):
+    send, device = send_tree(tmp_path)
+    caplog.set_level(logging.INFO)
+
+    main = storage_cli(*send, '--time-budget', '0')
+    assert main.files == 0
+    assert any(record.getMessage().startswith('Time budget reached, 3 files') for record in caplog.records)
+    assert os.listdir(device / 'ext' / 'sent') == []
@@ -0,0 +1,82 @@
+import errno
+import os
+
+import flipper_storage_lib
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import NotExistError, BackgroundWriter
+
+
+def test_read_to_file(connect, tmp_path):
+    tree = MemoryTree()
+    data = os.urandom(20000)
+    tree.append('/ext/file.bin', data)
+    storage = connect(tree)
+
+    with open(tmp_path / 'received.bin', 'wb') as file:
+        assert storage.read_file_to('/ext/file.bin', file, 1024)
+    assert (tmp_path / 'received.bin').read_bytes() == data
+
+
+def test_read_empty_file(connect):
+    tree = MemoryTree()
+    tree.append('/ext/empty.bin', b'')
+    storage = connect(tree)
+
+    assert storage.read_file('/ext/empty.bin') == b''
+    assert storage.mkdir('/ext/dir')
+
+
+def test_receive_file_replaces_target(connect, tmp_path):
+    tree = MemoryTree()
+    data = os.urandom(5000)
+    tree.append('/ext/file.bin', data)
+    storage = connect(tree)
+    (tmp_path / 'received.bin').write_bytes(b'old')
+
+    assert storage.receive_file('/ext/file.bin', str(tmp_path / 'received.bin'), verify=True)
+    assert (tmp_path / 'received.bin').read_bytes() == data
+    # nothing but the target is left behind
+    assert os.listdir(tmp_path) == ['received.bin']
+
+
+def test_read_missing_file(connect):
+    storage = connect()
+
+    assert not storage.read_file_to('/ext/missing.bin', lambda data: None)
+    assert isinstance(storage.last_exception, NotExistError)
+    assert storage.last_exception.command == 'read_chunks'
+
+
+def test_read_timeout_leaves_cli_at_prompt(connect):
+    tree = MemoryTree()
+    tree.append('/ext/file.bin', os.urandom(3000))
+    # a chunk takes longer than the port timeout
+    storage = connect(tree, byte_latency=0.00015)
+
+    assert not storage.read_file_to('/ext/file.bin', lambda data: None)
+    assert storage.last_error == 'timeout at offset 0'
+    storage.cache.invalidate()
+    assert storage.size('/ext/file.bin') == 3000
+    assert storage.mkdir('/ext/dir')
+
+
+class FullDisk:
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+
+def test_receive_write_error_is_final(connect, tmp_path, monkeypatch):
+    monkeypatch.setattr(flipper_storage_lib, 'BackgroundWriter', lambda file, hash_md5=None: BackgroundWriter(FullDisk(file), hash_md5))
+    tree = MemoryTree()
+    tree.append('/ext/file.bin', os.urandom(5000))
+    storage = connect(tree)
+
+    assert not storage.receive_file('/ext/file.bin', str(tmp_path / 'received.bin'))
+    assert os.strerror(errno.ENOSPC) in storage.last_error
+    assert storage.port.calls['read_chunks'] == 1
+    assert os.listdir(tmp_path) == []
+    storage.cache.invalidate()
+    assert storage.size('/ext/file.bin') == 5000
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import TransferJournal
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_send_resumes_after_disconnect(connect, local_file, window):
+    tree = MemoryTree()
+    storage = connect(tree, disconnect_after=20000)
+    path, data = local_file(50000)
+
+    assert storage.send_file(path, '/ext/file.bin', window, 512)
+    assert tree.read('/ext/file.bin') == data
+    # the part written before the link broke was not sent again
+    assert storage.port.calls['write_chunk'] < 50000 // 512 + 20
+
+
+def test_receive_retries_after_disconnect(connect, tmp_path):
+    tree = MemoryTree()
+    data = os.urandom(50000)
+    tree.append('/ext/file.bin', data)
+    storage = connect(tree, disconnect_after=300)
+    target = str(tmp_path / 'received.bin')
+
+    assert storage.receive_file('/ext/file.bin', target, verify=True)
+    with open(target, 'rb') as file:
+        assert file.read() == data
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_send_resumes_after_stall(connect, local_file, window):
+    tree = MemoryTree()
+    storage = connect(tree, stall_after=20000)
+    path, data = local_file(50000)
+
+    assert storage.send_file(path, '/ext/file.bin', window, 512)
+    assert str(storage.last_exception) == 'no answer from device'
+    assert tree.read('/ext/file.bin') == data
+    assert storage.port.calls['write_chunk'] < 50000 // 512 + 20
+
+
+def test_receive_retries_after_stall(connect, tmp_path):
+    tree = MemoryTree()
+    data = os.urandom(50000)
+    tree.append('/ext/file.bin', data)
+    storage = connect(tree, stall_after=300)
+    target = str(tmp_path / 'received.bin')
+
+    assert storage.receive_file('/ext/file.bin', target)
+    with open(target, 'rb') as file:
+        assert file.read() == data
+
+
+def test_send_resumes_interrupted_run(connect, local_file, tmp_path):
+    tree = MemoryTree()
+    path, data = local_file(50000)
+    storage = connect(tree, disconnect_after=20000)
+    storage.retries = 0
+    storage.journal = TransferJournal(str(tmp_path / 'journal.json'))
+    assert not storage.send_file(path, '/ext/file.bin', 8, 512)
+    written = len(tree.read('/ext/file.bin'))
+    assert 0 < written < 50000
+
+    # a later run finds the upload in the journal
+    storage = connect(tree)
+    storage.journal = TransferJournal(str(tmp_path / 'journal.json'))
+    assert storage.send_file(path, '/ext/file.bin', 8, 512)
+    assert tree.read('/ext/file.bin') == data
+    assert storage.port.calls['write_chunk'] == -(-(50000 - written) // 512)
+    assert TransferJournal(str(tmp_path / 'journal.json')).files == {}
+
+
+def test_resume_sends_all_if_device_file_differs(connect, local_file):
+    tree = MemoryTree()
+    path, data = local_file(5000)
+    tree.append('/ext/file.bin', b'x' * 1000)
+    storage = connect(tree)
+
+    assert storage.send_file(path, '/ext/file.bin', 8, 512, resume=True)
+    assert tree.read('/ext/file.bin') == data
+    assert storage.port.calls['write_chunk'] == 10
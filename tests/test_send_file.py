@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+from flipper_storage_emulator import MemoryTree
+from flipper_storage_lib import NotExistError
+
+
+@pytest.mark.parametrize('window', [1, 8])
+@pytest.mark.parametrize('size', [1, 512, 513, 20000])
+def test_send_read_round_trip(connect, local_file, window, size):
+    tree = MemoryTree()
+    storage = connect(tree)
+    path, data = local_file(size)
+
+    assert storage.send_file(path, '/ext/file.bin', window)
+    assert tree.read('/ext/file.bin') == data
+    assert bytes(storage.read_file('/ext/file.bin')) == data
+    assert storage.hash_flipper('/ext/file.bin') == storage.hash_local(path)
+
+
+@pytest.mark.parametrize('window', [1, 8])
+def test_send_error_offset(connect, local_file, window):
+    storage = connect(faults={'write_chunk': [3]})
+    storage.retries = 0
+    path, data = local_file(5000)
+
+    assert not storage.send_file(path, '/ext/file.bin', window, 512)
+    assert storage.last_error_offset == 1024
+    assert str(storage.last_exception) == 'internal error at offset 1024'
+    assert storage.last_exception.command == 'write_chunk'
+    assert storage.last_exception.path == '/ext/file.bin'
+
+
+def test_send_error_after_first_chunk_is_retried(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree, faults={'write_chunk': [3]})
+    path, data = local_file(5000)
+
+    assert storage.send_file(path, '/ext/file.bin', 8, 512)
+    assert tree.read('/ext/file.bin') == data
+
+
+def test_send_error_of_first_chunk_is_final(connect, local_file):
+    storage = connect()
+    path, data = local_file(5000)
+
+    assert not storage.send_file(path, '/ext/missing/file.bin', 8)
+    assert isinstance(storage.last_exception, NotExistError)
+    assert storage.last_error_offset == 0
+
+
+# with a window, write_chunk commands do not wait for the answers of the ones before
+def test_pipelined_send_is_faster(connect, local_file):
+    path, data = local_file(20000)
+    took = {}
+    for window in (1, 8):
+        tree = MemoryTree()
+        storage = connect(tree, link_latency=0.002)
+        start = time.monotonic()
+        assert storage.send_file(path, '/ext/file.bin', window, 512)
+        took[window] = time.monotonic() - start
+        assert tree.read('/ext/file.bin') == data
+    assert took[8] < took[1] * 0.6
+
+
+def test_write_chunks_reuse_one_buffer(connect, local_file):
+    storage = connect()
+    path, data = local_file(2500)
+    write_buffer = storage.write_buffer('/ext/file.bin', 1024)
+
+    with open(path, 'rb') as file:
+        chunks = []
+        while True:
+            command, payload = storage.next_write_chunk(file, write_buffer, 1024)
+            if not payload:
+                break
+            assert payload.obj is write_buffer[2]
+            assert bytes(command) == b'storage write_chunk "/ext/file.bin" %d\r' % len(payload) + bytes(payload)
+            chunks.append(bytes(payload))
+    assert chunks == [data[:1024], data[1024:2048], data[2048:]]
+
+
+def test_send_hashes_in_the_same_pass(connect, local_file):
+    tree = MemoryTree()
+    storage = connect(tree)
+    path, data = local_file(5000)
+
+    assert storage.send_file(path, '/ext/file.bin', 8, 1024)
+    # the local file was hashed while it was read for sending
+    def compute(filename):
+        raise AssertionError('hashed again')
+    assert storage.hash_cache.get(path, compute) == storage.hash_flipper('/ext/file.bin')
@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from flipper_storage_emulator import EmulatedSerial, DirectoryTree
+from flipper_storage_lib import FlipperStorage, NotExistError
+import flipper_storage_session
+from flipper_storage_session import SessionServer, SessionClient, socket_path
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+pytestmark = pytest.mark.skipif(not flipper_storage_session.available(), reason='sessions need Unix domain sockets')
+
+
+# SessionServer of an emulated device on DIR, serving in a thread, yields (port name, device directory, server)
+@pytest.fixture
+def session(monkeypatch):
+    # socket paths are limited to about 100 bytes
+    cache = tempfile.mkdtemp(prefix='fs-')
+    monkeypatch.setenv('XDG_CACHE_HOME', cache)
+    device = os.path.join(cache, 'device')
+    os.makedirs(os.path.join(device, 'ext'))
+    port = 'emu:' + device
+    storage = FlipperStorage(port, EmulatedSerial(DirectoryTree(device)))
+    storage.start()
+    server = SessionServer(storage, socket_path(port))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield port, device, server
+    server.shutdown()
+    server.server_close()
+    storage.stop()
+    shutil.rmtree(cache)
+
+
+def test_client_calls(session):
+    port, device, server = session
+    client = SessionClient.connect(socket_path(port))
+
+    assert client.mkdir('/ext/dir')
+    assert client.stat('/ext/dir').is_dir
+    assert client.stat('/ext/missing') is None
+    assert isinstance(client.last_exception, NotExistError)
+    assert [entry.name for entry in client.scandir('/ext')] == ['dir']
+    assert list(client.walk('/ext')) == [('/ext', ['dir'], []), ('/ext/dir', [], [])]
+    assert os.path.isdir(os.path.join(device, 'ext', 'dir'))
+
+
+def test_client_transfers(session, tmp_path):
+    port, device, server = session
+    client = SessionClient.connect(socket_path(port))
+    local = tmp_path / 'file.bin'
+    local.write_bytes(os.urandom(3000))
+
+    assert client.send_file(str(local), '/ext/file.bin')
+    assert client.hash_flipper('/ext/file.bin') == client.hash_local(str(local))
+    assert bytes(client.read_file('/ext/file.bin')) == local.read_bytes()
+
+
+# session comes last, its cache directory holds the socket
+def test_commands_use_session(storage_cli, session):
+    port, device, server = session
+
+    storage_cli('-p', port, 'mkdir', '-fp', '/ext/dir', use_session=True)
+    assert server.calls > 0
+    assert os.path.isdir(os.path.join(device, 'ext', 'dir'))
+
+    calls = server.calls
+    storage_cli('-p', port, 'mkdir', '-fp', '/ext/other')
+    assert server.calls == calls
+    assert os.path.isdir(os.path.join(device, 'ext', 'other'))
+
+
+def test_no_session(tmp_path):
+    assert SessionClient.connect(str(tmp_path / 'missing.sock')) is None
+
+
+# storage.py has to work where there are no Unix domain sockets, e.g. on Windows
+def test_storage_without_unix_sockets(tmp_path):
+    device = tmp_path / 'device'
+    (device / 'ext').mkdir(parents=True)
+    script = (
+        'import socket, sys\n'
+        'del socket.AF_UNIX\n'
+        'import storage\n'
+        'sys.argv = ["storage.py", "-p", "emu:" + sys.argv[1], "mkdir", "-fp", "/ext/dir"]\n'
+        'storage.Main()()\n'
+    )
+    environment = dict(os.environ, XDG_CACHE_HOME=str(tmp_path / 'cache'))
+    subprocess.run([sys.executable, '-c', script, str(device)], cwd=ROOT, env=environment, check=True, capture_output=True)
+    assert (device / 'ext' / 'dir').is_dir()
@@ -0,0 +1,188 @@
+import logging
+import os
+
+import pytest
+
+import storage
+from flipper_storage_emulator import EmulatedSerial
+
+
+# Directory behind an emulated device, used with "-p emu:DIR"
+@pytest.fixture
+def device(tmp_path):
+    device = tmp_path / 'device'
+    (device / 'ext').mkdir(parents=True)
+    return device
+
+
+def port(device):
+    return 'emu:' + str(device)
+
+
+# EmulatedSerial ports storage.py commands open from now on, with extra EmulatedSerial options
+# returns the list they are added to, their calls tell which commands ran
+@pytest.fixture
+def emulated(monkeypatch):
+    ports = []
+
+    def emulated(**options):
+        def new_port(tree):
+            ports.append(EmulatedSerial(tree, **options))
+            return ports[-1]
+        monkeypatch.setattr(storage, 'EmulatedSerial', new_port)
+        return ports
+
+    return emulated
+
+
+# Files under root as {relative path: data}
+def tree(root):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as file:
+                files[os.path.relpath(path, root).replace(os.sep, '/')] = file.read()
+    return files
+
+
+def write(root, files):
+    for path, data in files.items():
+        os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+        with open(os.path.join(root, path), 'wb') as file:
+            file.write(data)
+
+
+def errors(caplog):
+    return [record.getMessage() for record in caplog.records if record.levelno >= logging.ERROR]
+
+
+def test_receive_delete(device, tmp_path, storage_cli, caplog):
+    remote = {'a.bin': os.urandom(1000), 'sub/b.bin': os.urandom(2000)}
+    write(device / 'ext' / 'dir', remote)
+    local = tmp_path / 'local'
+    write(local, {'old.bin': b'old', 'gone/c.bin': b'c', 'sub/b.bin': b'stale'})
+    os.makedirs(local / 'empty')
+
+    storage_cli('-p', port(device), 'receive', '-fp', '/ext/dir', '-lp', str(local), '--delete')
+    assert errors(caplog) == []
+    assert tree(local) == remote
+    assert sorted(os.listdir(local)) == ['a.bin', 'sub']
+
+
+def test_receive_delete_skipped_after_error(device, tmp_path, storage_cli, caplog, emulated):
+    emulated(faults={'read_chunks': [1]})
+    write(device / 'ext' / 'dir', {'a.bin': os.urandom(1000), 'b.bin': os.urandom(1000)})
+    local = tmp_path / 'local'
+    write(local, {'old.bin': b'old'})
+
+    storage_cli('-p', port(device), 'receive', '-fp', '/ext/dir', '-lp', str(local), '--delete')
+    assert any('not removing local files' in message for message in errors(caplog))
+    assert (local / 'old.bin').exists()
+    assert (local / 'b.bin').exists()
+
+
+def test_receive_incremental(device, tmp_path, storage_cli):
+    remote = {'a.bin': os.urandom(1000), 'sub/b.bin': os.urandom(2000)}
+    write(device / 'ext' / 'dir', remote)
+    local = tmp_path / 'local'
+
+    main = storage_cli('-p', port(device), 'receive', '-fp', '/ext/dir', '-lp', str(local), '-i')
+    assert (main.files, main.skipped) == (2, 0)
+    assert tree(local) == remote
+
+    # same size, other data
+    remote['a.bin'] = os.urandom(1000)
+    write(device / 'ext' / 'dir', remote)
+    main = storage_cli('-p', port(device), 'receive', '-fp', '/ext/dir', '-lp', str(local), '-i')
+    assert (main.files, main.skipped) == (1, 1)
+    assert tree(local) == remote
+
+
+def test_send_takes_sizes_from_listings(device, tmp_path, storage_cli, emulated):
+    local = tmp_path / 'local'
+    write(local, {'a.bin': os.urandom(1000), 'sub/b.bin': os.urandom(2000), 'sub/deeper/c.bin': os.urandom(10)})
+    ports = emulated()
+
+    main = storage_cli('-p', port(device), 'send', '-fp', '/ext/sent', '-lp', str(local), '--no-manifest')
+    assert main.files == 3
+    assert tree(device / 'ext' / 'sent') == tree(local)
+
+    main = storage_cli('-p', port(device), 'send', '-fp', '/ext/sent', '-lp', str(local), '--no-manifest')
+    assert (main.files, main.skipped) == (0, 3)
+    # one listing per directory, files of the same size are compared by hash, nothing is stat'ed
+    assert ports[-1].calls == {'list': 3, 'md5': 3}
+
+
+def test_send_manifest_skips_hashing(device, tmp_path, storage_cli, emulated):
+    local = tmp_path / 'local'
+    write(local, {'a.bin': os.urandom(1000), 'sub/b.bin': os.urandom(2000)})
+    ports = emulated()
+    send = ('-p', port(device), 'send', '-fp', '/ext/sent', '-lp', str(local))
+
+    assert storage_cli(*send).files == 2
+    main = storage_cli(*send)
+    assert (main.files, main.skipped) == (0, 2)
+    assert ports[-1].calls == {'list': 2}
+
+    # --verify and --no-manifest compare by hash again
+    assert storage_cli(*send, '-v').skipped == 2
+    assert ports[-1].calls['md5'] == 2
+    assert storage_cli(*send, '--no-manifest').skipped == 2
+    assert ports[-1].calls['md5'] == 2
+
+    # same size, other data and mtime
+    write(local, {'a.bin': os.urandom(1000)})
+    stat = os.stat(local / 'a.bin')
+    os.utime(local / 'a.bin', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    main = storage_cli(*send)
+    assert (main.files, main.skipped) == (1, 1)
+    assert ports[-1].calls['md5'] == 1
+    assert tree(device / 'ext' / 'sent') == tree(local)
+
+
+def test_receive_manifest_skips_local_hashing(device, tmp_path, storage_cli, emulated, monkeypatch):
+    write(device / 'ext' / 'dir', {'a.bin': os.urandom(1000), 'b.bin': os.urandom(2000)})
+    local = tmp_path / 'local'
+    local.mkdir()
+    receive = ('-p', port(device), 'receive', '-fp', '/ext/dir', '-lp', str(local), '-i')
+    storage_cli(*receive)
+
+    hashed = []
+    hash_local = storage.FlipperStorage.hash_local
+    monkeypatch.setattr(storage.FlipperStorage, 'hash_local', lambda self, path: hashed.append(path) or hash_local(self, path))
+    assert storage_cli(*receive).skipped == 2
+    assert hashed == []
+    assert storage_cli(*receive, '--no-manifest').skipped == 2
+    assert len(hashed) == 2
+
+
+def test_send_delta_appends_tail(device, tmp_path, storage_cli, emulated):
+    local = tmp_path / 'local'
+    log = os.urandom(20000)
+    write(local, {'log.txt': log, 'other.txt': os.urandom(20000)})
+    ports = emulated()
+    send = ('-p', port(device), 'send', '-fp', '/ext/sent', '-lp', str(local), '-D')
+    storage_cli(*send)
+
+    # grown file with the old data as prefix, and one rewritten before growing
+    write(local, {'log.txt': log + os.urandom(1000), 'other.txt': os.urandom(21000)})
+    assert storage_cli(*send).files == 2
+    assert tree(device / 'ext' / 'sent') == tree(local)
+    # the tail of log.txt in two chunks, other.txt from the start
+    assert ports[-1].calls['write_chunk'] == 2 + -(-21000 // 512)
+    assert ports[-1].calls['md5'] == 2
+
+
+def test_send_without_delta_sends_all(device, tmp_path, storage_cli, emulated):
+    local = tmp_path / 'local'
+    log = os.urandom(20000)
+    write(local, {'log.txt': log})
+    ports = emulated()
+    send = ('-p', port(device), 'send', '-fp', '/ext/sent', '-lp', str(local))
+    storage_cli(*send)
+
+    write(local, {'log.txt': log + os.urandom(1000)})
+    storage_cli(*send)
+    assert tree(device / 'ext' / 'sent') == tree(local)
+    assert ports[-1].calls['write_chunk'] == -(-21000 // 512)
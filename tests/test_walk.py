@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+
+from flipper_storage_emulator import MemoryTree
+
+
+# /ext/a/x.txt, /ext/a/b/y.txt, /ext/a/b/deep/, /ext/c/z.bin
+@pytest.fixture
+def tree():
+    tree = MemoryTree()
+    for path in ('/ext/a', '/ext/a/b', '/ext/a/b/deep', '/ext/c'):
+        tree.mkdir(path)
+    tree.append('/ext/a/x.txt', b'x')
+    tree.append('/ext/a/b/y.txt', b'yy')
+    tree.append('/ext/c/z.bin', b'zzz')
+    return tree
+
+
+def paths(entries):
+    return [(entry.path, entry.depth) for entry in entries]
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_traverse_dfs(connect, tree, prefetch):
+    storage = connect(tree)
+    assert paths(storage.traverse('/ext', prefetch=prefetch)) == [
+        ('/ext/a', 0), ('/ext/a/b', 1), ('/ext/a/b/deep', 2), ('/ext/a/b/y.txt', 2), ('/ext/a/x.txt', 1),
+        ('/ext/c', 0), ('/ext/c/z.bin', 1),
+    ]
+    # every directory is listed once
+    assert storage.port.calls['list'] == 5
+
+
+@pytest.mark.parametrize('prefetch', [False, True])
+def test_traverse_bfs(connect, tree, prefetch):
+    storage = connect(tree)
+    assert paths(storage.traverse('/ext', 'bfs', prefetch=prefetch)) == [
+        ('/ext/a', 0), ('/ext/c', 0), ('/ext/a/b', 1), ('/ext/a/x.txt', 1), ('/ext/c/z.bin', 1),
+        ('/ext/a/b/deep', 2), ('/ext/a/b/y.txt', 2),
+    ]
+    assert storage.port.calls['list'] == 5
+
+
+def test_traverse_depth_and_pattern(connect, tree):
+    storage = connect(tree)
+    assert paths(storage.traverse('/ext', max_depth=0)) == [('/ext/a', 0), ('/ext/c', 0)]
+    assert [entry.path for entry in storage.traverse('/ext', pattern='*.txt')] == ['/ext/a/b/y.txt', '/ext/a/x.txt']
+    with pytest.raises(ValueError):
+        list(storage.traverse('/ext', 'sideways'))
+
+
+def test_traverse_with_commands_in_between(connect, tree):
+    storage = connect(tree)
+    found = []
+    for entry in storage.traverse('/ext'):
+        found.append(entry.path)
+        # the listing sent ahead is read before the answer to this command
+        if not entry.is_dir:
+            assert storage.hash_flipper(entry.path)
+    assert found == [path for path, depth in paths(connect(tree).traverse('/ext'))]
+
+
+def test_walk(connect, tree):
+    storage = connect(tree)
+    assert list(storage.walk('/ext')) == [
+        ('/ext', ['a', 'c'], []),
+        ('/ext/a', ['b'], ['x.txt']),
+        ('/ext/a/b', ['deep'], ['y.txt']),
+        ('/ext/a/b/deep', [], []),
+        ('/ext/c', [], ['z.bin']),
+    ]
+
+
+def test_walk_skips_removed_dirs(connect, tree):
+    storage = connect(tree)
+    walked = []
+    for path, dirnames, filenames in storage.walk('/ext'):
+        walked.append(path)
+        if 'a' in dirnames:
+            dirnames.remove('a')
+    assert walked == ['/ext', '/ext/c']
+
+
+def test_walk_entries(connect, tree):
+    storage = connect(tree)
+    path, dirs, files = next(storage.walk('/ext/a', entries=True))
+    assert [(entry.name, entry.is_dir) for entry in dirs] == [('b', True)]
+    assert [(entry.name, entry.size) for entry in files] == [('x.txt', 1)]
+
+
+def test_storage_list_json(tmp_path, storage_cli, capsys):
+    device = tmp_path / 'device'
+    (device / 'ext' / 'dir').mkdir(parents=True)
+    (device / 'ext' / 'dir' / 'file.bin').write_bytes(os.urandom(10))
+
+    storage_cli('-p', 'emu:' + str(device), 'list', '-fp', '/ext', '--json', '--bfs')
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert records == [
+        {'path': '/ext/dir', 'type': 'dir', 'size': 0, 'depth': 0},
+        {'path': '/ext/dir/file.bin', 'type': 'file', 'size': 10, 'depth': 1},
+    ]